@@ -0,0 +1,134 @@
+"""
+Copyright (c) 2021 Jet Propulsion Laboratory,
+California Institute of Technology.  All rights reserved
+
+Compares the previous WKT -> OGR geometry handling (copied below, needs GDAL) against the
+PostGIS GeoJSON/WKB handling in msfbe.geometry, in rows per second including serialization of
+the response. Rows are synthetic flightline polygons in the formats each version selects.
+
+    python benchmarks/bench_geometry.py --rows 20000 --vertices 50
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from msfbe import geometry
+from msfbe import serialization
+
+try:
+    from osgeo import ogr
+except ImportError:
+    ogr = None
+
+
+def make_rings(num_rows, num_vertices, seed=0):
+    rnd = random.Random(seed)
+    rings = []
+    for i in range(num_rows):
+        lon, lat = rnd.uniform(-124, -114), rnd.uniform(32, 42)
+        ring = []
+        for j in range(num_vertices):
+            angle = 2 * math.pi * j / num_vertices
+            ring.append((lon + 0.1 * math.cos(angle), lat + 0.1 * math.sin(angle)))
+        ring.append(ring[0])
+        rings.append(ring)
+    return rings
+
+
+def to_wkt(ring):
+    return "POLYGON ((%s))" % ",".join("%.15g %.15g" % pt for pt in ring)
+
+
+def to_geojson(ring):
+    return '{"type":"Polygon","coordinates":[[%s]]}' % ",".join("[%.15g,%.15g]" % pt for pt in ring)
+
+
+def to_wkb(ring):
+    return struct.pack("<BII", 1, 2, len(ring)) + struct.pack("<%dd" % (2 * len(ring)), *[c for pt in ring for c in pt])
+
+
+def properties(i):
+    return {
+        "name": "ang%08d" % i,
+        "png_url": "https://example.com/%d.png" % i,
+        "data_date_dt": "2020-09-01 18:00:00",
+        "id": i
+    }
+
+
+def previous_basic(rows):
+    results = []
+    for i, wkt in enumerate(rows):
+        shape = []
+        shape_geom = ogr.CreateGeometryFromWkt(wkt)
+        shape_geom_poly = shape_geom.GetGeometryRef(0)
+        for j in range(0, shape_geom_poly.GetPointCount()):
+            pt = shape_geom_poly.GetPoint(j)
+            shape.append(pt[:2])
+        results.append({"id": i, "shape": shape})
+    return serialization.dumps(results)
+
+
+def previous_geojson(rows):
+    features = []
+    for i, wkt in enumerate(rows):
+        feature = json.loads(ogr.CreateGeometryFromWkt(wkt).ExportToJson())
+        feature["properties"] = properties(i)
+        features.append(feature)
+    return serialization.dumps({"type": "FeatureCollection", "features": features})
+
+
+def current_basic(rows):
+    return serialization.dumps([{"id": i, "shape": geometry.ring_points(wkb)} for i, wkb in enumerate(rows)])
+
+
+def current_geojson(rows):
+    features = [geometry.with_members(text, {"properties": properties(i)}) for i, text in enumerate(rows)]
+    return serialization.dumps({"type": "FeatureCollection", "features": features})
+
+
+def bench(name, fn, rows, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        fn(rows)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print("%-28s %12.0f rows/s" % (name, len(rows) / best))
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark geometry formatting of query results")
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--vertices", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    rings = make_rings(args.rows, args.vertices)
+    wkt_rows = [to_wkt(ring) for ring in rings]
+    wkb_rows = [buffer(to_wkb(ring)) if sys.version_info[0] == 2 else memoryview(to_wkb(ring)) for ring in rings]
+    geojson_rows = [to_geojson(ring) for ring in rings]
+
+    print("Formatting %s rows of %s vertices with the %s JSON backend (best of %s)" %
+          (args.rows, args.vertices + 1, serialization.backend_name(), args.repeat))
+    for label, previous, current, rows in (("point list", previous_basic, current_basic, wkb_rows),
+                                           ("GeoJSON", previous_geojson, current_geojson, geojson_rows)):
+        after = bench("%s, PostGIS" % label, current, rows, args.repeat)
+        if ogr is None:
+            print("%-28s %12s" % ("%s, WKT/OGR" % label, "skipped (GDAL is not installed)"))
+            continue
+        before = bench("%s, WKT/OGR" % label, previous, wkt_rows, args.repeat)
+        print("  speedup: %.2fx" % (before / after))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Copyright (c) 2021 Jet Propulsion Laboratory,
+California Institute of Technology.  All rights reserved
+
+Compares the previous response serialization (json.dumps with indent=4 and CustomEncoder)
+against msfbe.serialization on a synthetic /vista response.
+
+    python benchmarks/bench_serialization.py --features 50000
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from decimal import Decimal
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import msfbe.serialization as serialization
+from msfbe.serialization import JsonEncoder
+
+
+def make_vista_response(num_features, sources_per_feature=2, seed=0):
+    rnd = random.Random(seed)
+    features = []
+    for i in range(num_features):
+        lat = rnd.uniform(32.0, 42.0)
+        lon = rnd.uniform(-124.0, -114.0)
+        sources = {}
+        for j in range(sources_per_feature):
+            source_id = "P%05d-%d" % (i, j)
+            sources[source_id] = {
+                "id": source_id,
+                "lat": Decimal("%.6f" % (lat + rnd.uniform(-0.01, 0.01))),
+                "lon": Decimal("%.6f" % (lon + rnd.uniform(-0.01, 0.01))),
+                "area": "Area %s" % (i % 50),
+                "type": "Point",
+                "est_dist_from_facility": rnd.uniform(0, 500),
+                "sector_level_1": "Energy",
+                "sector_level_2": "Oil and Gas",
+                "sector_level_3": "Production",
+                "internal_id": source_id
+            }
+        features.append({
+            "type": "Feature",
+            "geometry": {
+                "type": "Polygon",
+                "coordinates": [[[lon, lat], [lon + 0.001, lat], [lon + 0.001, lat + 0.001], [lon, lat + 0.001], [lon, lat]]]
+            },
+            "properties": {
+                "name": "Facility %s" % i,
+                "id": "VF%06d" % i,
+                "internal_id": i,
+                "category_id": i % 14,
+                "category": "Category %s" % (i % 14),
+                "num_flights_matching": rnd.randint(0, 40),
+                "num_plumes_matching": rnd.randint(0, 5),
+                "description": None,
+                "metadata": {
+                    "LLat": str(round(lat * 100000) / 100000),
+                    "LLong": str(round(lon * 100000) / 100000)
+                },
+                "sources": sources
+            }
+        })
+
+    return {
+        "type": "FeatureCollection",
+        "crs": {"type": "name", "properties": {"name": "EPSG:4326"}},
+        "features": features
+    }
+
+
+def previous_serializer(obj):
+    return json.dumps(obj, indent=4, cls=JsonEncoder)
+
+
+def bench(name, fn, obj, repeat):
+    best = None
+    body = None
+    for i in range(repeat):
+        start = time.time()
+        body = fn(obj)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print("%-28s %8.3f s  %10.1f KB" % (name, best, len(body) / 1024.0))
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark JSON serialization of a /vista response")
+    parser.add_argument("--features", type=int, default=50000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    response = make_vista_response(args.features)
+
+    print("Serializing %s features (best of %s)" % (args.features, args.repeat))
+    baseline = bench("indent=4 + CustomEncoder", previous_serializer, response, args.repeat)
+
+    serialization.set_backend(serialization.JsonBackends.JSON)
+    compact = bench("compact (json)", serialization.dumps, response, args.repeat)
+    print("  speedup: %.2fx" % (baseline / compact))
+
+    if serialization.simplejson is not None:
+        serialization.set_backend(serialization.JsonBackends.SIMPLEJSON)
+        fast = bench("compact (simplejson)", serialization.dumps, response, args.repeat)
+        print("  speedup: %.2fx" % (baseline / fast))
+
+
+if __name__ == "__main__":
+    main()
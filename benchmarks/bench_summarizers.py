@@ -0,0 +1,157 @@
+"""
+Copyright (c) 2021 Jet Propulsion Laboratory,
+California Institute of Technology.  All rights reserved
+
+Compares the previous per-row summarizers (copied below) against the columnar summarizers in
+msfbe.queryhandlers on synthetic /methanePlumeSourcesSummary rows.
+
+    python benchmarks/bench_summarizers.py --rows 1000000
+
+The previous COUNT_DISTINCT scans a list per row, so its cost grows with the number of distinct
+sources; --baseline-rows runs it on a prefix of the rows and scales the time up linearly, which
+underestimates it.
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from msfbe.queryhandlers import QueryResultsSummarizer, SummaryTypes, summary
+
+SUMMARIZE = [
+    summary("number_of_sources", SummaryTypes.COUNT_DISTINCT),
+    summary("avg_source_persistance", SummaryTypes.AVERAGE),
+    summary("total_overflights", SummaryTypes.SUM),
+    summary("avg_q_source_final", SummaryTypes.AVERAGE),
+    summary("avg_q_source_final_sigma", SummaryTypes.AVERAGE),
+    summary("avg_confidence_in_persistence", SummaryTypes.AVERAGE)
+]
+
+
+def make_rows(num_rows, num_sources, null_fraction=0.05, seed=0):
+    rnd = random.Random(seed)
+
+    def maybe_null(value):
+        return None if rnd.random() < null_fraction else value
+
+    rows = []
+    for i in range(num_rows):
+        rows.append({
+            "number_of_sources": "P%06d" % rnd.randint(0, num_sources - 1),
+            "avg_source_persistance": maybe_null(rnd.random()),
+            "total_overflights": rnd.randint(0, 40),
+            "avg_q_source_final": maybe_null(rnd.uniform(0, 2000)),
+            "avg_q_source_final_sigma": maybe_null(rnd.uniform(0, 500)),
+            "avg_confidence_in_persistence": maybe_null(rnd.random()),
+            "vista_id": "VF%06d" % (i % 50000)
+        })
+    return rows
+
+
+class PreviousAverage(object):
+    def __init__(self, field):
+        self.field = field
+        self.values = []
+
+    def next(self, row):
+        row_value = row[self.field]
+        if row_value is not None:
+            self.values.append(row_value)
+
+    def value(self):
+        v = np.mean(self.values)
+        return 0.0 if np.isnan(v) else v
+
+
+class PreviousSum(object):
+    def __init__(self, field):
+        self.field = field
+        self.total = 0.0
+
+    def next(self, row):
+        row_value = row[self.field]
+        if row_value is not None:
+            self.total += row_value
+
+    def value(self):
+        return self.total
+
+
+class PreviousCountDistinct(object):
+    def __init__(self, field):
+        self.field = field
+        self.value_list = []
+
+    def next(self, row):
+        row_value = row[self.field]
+        if row_value is not None and not row_value in self.value_list:
+            self.value_list.append(row_value)
+
+    def value(self):
+        return len(self.value_list)
+
+
+_PREVIOUS = {
+    SummaryTypes.AVERAGE: PreviousAverage,
+    SummaryTypes.SUM: PreviousSum,
+    SummaryTypes.COUNT_DISTINCT: PreviousCountDistinct
+}
+
+
+def previous_summarize(rows):
+    summarizers = [_PREVIOUS[spec["type"]](spec["name"]) for spec in SUMMARIZE]
+    for row in rows:
+        for summarizer in summarizers:
+            summarizer.next(row)
+    return [dict((summarizer.field, summarizer.value()) for summarizer in summarizers)]
+
+
+def columnar_summarize(rows):
+    return QueryResultsSummarizer(SUMMARIZE).summarize_resultset(rows)
+
+
+def bench(name, fn, rows, repeat, scale=1.0):
+    best = None
+    result = None
+    for i in range(repeat):
+        start = time.time()
+        result = fn(rows)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    best *= scale
+    print("%-28s %8.3f s%s" % (name, best, "  (scaled from %s rows)" % len(rows) if scale != 1.0 else ""))
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark in-process query result summaries")
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--sources", type=int, default=5000)
+    parser.add_argument("--baseline-rows", type=int, default=None,
+                        help="Run the previous summarizers on this many rows and scale the time up")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    rows = make_rows(args.rows, args.sources)
+    baseline_rows = rows[:args.baseline_rows] if args.baseline_rows else rows
+
+    print("Summarizing %s rows, %s sources (best of %s)" % (args.rows, args.sources, args.repeat))
+    baseline, previous = bench("per-row summarizers", previous_summarize, baseline_rows, args.repeat,
+                               float(len(rows)) / len(baseline_rows))
+    columnar, current = bench("columnar summarizers", columnar_summarize, rows, args.repeat)
+    print("  speedup: %.2fx" % (baseline / columnar))
+
+    if len(baseline_rows) == len(rows):
+        for name, value in previous[0].items():
+            if not np.isclose(value, current[0][name]):
+                print("  mismatch for %s: %s != %s" % (name, value, current[0][name]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,371 @@
+"""
+Copyright (c) 2021 Jet Propulsion Laboratory,
+California Institute of Technology.  All rights reserved
+
+Loads a synthetic, deterministic data set into the schema in schema.sql. Row counts scale
+linearly with the scale factor; scale 1 is roughly the size of the production tables.
+
+    python benchmarks/fixtures.py --dsn "dbname=methane_bench user=postgres" --scale 2
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import random
+import time
+from datetime import datetime, timedelta
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+SCHEMA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "schema.sql")
+
+# Rows per table at scale 1
+BASE_ROWS = {
+    "vista": 20000,
+    "sources": 3000,
+    "flightlines": 2000,
+    "plumes": 6000,
+    "field_boundaries": 500
+}
+
+# California
+MIN_LON, MIN_LAT, MAX_LON, MAX_LAT = -124.4, 32.5, -114.1, 42.0
+COUNTY_COLUMNS = 6
+COUNTY_ROWS = 10
+
+CATEGORIES = [
+    (0, "Oil and Gas Wells"),
+    (1, "Dairies"),
+    (2, "Landfills"),
+    (3, "Wastewater Treatment Plants"),
+    (4, "Natural Gas Storage Fields"),
+    (5, "Power Plants"),
+    (6, "Refineries"),
+    (7, "Compressor Stations"),
+    (8, "Processing Plants"),
+    (9, "Feedlots"),
+    (10, "Digesters"),
+    (11, "Composting Sites"),
+    (12, "Pipelines"),
+    (13, "Liquefied Natural Gas Facilities")
+]
+
+SECTORS = [
+    ("1B2 Oil and Natural Gas", "1B2a Oil", "1B2a2 Production"),
+    ("1B2 Oil and Natural Gas", "1B2b Natural Gas", "1B2b3 Processing"),
+    ("1B2 Oil and Natural Gas", "1B2b Natural Gas", "1B2b4 Transmission and Storage"),
+    ("3A Livestock", "3A1 Enteric Fermentation", "3A1a Cattle"),
+    ("3A Livestock", "3A2 Manure Management", "3A2a Cattle"),
+    ("4A Solid Waste Disposal", "4A1 Managed Waste Disposal Sites", "4A1a Anaerobic"),
+    ("4D Wastewater Treatment", "4D1 Domestic Wastewater", "4D1a Treatment Plants"),
+    ("1A1 Energy Industries", "1A1a Electricity Generation", "1A1a1 Gas Fired")
+]
+
+FIRST_FLIGHT = datetime(2016, 8, 1)
+FLIGHT_PERIOD_DAYS = 5 * 365
+
+
+def rows_for(table, scale):
+    return max(1, int(BASE_ROWS[table] * scale))
+
+
+def box_wkt(min_lon, min_lat, max_lon, max_lat):
+    return "POLYGON((%f %f,%f %f,%f %f,%f %f,%f %f))" % (min_lon, min_lat, max_lon, min_lat, max_lon, max_lat,
+                                                        min_lon, max_lat, min_lon, min_lat)
+
+
+def box_coordinates(min_lon, min_lat, max_lon, max_lat):
+    return [[[min_lon, min_lat], [max_lon, min_lat], [max_lon, max_lat], [min_lon, max_lat], [min_lon, min_lat]]]
+
+
+def random_point(rnd):
+    return rnd.uniform(MIN_LON, MAX_LON), rnd.uniform(MIN_LAT, MAX_LAT)
+
+
+def county_for(lon, lat):
+    col = min(COUNTY_COLUMNS - 1, int((lon - MIN_LON) / (MAX_LON - MIN_LON) * COUNTY_COLUMNS))
+    row = min(COUNTY_ROWS - 1, int((lat - MIN_LAT) / (MAX_LAT - MIN_LAT) * COUNTY_ROWS))
+    return row * COUNTY_COLUMNS + col + 1
+
+
+def make_counties():
+    width = (MAX_LON - MIN_LON) / COUNTY_COLUMNS
+    height = (MAX_LAT - MIN_LAT) / COUNTY_ROWS
+    counties = []
+    for row in range(COUNTY_ROWS):
+        for col in range(COUNTY_COLUMNS):
+            county_id = row * COUNTY_COLUMNS + col + 1
+            min_lon = MIN_LON + col * width
+            min_lat = MIN_LAT + row * height
+            name = "County %02d" % county_id
+            counties.append((county_id, name, name, width * height, 2 * (width + height), county_id, county_id,
+                             "D%d" % (county_id % 5), county_id,
+                             box_wkt(min_lon, min_lat, min_lon + width, min_lat + height)))
+    return counties
+
+
+def make_vista(rnd, count):
+    vista = []
+    metadata = []
+    for i in range(count):
+        internal_id = i + 1
+        lon, lat = random_point(rnd)
+        size = rnd.uniform(0.0005, 0.005)
+        category_id, category = rnd.choice(CATEGORIES)
+        sector = rnd.choice(SECTORS)
+        geojson = json.dumps({
+            "type": "Feature",
+            "geometry": {
+                "type": "Polygon",
+                "coordinates": box_coordinates(lon - size, lat - size, lon + size, lat + size)
+            }
+        })
+        vista.append((internal_id, "V%07d" % internal_id, "%s %d" % (category, internal_id), "Site %d" % internal_id,
+                      "Polygon", lat, lon, category, category_id, "Operator %d" % rnd.randint(1, 500),
+                      "%d Main St" % rnd.randint(1, 9999), "CA", sector[0], "City %d" % rnd.randint(1, 400),
+                      sector[0], sector[1], sector[2], box_wkt(lon - size, lat - size, lon + size, lat + size),
+                      geojson))
+        for property_name in ("Owner", "Status", "Capacity"):
+            metadata.append((internal_id, property_name, "%s %d" % (property_name, rnd.randint(1, 100))))
+    return vista, metadata
+
+
+def make_sources(rnd, count, vista):
+    sources = []
+    vista_sources = []
+    for i in range(count):
+        source_id = "P%06d" % (i + 1)
+        facility = rnd.choice(vista) if rnd.random() < 0.8 else None
+        if facility is not None:
+            lat = facility[5] + rnd.uniform(-0.005, 0.005)
+            lon = facility[6] + rnd.uniform(-0.005, 0.005)
+            sector = (facility[14], facility[15], facility[16])
+        else:
+            lon, lat = random_point(rnd)
+            sector = rnd.choice(SECTORS)
+        sources.append((source_id, lat, lon, "POINT(%f %f)" % (lon, lat), "Area %d" % rnd.randint(1, 50),
+                        rnd.choice(("Point", "Area")), facility[2] if facility is not None else None,
+                        rnd.choice(("Persistence", "Flux", "Manual")), sector[0], sector[1], sector[2],
+                        rnd.random(), rnd.random(), 0, rnd.uniform(10, 2000), rnd.uniform(1, 200),
+                        facility[1] if facility is not None else None))
+        if facility is not None:
+            vista_sources.append((facility[0], source_id, rnd.random() < 0.5, rnd.uniform(0, 500)))
+    return sources, vista_sources
+
+
+def make_flightlines(rnd, count):
+    flightlines = []
+    for i in range(count):
+        timestamp = FIRST_FLIGHT + timedelta(seconds=rnd.randint(0, FLIGHT_PERIOD_DAYS * 86400))
+        name = timestamp.strftime("ang%Y%m%dt%H%M%S")
+        lon, lat = random_point(rnd)
+        if rnd.random() < 0.5:
+            shape = box_wkt(lon, lat, lon + rnd.uniform(0.2, 1.0), lat + 0.05)
+        else:
+            shape = box_wkt(lon, lat, lon + 0.05, lat + rnd.uniform(0.2, 1.0))
+        flightlines.append((i + 1, name, timestamp, "{s3}/flightlines/%s.png" % name, shape))
+    return flightlines
+
+
+def make_plumes(rnd, count, overflights):
+    """
+    Plumes are detected on flights that passed over their source, and named after the flight
+    as the handlers expect (plume_id like flight_name || '%').
+    """
+    plumes = []
+    aviris_plumes = []
+    used = set()
+    if len(overflights) == 0:
+        return plumes, aviris_plumes
+
+    for i in range(count):
+        source_id, flight_name, flight_timestamp, vista_id, lat, lon = rnd.choice(overflights)
+        suffix = 0
+        while "%s-%s" % (flight_name, suffix) in used:
+            suffix += 1
+        candidate_id = "%s-%s" % (flight_name, suffix)
+        used.add(candidate_id)
+
+        plume_lat = lat + rnd.uniform(-0.001, 0.001)
+        plume_lon = lon + rnd.uniform(-0.001, 0.001)
+        flux = rnd.uniform(10, 2000)
+        plumes.append((candidate_id, candidate_id, source_id, vista_id, flight_timestamp, flux, flux * 0.3,
+                       rnd.uniform(100, 5000), plume_lat, plume_lon))
+
+        size = 0.001
+        url = "{s3}/plumes/%s" % candidate_id
+        aviris_plumes.append((i + 1, "%s-%d" % (source_id, i + 1), candidate_id, source_id,
+                              url + ".json", url + ".png", url + "_plume.png", url + "_rgb.png",
+                              url + "_thumb.png", url + "_plume_thumb.png", url + "_rgb_thumb.png",
+                              url + "_plume.tif", url + "_rgb.tif", flight_timestamp, rnd.uniform(0, 100),
+                              rnd.uniform(0, 500), rnd.uniform(0, 1000), rnd.uniform(0, 2000),
+                              "d%d" % i, "d%d" % i, "d%d" % i, rnd.uniform(0, 10), rnd.uniform(0, 20),
+                              rnd.uniform(0, 40),
+                              box_wkt(plume_lon - size, plume_lat - size, plume_lon + size, plume_lat + size)))
+    return plumes, aviris_plumes
+
+
+def make_field_boundaries(rnd, count):
+    fields = []
+    for i in range(count):
+        lon, lat = random_point(rnd)
+        size = rnd.uniform(0.01, 0.1)
+        shape = box_wkt(lon - size, lat - size, lon + size, lat + size)
+        fields.append((i + 1, "Field %d" % (i + 1), size * size * 4780, size * size * 3059200, size * 8 * 69,
+                       "District %d" % rnd.randint(1, 6), shape, shape))
+    return fields
+
+
+def insert(cur, table, columns, rows, geometry_columns=(), page_size=1000):
+    template = "(%s)" % ",".join("ST_GeomFromText(%s, 4326)" if c in geometry_columns else "%s" for c in columns)
+    execute_values(cur, "insert into %s (%s) values %%s" % (table, ",".join(columns)), rows,
+                   template=template, page_size=page_size)
+
+
+def load(conn, scale=1.0, seed=0):
+    rnd = random.Random(seed)
+    start = time.time()
+
+    with open(SCHEMA_FILE) as f:
+        schema = f.read()
+
+    cur = conn.cursor()
+    cur.execute(schema)
+
+    counties = make_counties()
+    insert(cur, "counties", ("county_id", "name", "coname", "area", "perimeter", "cacoa", "cacoa_id", "dsslv",
+                             "conum", "county_shape"), counties, geometry_columns=("county_shape",))
+
+    vista, metadata = make_vista(rnd, rows_for("vista", scale))
+    insert(cur, "vista", ("id", "vista_id", "name", "site_name", "shape_type", "latitude", "longitude", "category",
+                          "category_id", "operator", "address", "state", "sector", "city", "sector_level_1",
+                          "sector_level_2", "sector_level_3", "facility_envelope", "geojson"),
+           vista, geometry_columns=("facility_envelope",))
+    cur.execute("select setval('vista_id_seq', (select max(id) from vista));")
+    insert(cur, "vista_metadata", ("vista_id", "property_name", "property_value"), metadata)
+    insert(cur, "county_vista", ("county_id", "vista_id"), [(county_for(v[6], v[5]), v[0]) for v in vista])
+
+    sources, vista_sources = make_sources(rnd, rows_for("sources", scale), vista)
+    insert(cur, "sources", ("source_id", "source_latitude_deg", "source_longitude_deg", "source_location",
+                            "area_name", "source_type", "nearest_facility", "selection_criteria", "sector_level_1",
+                            "sector_level_2", "sector_level_3", "source_persistence", "confidence_in_persistence",
+                            "total_overflights", "q_source_final", "q_source_final_sigma", "vista_id"),
+           sources, geometry_columns=("source_location",))
+    insert(cur, "vista_sources", ("vista_id", "source_id", "facility_poly_contains_source", "distance"), vista_sources)
+    insert(cur, "county_sources", ("county_id", "source_id"), [(county_for(s[2], s[1]), s[0]) for s in sources])
+
+    insert(cur, "flightlines", ("flightline_id", "flight_name", "flight_timestamp", "image_url", "flightline_shape"),
+           make_flightlines(rnd, rows_for("flightlines", scale)), geometry_columns=("flightline_shape",))
+
+    # Overflights are derived from the geometry, as they are in production
+    cur.execute("""
+insert into vista_flightlines (vista_id, flightline_id)
+select v.id, f.flightline_id from vista as v, flightlines as f
+where ST_Intersects(v.facility_envelope, f.flightline_shape);
+
+insert into sources_flightlines (source_id, flightline_id)
+select s.source_id, f.flightline_id from sources as s, flightlines as f
+where ST_Intersects(s.source_location, f.flightline_shape);
+
+update sources as s set total_overflights = sf.overflights
+from (select source_id, count(1) as overflights from sources_flightlines group by source_id) as sf
+where sf.source_id = s.source_id;
+    """)
+
+    cur.execute("""
+select s.source_id, f.flight_name, f.flight_timestamp, s.vista_id, s.source_latitude_deg, s.source_longitude_deg
+from sources_flightlines as sf, sources as s, flightlines as f
+where sf.source_id = s.source_id and sf.flightline_id = f.flightline_id
+order by s.source_id, f.flightline_id;
+    """)
+    plumes, aviris_plumes = make_plumes(rnd, rows_for("plumes", scale), cur.fetchall())
+    insert(cur, "plumes", ("plume_id", "candidate_id", "source_id", "vista_id", "detection_timestamp", "flux",
+                           "flux_uncertainty", "ime20_1500ppmm_150m", "plume_latitude_deg", "plume_longitude_deg"),
+           plumes)
+    insert(cur, "aviris_plumes", ("plume_id", "aviris_plume_id", "candidate_id", "source_id", "json_url", "png_url",
+                                  "plume_url", "rgbqlctr_url", "png_url_thumb", "plume_url_thumb",
+                                  "rgbqlctr_url_thumb", "plume_tiff_url", "rgb_tiff_url", "data_date", "mergedist",
+                                  "ime_5", "ime_10", "ime_20", "detid5", "detid10", "detid20", "fetch5", "fetch10",
+                                  "fetch20", "plume_shape"),
+           aviris_plumes, geometry_columns=("plume_shape",))
+    cur.execute("""
+insert into vista_aviris_plumes (vista_id, plume_id)
+select v.id, ap.plume_id from aviris_plumes as ap, plumes as p, vista as v
+where p.candidate_id = ap.candidate_id and v.vista_id = p.vista_id;
+
+insert into vista_counts (vista_id, flyover_count, plume_count)
+select
+  v.id,
+  (select count(1) from vista_flightlines as vf where vf.vista_id = v.id),
+  (select count(1) from vista_aviris_plumes as vap where vap.vista_id = v.id)
+from vista as v;
+    """)
+
+    insert(cur, "field_boundaries", ("id", "feature_name", "area_sq_mi", "area_acre", "perimeter", "district",
+                                     "field_envelope", "field_shape"),
+           make_field_boundaries(rnd, rows_for("field_boundaries", scale)),
+           geometry_columns=("field_envelope", "field_shape"))
+    cur.execute("select setval('field_boundaries_id_seq', (select max(id) from field_boundaries));")
+
+    conn.commit()
+
+    # analyze cannot run inside a transaction block
+    conn.autocommit = True
+    cur.execute("analyze;")
+    conn.autocommit = False
+
+    counts = {}
+    for table in ("counties", "vista", "vista_sources", "sources", "flightlines", "vista_flightlines",
+                  "sources_flightlines", "plumes", "aviris_plumes", "vista_aviris_plumes"):
+        cur.execute("select count(1) from %s;" % table)
+        counts[table] = cur.fetchone()[0]
+    cur.close()
+
+    print("Loaded fixture at scale %s in %.1fs: %s" % (scale, time.time() - start,
+                                                       ", ".join("%s=%s" % item for item in sorted(counts.items()))))
+    return counts
+
+
+def sample_values(conn, limit=200, seed=0):
+    """
+    Identifiers from the loaded fixture used to build requests for single object endpoints.
+    """
+    cur = conn.cursor()
+    values = {}
+    queries = {
+        "vista_ids": "select vista_id from vista order by vista_id",
+        "flown_vista_ids": "select distinct v.vista_id from vista as v, vista_flightlines as vf where vf.vista_id = v.id order by v.vista_id",
+        "source_ids": "select source_id from sources order by source_id",
+        "plume_source_ids": "select distinct source_id from plumes order by source_id",
+        "counties": "select name from counties order by name",
+        "sectors": "select distinct sector_level_1 from vista order by sector_level_1"
+    }
+    rnd = random.Random(seed)
+    for name, sql in queries.items():
+        cur.execute(sql)
+        rows = [row[0] for row in cur.fetchall()]
+        values[name] = rnd.sample(rows, min(limit, len(rows)))
+    cur.close()
+    conn.rollback()
+    return values
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load the synthetic benchmark fixture")
+    parser.add_argument("--dsn", required=True, help="libpq connection string of the fixture database")
+    parser.add_argument("--scale", type=float, default=1.0, help="Scale factor for table sizes")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(args.dsn)
+    try:
+        load(conn, args.scale, args.seed)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,378 @@
+"""
+Copyright (c) 2021 Jet Propulsion Laboratory,
+California Institute of Technology.  All rights reserved
+
+Replays a weighted mix of API requests against a running msfbe server and reports latency
+percentiles and throughput per endpoint.
+
+By default the fixture database is started in a PostGIS container, loaded with the synthetic
+data set from fixtures.py and the server is started from this checkout:
+
+    python benchmarks/loadtest.py --docker --scale 1 --duration 60 --concurrency 16
+
+Use an existing database with --dsn (add --skip-load to keep its data), an existing server with
+--url, and --output to save the report as JSON for comparison between runs.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+import requests
+
+import fixtures
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+DOCKER_IMAGE = "postgis/postgis:13-3.1"
+DOCKER_PASSWORD = "msfbe_bench"
+DOCKER_DATABASE = "methane_bench"
+
+# California and a few of its oil fields, dairies and cities, at the zoom levels the UI uses
+REGIONS = [
+    (-124.4, 32.5, -114.1, 42.0),
+    (-119.9, 34.8, -118.6, 35.8),
+    (-119.5, 35.9, -119.0, 36.4),
+    (-118.7, 33.6, -117.6, 34.3),
+    (-122.6, 37.3, -121.7, 38.0)
+]
+
+
+def random_bbox(rnd):
+    min_lon, min_lat, max_lon, max_lat = rnd.choice(REGIONS)
+    width = (max_lon - min_lon) * rnd.uniform(0.2, 1.0)
+    height = (max_lat - min_lat) * rnd.uniform(0.2, 1.0)
+    lon = rnd.uniform(min_lon, max_lon - width)
+    lat = rnd.uniform(min_lat, max_lat - height)
+    return {
+        "minLon": "%.4f" % lon,
+        "minLat": "%.4f" % lat,
+        "maxLon": "%.4f" % (lon + width),
+        "maxLat": "%.4f" % (lat + height)
+    }
+
+
+def with_bbox(**params):
+    def build(rnd, values):
+        args = random_bbox(rnd)
+        args.update(params)
+        return args
+    return build
+
+
+def with_value(name, values_key, **params):
+    def build(rnd, values):
+        args = dict(params)
+        args[name] = rnd.choice(values[values_key])
+        return args
+    return build
+
+
+def with_params(**params):
+    def build(rnd, values):
+        return dict(params)
+    return build
+
+
+def optional_filters(rnd, values):
+    args = {}
+    if rnd.random() < 0.3:
+        args["county"] = rnd.choice(values["counties"])
+    if rnd.random() < 0.3:
+        args["sector_level_1"] = rnd.choice(values["sectors"])
+    return args
+
+
+# (name, weight, path, parameter builder)
+REQUEST_MIX = [
+    ("vista", 20, "/vista", with_bbox(maxObjects="1000")),
+    ("vista_single", 5, "/vista", with_value("vistaId", "vista_ids")),
+    ("vista_countonly", 3, "/vista", with_bbox(countonly="true")),
+    ("aviris_plumes", 10, "/aviris/plumes", with_bbox()),
+    ("aviris_flights", 8, "/aviris/flights", with_bbox(maxObjects="1000")),
+    ("sources", 8, "/sources", with_bbox(maxObjects="1000")),
+    ("counties", 3, "/counties", with_bbox()),
+    ("detection_by_sector", 4, "/detectionBySector", with_params()),
+    ("flyovers_of_plume_source", 6, "/flyoversOfPlumeSource", with_value("source", "plume_source_ids")),
+    ("flyovers_of_facility", 6, "/flyoversOfFacility", with_value("vista_id", "flown_vista_ids")),
+    ("emissions_by_source", 3, "/emissionsBySource", with_params()),
+    ("methane_plume_sources", 8, "/methanePlumeSources", optional_filters),
+    ("methane_plume_sources_summary", 6, "/methanePlumeSourcesSummary", optional_filters),
+    ("list_counties", 2, "/list/counties", with_params()),
+    ("list_sectors", 1, "/list/sectors", with_params()),
+    ("list_categories", 1, "/list/categories", with_params()),
+    ("plumes_date_range", 1, "/plumesDateRange", with_params())
+]
+
+
+def percentile(sorted_values, pct):
+    if len(sorted_values) == 0:
+        return None
+    index = int(round(pct / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+class Recorder(object):
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__samples = {}
+        self.__errors = {}
+        self.__bytes = {}
+
+    def record(self, name, seconds, ok, size):
+        with self.__lock:
+            if ok:
+                self.__samples.setdefault(name, []).append(seconds)
+                self.__bytes[name] = self.__bytes.get(name, 0) + size
+            else:
+                self.__errors[name] = self.__errors.get(name, 0) + 1
+
+    def report(self, elapsed):
+        with self.__lock:
+            names = sorted(set(self.__samples.keys()) | set(self.__errors.keys()))
+            all_samples = []
+            endpoints = {}
+            for name in names:
+                samples = sorted(self.__samples.get(name, []))
+                all_samples.extend(samples)
+                endpoints[name] = self.__summarize(samples, self.__errors.get(name, 0), self.__bytes.get(name, 0), elapsed)
+            total = self.__summarize(sorted(all_samples), sum(self.__errors.values()), sum(self.__bytes.values()), elapsed)
+        return {"elapsed_seconds": elapsed, "endpoints": endpoints, "total": total}
+
+    @staticmethod
+    def __summarize(samples, errors, size, elapsed):
+        def ms(value):
+            return round(value * 1000.0, 2) if value is not None else None
+
+        return {
+            "requests": len(samples),
+            "errors": errors,
+            "throughput_rps": round(len(samples) / elapsed, 2) if elapsed > 0 else None,
+            "p50_ms": ms(percentile(samples, 50)),
+            "p95_ms": ms(percentile(samples, 95)),
+            "p99_ms": ms(percentile(samples, 99)),
+            "max_ms": ms(samples[-1] if len(samples) > 0 else None),
+            "avg_bytes": int(size / len(samples)) if len(samples) > 0 else None
+        }
+
+
+def choose(rnd, mix, total_weight):
+    pick = rnd.uniform(0, total_weight)
+    for entry in mix:
+        pick -= entry[1]
+        if pick <= 0:
+            return entry
+    return mix[-1]
+
+
+def worker(base_url, mix, values, seed, deadline, warmup_until, recorder, timeout):
+    rnd = random.Random(seed)
+    session = requests.Session()
+    total_weight = sum(entry[1] for entry in mix)
+
+    while time.time() < deadline:
+        name, weight, path, build = choose(rnd, mix, total_weight)
+        params = build(rnd, values)
+        start = time.time()
+        try:
+            response = session.get(base_url + path, params=params, timeout=timeout)
+            ok = response.status_code < 400
+            size = len(response.content)
+        except requests.RequestException:
+            ok = False
+            size = 0
+        if start >= warmup_until:
+            recorder.record(name, time.time() - start, ok, size)
+
+
+def run_load(base_url, mix, values, concurrency, duration, warmup, seed, timeout):
+    recorder = Recorder()
+    start = time.time()
+    warmup_until = start + warmup
+    deadline = warmup_until + duration
+    threads = []
+    for i in range(concurrency):
+        thread = threading.Thread(target=worker, args=(base_url, mix, values, seed + i, deadline, warmup_until,
+                                                       recorder, timeout))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return recorder.report(time.time() - warmup_until)
+
+
+def print_report(report):
+    header = "%-32s %8s %7s %9s %9s %9s %9s %10s" % ("endpoint", "requests", "errors", "req/s", "p50 ms",
+                                                     "p95 ms", "p99 ms", "avg bytes")
+    print(header)
+    print("-" * len(header))
+    rows = sorted(report["endpoints"].items()) + [("TOTAL", report["total"])]
+    for name, stats in rows:
+        print("%-32s %8s %7s %9s %9s %9s %9s %10s" % (name, stats["requests"], stats["errors"], stats["throughput_rps"],
+                                                      stats["p50_ms"], stats["p95_ms"], stats["p99_ms"],
+                                                      stats["avg_bytes"]))
+
+
+def start_docker(image, port):
+    name = "msfbe-bench-%s" % os.getpid()
+    subprocess.check_call(["docker", "run", "-d", "--rm", "--name", name,
+                           "-e", "POSTGRES_PASSWORD=%s" % DOCKER_PASSWORD,
+                           "-e", "POSTGRES_DB=%s" % DOCKER_DATABASE,
+                           "-p", "127.0.0.1:%s:5432" % port, image])
+    dsn = "host=127.0.0.1 port=%s dbname=%s user=postgres password=%s" % (port, DOCKER_DATABASE, DOCKER_PASSWORD)
+    return name, dsn
+
+
+def stop_docker(name):
+    subprocess.call(["docker", "stop", name])
+
+
+def wait_for_database(dsn, timeout=120):
+    # The PostGIS image restarts the server once after initializing, so wait until a query
+    # succeeds on two consecutive attempts.
+    deadline = time.time() + timeout
+    successes = 0
+    while True:
+        try:
+            conn = psycopg2.connect(dsn)
+            cur = conn.cursor()
+            cur.execute("select 1;")
+            conn.close()
+            successes += 1
+            if successes >= 2:
+                return
+        except psycopg2.Error:
+            successes = 0
+            if time.time() > deadline:
+                raise
+        time.sleep(1)
+
+
+def start_server(python, dsn, port, subprocesses):
+    dsn_params = psycopg2.extensions.parse_dsn(dsn)
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.path.join(REPO_DIR, "src")
+    env["PG_USER"] = dsn_params.get("user", "")
+    env["PG_PWD"] = dsn_params.get("password", "")
+    cmd = [python, "-m", "msfbe.main",
+           "--address=127.0.0.1",
+           "--port=%s" % port,
+           "--pgendpoint=%s" % dsn_params.get("host", "localhost"),
+           "--pgport=%s" % dsn_params.get("port", "5432"),
+           "--pgdatabase=%s" % dsn_params.get("dbname", DOCKER_DATABASE),
+           "--subprocesses=%s" % subprocesses]
+    return subprocess.Popen(cmd, cwd=REPO_DIR, env=env)
+
+
+def wait_for_server(base_url, process=None, timeout=60):
+    # Any registered handler will do; /sources is always registered and needs the database too
+    deadline = time.time() + timeout
+    while True:
+        if process is not None and process.poll() is not None:
+            raise Exception("Server exited with status %s" % process.returncode)
+        try:
+            if requests.get(base_url + "/sources", params={"maxObjects": "1"}, timeout=5).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        if time.time() > deadline:
+            raise Exception("Server did not start within %s seconds" % timeout)
+        time.sleep(0.5)
+
+
+def stop_server(process):
+    if process.poll() is None:
+        process.send_signal(signal.SIGTERM)
+        process.wait()
+
+
+def select_mix(names):
+    if names is None:
+        return REQUEST_MIX
+    names = set(names.split(","))
+    mix = [entry for entry in REQUEST_MIX if entry[0] in names]
+    if len(mix) == 0:
+        raise Exception("No requests in the mix match %s" % ", ".join(sorted(names)))
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test msfbe against a synthetic PostGIS fixture")
+    database = parser.add_mutually_exclusive_group(required=True)
+    database.add_argument("--dsn", help="libpq connection string of the fixture database")
+    database.add_argument("--docker", action="store_true", help="Start a PostGIS container for the fixture")
+    parser.add_argument("--docker-image", default=DOCKER_IMAGE)
+    parser.add_argument("--docker-port", type=int, default=54329)
+    parser.add_argument("--scale", type=float, default=1.0, help="Fixture scale factor")
+    parser.add_argument("--skip-load", action="store_true", help="Use the data already in the database")
+    parser.add_argument("--url", help="Base URL of a running server; otherwise one is started from this checkout")
+    parser.add_argument("--python", default=sys.executable, help="Interpreter used to start the server")
+    parser.add_argument("--port", type=int, default=9190, help="Port of the server started by the benchmark")
+    parser.add_argument("--subprocesses", type=int, default=1, help="Server subprocesses (0 for one per CPU)")
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent clients")
+    parser.add_argument("--duration", type=float, default=60, help="Measured seconds")
+    parser.add_argument("--warmup", type=float, default=10, help="Seconds of load before measuring")
+    parser.add_argument("--timeout", type=float, default=60, help="Request timeout in seconds")
+    parser.add_argument("--mix", help="Comma separated request names to run instead of the full mix")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the report as JSON to this file")
+    args = parser.parse_args()
+
+    container = None
+    server = None
+    try:
+        dsn = args.dsn
+        if args.docker:
+            container, dsn = start_docker(args.docker_image, args.docker_port)
+        wait_for_database(dsn)
+
+        conn = psycopg2.connect(dsn)
+        try:
+            if not args.skip_load:
+                fixtures.load(conn, args.scale, args.seed)
+            values = fixtures.sample_values(conn, seed=args.seed)
+        finally:
+            conn.close()
+
+        base_url = args.url
+        if base_url is None:
+            server = start_server(args.python, dsn, args.port, args.subprocesses)
+            base_url = "http://127.0.0.1:%s" % args.port
+        wait_for_server(base_url.rstrip("/"), server)
+
+        mix = select_mix(args.mix)
+        print("Running %s clients for %ss (after %ss warmup) against %s" % (args.concurrency, args.duration,
+                                                                         args.warmup, base_url))
+        report = run_load(base_url.rstrip("/"), mix, values, args.concurrency, args.duration, args.warmup,
+                          args.seed, args.timeout)
+        report["config"] = {
+            "scale": args.scale,
+            "concurrency": args.concurrency,
+            "subprocesses": args.subprocesses,
+            "mix": [entry[0] for entry in mix]
+        }
+        print_report(report)
+
+        if args.output is not None:
+            with open(args.output, "w") as f:
+                json.dump(report, f, indent=4, sort_keys=True)
+    finally:
+        if server is not None:
+            stop_server(server)
+        if container is not None:
+            stop_docker(container)
+
+
+if __name__ == "__main__":
+    main()
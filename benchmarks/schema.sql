@@ -0,0 +1,193 @@
+-- Copyright (c) 2021 Jet Propulsion Laboratory,
+-- California Institute of Technology.  All rights reserved
+--
+-- Synthetic schema for the benchmark fixture. Only the tables and columns queried by the
+-- handlers are included; types follow how the handlers bind and join them.
+
+create extension if not exists postgis;
+
+drop table if exists vista_counts, vista_counts_dirty, vista_metadata, vista_sources, vista_flightlines,
+    vista_aviris_plumes, county_vista, county_sources, sources_flightlines, aviris_plumes, plumes, flightlines,
+    sources, vista, counties, field_boundaries cascade;
+
+create table counties (
+    county_id integer primary key,
+    name text not null,
+    coname text not null,
+    area double precision,
+    perimeter double precision,
+    cacoa integer,
+    cacoa_id integer,
+    dsslv text,
+    conum integer,
+    county_shape geometry(Polygon, 4326) not null
+);
+
+create table vista (
+    id serial primary key,
+    vista_id text not null unique,
+    name text,
+    site_name text,
+    shape_type text,
+    latitude double precision,
+    longitude double precision,
+    category text,
+    category_id integer,
+    operator text,
+    address text,
+    state text,
+    sector text,
+    city text,
+    sector_level_1 text,
+    sector_level_2 text,
+    sector_level_3 text,
+    facility_envelope geometry(Polygon, 4326) not null,
+    geojson text
+);
+
+create table vista_metadata (
+    vista_id integer not null references vista (id),
+    property_name text not null,
+    property_value text
+);
+
+create table sources (
+    source_id text primary key,
+    source_latitude_deg double precision,
+    source_longitude_deg double precision,
+    source_location geometry(Point, 4326) not null,
+    area_name text,
+    source_type text,
+    nearest_facility text,
+    selection_criteria text,
+    sector_level_1 text,
+    sector_level_2 text,
+    sector_level_3 text,
+    source_persistence double precision,
+    confidence_in_persistence double precision,
+    total_overflights integer,
+    q_source_final double precision,
+    q_source_final_sigma double precision,
+    vista_id text
+);
+
+create table vista_sources (
+    vista_id integer not null references vista (id),
+    source_id text not null references sources (source_id),
+    facility_poly_contains_source boolean,
+    distance double precision
+);
+
+create table flightlines (
+    flightline_id integer primary key,
+    flight_name text not null,
+    flight_timestamp timestamp not null,
+    image_url text,
+    flightline_shape geometry(Polygon, 4326) not null
+);
+
+create table vista_flightlines (
+    vista_id integer not null references vista (id),
+    flightline_id integer not null references flightlines (flightline_id)
+);
+
+create table sources_flightlines (
+    source_id text not null references sources (source_id),
+    flightline_id integer not null references flightlines (flightline_id)
+);
+
+create table plumes (
+    plume_id text primary key,
+    candidate_id text not null,
+    source_id text references sources (source_id),
+    vista_id text,
+    detection_timestamp timestamp not null,
+    flux double precision,
+    flux_uncertainty double precision,
+    ime20_1500ppmm_150m double precision,
+    plume_latitude_deg double precision,
+    plume_longitude_deg double precision
+);
+
+create table aviris_plumes (
+    plume_id integer primary key,
+    aviris_plume_id text,
+    candidate_id text,
+    source_id text,
+    json_url text,
+    png_url text,
+    plume_url text,
+    rgbqlctr_url text,
+    png_url_thumb text,
+    plume_url_thumb text,
+    rgbqlctr_url_thumb text,
+    plume_tiff_url text,
+    rgb_tiff_url text,
+    data_date timestamp,
+    mergedist double precision,
+    ime_5 double precision,
+    ime_10 double precision,
+    ime_20 double precision,
+    detid5 text,
+    detid10 text,
+    detid20 text,
+    fetch5 double precision,
+    fetch10 double precision,
+    fetch20 double precision,
+    plume_shape geometry(Polygon, 4326) not null
+);
+
+create table vista_aviris_plumes (
+    vista_id integer not null references vista (id),
+    plume_id integer not null references aviris_plumes (plume_id)
+);
+
+-- Maintained by msfbe.maintenance; the fixture fills it directly and leaves out the triggers
+create table vista_counts (
+    vista_id integer primary key references vista (id) on delete cascade,
+    flyover_count integer not null,
+    plume_count integer not null
+);
+
+create table county_vista (
+    county_id integer not null references counties (county_id),
+    vista_id integer not null references vista (id)
+);
+
+create table county_sources (
+    county_id integer not null references counties (county_id),
+    source_id text not null references sources (source_id)
+);
+
+create table field_boundaries (
+    id serial primary key,
+    feature_name text,
+    area_sq_mi double precision,
+    area_acre double precision,
+    perimeter double precision,
+    district text,
+    field_envelope geometry(Polygon, 4326) not null,
+    field_shape geometry(Polygon, 4326) not null
+);
+
+create index counties_shape_idx on counties using gist (county_shape);
+create index vista_envelope_idx on vista using gist (facility_envelope);
+create index vista_category_idx on vista (category_id);
+create index vista_metadata_vista_idx on vista_metadata (vista_id);
+create index sources_location_idx on sources using gist (source_location);
+create index sources_vista_idx on sources (vista_id);
+create index vista_sources_vista_idx on vista_sources (vista_id);
+create index vista_sources_source_idx on vista_sources (source_id);
+create index flightlines_shape_idx on flightlines using gist (flightline_shape);
+create index flightlines_timestamp_idx on flightlines (flight_timestamp);
+create index vista_flightlines_vista_idx on vista_flightlines (vista_id);
+create index sources_flightlines_source_idx on sources_flightlines (source_id);
+create index plumes_candidate_idx on plumes (candidate_id);
+create index plumes_source_idx on plumes (source_id);
+create index plumes_vista_idx on plumes (vista_id);
+create index aviris_plumes_shape_idx on aviris_plumes using gist (plume_shape);
+create index aviris_plumes_candidate_idx on aviris_plumes (candidate_id);
+create index vista_aviris_plumes_vista_idx on vista_aviris_plumes (vista_id);
+create index county_vista_county_idx on county_vista (county_id);
+create index county_sources_county_idx on county_sources (county_id);
+create index field_boundaries_envelope_idx on field_boundaries using gist (field_envelope);
@@ -17,7 +17,7 @@ setuptools.setup(
     install_requires=[
         'tornado', 'numpy', 'singledispatch', 'pytz', 'requests==2.25.0',
         'utm', 'shapely==1.7.1', 'mock', 'backports.functools-lru-cache==1.3',
-        'boto3==1.14.18', 'pillow==5.0.0', 'psycopg2==2.8.6', 'six', 'psutil'
+        'boto3==1.14.18', 'pillow==5.0.0', 'psycopg2==2.8.6', 'six', 'psutil', 'futures', 'simplejson'
     ],
     classifiers=[
         'Development Status :: 1 - Pre-Alpha',
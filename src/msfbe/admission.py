@@ -0,0 +1,133 @@
+"""
+Copyright (c) 2021 Jet Propulsion Laboratory,
+California Institute of Technology.  All rights reserved
+
+Per-handler admission control. Defaults are read from [admission] and can be overridden per
+handler in a section named after its path, e.g.
+
+    [admission:/emissionsBySource]
+    admission.max_concurrent=4
+    admission.max_queue=16
+    admission.statement_timeout=60000
+
+At most max_concurrent requests run the handler at once (0 is unlimited), up to max_queue more
+wait for up to queue_timeout seconds, and anything beyond that is rejected with a 503 and a
+Retry-After header. Limits apply per server process. statement_timeout (milliseconds, 0 for
+none) is applied to the handler's database transactions.
+"""
+
+import collections
+import os
+from datetime import timedelta
+from tornado import gen
+from tornado.concurrent import Future
+from msfbe.webmodel import ProcessingException
+import msfbe.metrics as metrics
+
+SECTION = "admission"
+
+ADMISSION_REJECTED = metrics.counter("msfbe_admission_rejected_total",
+                                     "Requests rejected because the handler's queue was full or the wait timed out",
+                                     labelnames=("path",))
+ADMISSION_ACTIVE = metrics.gauge("msfbe_admission_active",
+                                 "Requests running a handler, summed over all processes",
+                                 labelnames=("path",))
+ADMISSION_QUEUED = metrics.gauge("msfbe_admission_queued",
+                                 "Requests waiting to run a handler, summed over all processes",
+                                 labelnames=("path",))
+
+
+def _get_option(webconfig, path, option, default):
+    section = "%s:%s" % (SECTION, path)
+    if webconfig.has_section(section) and webconfig.has_option(section, option):
+        return webconfig.get(section, option)
+    if webconfig.has_option(SECTION, option):
+        return webconfig.get(SECTION, option)
+    return default
+
+
+def statement_timeout(webconfig, path):
+    timeout = int(_get_option(webconfig, path, "admission.statement_timeout", 0))
+    return timeout if timeout > 0 else None
+
+
+def register_paths(paths):
+    for path in paths:
+        ADMISSION_REJECTED.labels(path)
+        ADMISSION_ACTIVE.labels(path)
+        ADMISSION_QUEUED.labels(path)
+
+
+class AdmissionGate(object):
+    """
+    Limits the concurrency of one handler. Only used from the IOLoop thread.
+    """
+
+    def __init__(self, path, max_concurrent, max_queue, queue_timeout, retry_after):
+        self.__path = path
+        self.__max_concurrent = max_concurrent
+        self.__max_queue = max_queue
+        self.__queue_timeout = queue_timeout
+        self.__retry_after = retry_after
+        self.__active = 0
+        self.__waiters = collections.deque()
+
+    def __reject(self, reason):
+        ADMISSION_REJECTED.labels(self.__path).inc()
+        raise ProcessingException(reason=reason, code=503, headers={"Retry-After": str(self.__retry_after)})
+
+    @gen.coroutine
+    def acquire(self):
+        if self.__max_concurrent <= 0 or self.__active < self.__max_concurrent:
+            self.__active += 1
+            ADMISSION_ACTIVE.labels(self.__path).inc()
+            return
+
+        if len(self.__waiters) >= self.__max_queue:
+            self.__reject("Too many requests for %s, try again later" % self.__path)
+
+        waiter = Future()
+        self.__waiters.append(waiter)
+        ADMISSION_QUEUED.labels(self.__path).inc()
+        try:
+            if self.__queue_timeout > 0:
+                yield gen.with_timeout(timedelta(seconds=self.__queue_timeout), waiter)
+            else:
+                yield waiter
+        except gen.TimeoutError:
+            # The slot may have been handed over just as the wait timed out
+            if not waiter.done():
+                self.__waiters.remove(waiter)
+                self.__reject("Timed out waiting to process %s, try again later" % self.__path)
+        finally:
+            ADMISSION_QUEUED.labels(self.__path).dec()
+
+    def release(self):
+        # Hand the slot to the next waiter rather than freeing it, so that new arrivals cannot
+        # overtake the queue
+        if len(self.__waiters) > 0:
+            self.__waiters.popleft().set_result(None)
+            return
+        self.__active -= 1
+        ADMISSION_ACTIVE.labels(self.__path).dec()
+
+
+_gates = {}
+_gates_pid = None
+
+
+def get_gate(webconfig, path):
+    global _gates, _gates_pid
+    if _gates_pid != os.getpid():
+        _gates = {}
+        _gates_pid = os.getpid()
+
+    gate = _gates.get(path)
+    if gate is None:
+        gate = AdmissionGate(path,
+                             max_concurrent=int(_get_option(webconfig, path, "admission.max_concurrent", 0)),
+                             max_queue=int(_get_option(webconfig, path, "admission.max_queue", 0)),
+                             queue_timeout=float(_get_option(webconfig, path, "admission.queue_timeout", 30)),
+                             retry_after=int(_get_option(webconfig, path, "admission.retry_after", 5)))
+        _gates[path] = gate
+    return gate
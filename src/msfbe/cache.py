@@ -0,0 +1,193 @@
+"""
+Copyright (c) 2021 Jet Propulsion Laboratory,
+California Institute of Technology.  All rights reserved
+"""
+
+import hashlib
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from collections import OrderedDict
+import msfbe.metrics as metrics
+import msfbe.tiles as tiles
+
+# Query arguments that never change a response (e.g. jQuery's cache buster)
+IGNORED_ARGUMENTS = ("_",)
+
+# Incremented to flush every worker's cache. Allocated at import so it lives in memory shared
+# by the subprocesses forked from the main process.
+_flush_generation = multiprocessing.Value('l', 0)
+
+CACHE_HITS = metrics.counter("msfbe_cache_hits_total", "Response cache hits")
+CACHE_MISSES = metrics.counter("msfbe_cache_misses_total", "Response cache misses")
+CACHE_EVICTIONS = metrics.counter("msfbe_cache_evictions_total", "Response cache entries evicted to stay within bounds")
+
+
+def _get_option(webconfig, option, default):
+    if webconfig.has_option("cache", option):
+        return webconfig.get("cache", option)
+    return default
+
+
+def cache_key(path, request):
+    return (path, request.get_path_args(), request.get_normalized_arguments(ignore=IGNORED_ARGUMENTS))
+
+
+def compute_etag(body):
+    if isinstance(body, unicode):
+        body = body.encode("utf-8")
+    return '"%s"' % hashlib.sha1(body).hexdigest()
+
+
+class CacheEntry(object):
+    def __init__(self, body, content_type, ttl, etag=None):
+        self.body = body
+        self.content_type = content_type
+        self.created = time.time()
+        self.expires = self.created + ttl
+        self.size = len(body)
+        self.etag = etag if etag is not None else compute_etag(body)
+
+    def is_expired(self, now=None):
+        return (now if now is not None else time.time()) >= self.expires
+
+
+class ResultCache(object):
+    """
+    LRU cache of serialized handler responses bounded by both entry count and total body size.
+    Each entry carries the TTL of the handler that produced it.
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=64 * 1024 * 1024):
+        self.__max_entries = max_entries
+        self.__max_bytes = max_bytes
+        self.__entries = OrderedDict()
+        self.__bytes = 0
+        self.__lock = threading.Lock()
+        self.__pid = os.getpid()
+        self.__generation = _flush_generation.value
+
+        self.__hits = 0
+        self.__misses = 0
+        self.__evictions = 0
+
+    def pid(self):
+        return self.__pid
+
+    def __remove(self, key):
+        entry = self.__entries.pop(key)
+        self.__bytes -= entry.size
+        return entry
+
+    def __clear(self):
+        self.__entries = OrderedDict()
+        self.__bytes = 0
+
+    def __check_generation(self):
+        generation = _flush_generation.value
+        if generation != self.__generation:
+            self.__clear()
+            self.__generation = generation
+
+    def get(self, key):
+        with self.__lock:
+            self.__check_generation()
+            entry = self.__entries.get(key)
+            if entry is not None and entry.is_expired():
+                self.__remove(key)
+                entry = None
+
+            if entry is None:
+                self.__misses += 1
+                CACHE_MISSES.inc()
+                return None
+
+            # Re-insert to mark as most recently used
+            self.__remove(key)
+            self.__entries[key] = entry
+            self.__bytes += entry.size
+            self.__hits += 1
+            CACHE_HITS.inc()
+            return entry
+
+    def put(self, key, body, content_type, ttl, etag=None):
+        entry = CacheEntry(body, content_type, ttl, etag)
+        if entry.size > self.__max_bytes:
+            return None
+
+        with self.__lock:
+            self.__check_generation()
+            if key in self.__entries:
+                self.__remove(key)
+            self.__entries[key] = entry
+            self.__bytes += entry.size
+
+            while len(self.__entries) > self.__max_entries or self.__bytes > self.__max_bytes:
+                self.__remove(next(iter(self.__entries)))
+                self.__evictions += 1
+                CACHE_EVICTIONS.inc()
+        return entry
+
+    def flush(self):
+        with self.__lock:
+            count = len(self.__entries)
+            self.__clear()
+            return count
+
+    def stats(self):
+        with self.__lock:
+            return {
+                "pid": self.__pid,
+                "entries": len(self.__entries),
+                "bytes": self.__bytes,
+                "max_entries": self.__max_entries,
+                "max_bytes": self.__max_bytes,
+                "hits": self.__hits,
+                "misses": self.__misses,
+                "evictions": self.__evictions
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def is_enabled(webconfig):
+    return _get_option(webconfig, "cache.enabled", "false") == "true"
+
+
+def get_cache(webconfig):
+    global _cache
+    with _cache_lock:
+        if _cache is None or _cache.pid() != os.getpid():
+            _cache = ResultCache(max_entries=int(_get_option(webconfig, "cache.max_entries", 1000)),
+                                 max_bytes=int(_get_option(webconfig, "cache.max_bytes", 64 * 1024 * 1024)))
+        return _cache
+
+
+def flush_all(webconfig=None):
+    """
+    Flushes the cache in every worker process, and with 'webconfig' the tile cache as well.
+    Other workers drop their entries on their next lookup; the calling process is flushed
+    immediately.
+    """
+    if webconfig is not None:
+        tiles.flush_cache(webconfig)
+
+    with _flush_generation.get_lock():
+        _flush_generation.value += 1
+    logging.getLogger(__name__).info("Flushing response cache (generation %s)" % _flush_generation.value)
+
+    cache = _cache
+    if cache is not None and cache.pid() == os.getpid():
+        return cache.flush()
+    return 0
+
+
+def cache_stats():
+    cache = _cache
+    if cache is None or cache.pid() != os.getpid():
+        return None
+    return cache.stats()
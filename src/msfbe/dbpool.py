@@ -0,0 +1,472 @@
+"""
+Copyright (c) 2021 Jet Propulsion Laboratory,
+California Institute of Technology.  All rights reserved
+"""
+
+import collections
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+import psycopg2
+import psycopg2.extensions
+from msfbe.webmodel import ProcessingException, RequestCancelled
+import msfbe.metrics as metrics
+import msfbe.reqcontext as reqcontext
+
+CHECKOUT_SECONDS = metrics.histogram("msfbe_db_pool_checkout_seconds",
+                                     "Time spent waiting for a pooled database connection")
+CHECKOUT_TIMEOUTS = metrics.counter("msfbe_db_pool_checkout_timeouts_total",
+                                    "Connection checkouts that timed out")
+CONNECTIONS_IN_USE = metrics.gauge("msfbe_db_pool_connections_in_use",
+                                   "Database connections checked out, summed over all processes")
+CONNECTIONS_DISCARDED = metrics.counter("msfbe_db_pool_connections_discarded_total",
+                                        "Database connections closed after an error")
+STATEMENTS_PREPARED = metrics.counter("msfbe_db_statements_prepared_total",
+                                      "Statements prepared on a pooled connection")
+STATEMENTS_DEALLOCATED = metrics.counter("msfbe_db_statements_deallocated_total",
+                                         "Prepared statements dropped to stay within db.prepared_statements.max_per_connection")
+STATEMENTS_UNPREPARABLE = metrics.counter("msfbe_db_statements_unpreparable_total",
+                                          "Statements that failed to prepare and are executed without preparing")
+PREPARE_SECONDS = metrics.histogram("msfbe_db_prepare_seconds",
+                                    "Time spent preparing statements, which is saved on every later execution")
+
+
+def _get_option(webconfig, option, default):
+    if webconfig.has_option("database", option):
+        return webconfig.get("database", option)
+    return default
+
+
+_PLACEHOLDER = re.compile(r"%\((\w+)\)s|%s|%%")
+_PREPARABLE = re.compile(r"^\s*(select|with|insert|update|delete|values)\b", re.IGNORECASE)
+
+# Names of statements that could not be prepared, e.g. because Postgres cannot infer the type of
+# one of their parameters
+_unpreparable = set()
+
+
+def to_prepared(query, vars):
+    """
+    Converts a statement with psycopg2 placeholders into one with $n parameters for PREPARE.
+    Returns (sql, values) where values are the arguments for EXECUTE in order, or None if the
+    statement cannot be prepared.
+    """
+    if not _PREPARABLE.match(query):
+        return None
+    if vars is None:
+        return query, []
+
+    values = []
+    named = {}
+
+    def replace(match):
+        if match.group(0) == "%%":
+            return "%"
+        if match.group(1) is None:
+            values.append(vars[len(values)])
+            return "$%d" % len(values)
+        name = match.group(1)
+        if name not in named:
+            values.append(vars[name])
+            named[name] = len(values)
+        return "$%d" % named[name]
+
+    sql = _PLACEHOLDER.sub(replace, query)
+    # Tuples are adapted to a parenthesized list for IN, which is not a valid parameter value
+    if any(isinstance(value, tuple) for value in values):
+        return None
+    return sql, values
+
+
+class PreparingConnection(psycopg2.extensions.connection):
+    """
+    Connection that remembers the statements prepared on it, most recently used last.
+    max_prepared is set by the pool; 0 disables prepared statements.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(PreparingConnection, self).__init__(*args, **kwargs)
+        self.prepared = collections.OrderedDict()
+        self.max_prepared = 0
+
+
+class TimedCursor(psycopg2.extensions.cursor):
+    """
+    Cursor that records the time spent executing statements and fetching rows against the
+    active request context, if any. On a PreparingConnection, statements are prepared on first
+    use and run with EXECUTE afterwards, so that Postgres does not parse and plan them again.
+    """
+
+    def __prepare(self, name, sql):
+        # A statement that fails to prepare would abort the request's transaction
+        start = time.time()
+        super(TimedCursor, self).execute("savepoint msfbe_prepare;")
+        try:
+            super(TimedCursor, self).execute("prepare %s as %s" % (name, sql))
+        except psycopg2.ProgrammingError:
+            super(TimedCursor, self).execute("rollback to savepoint msfbe_prepare;")
+            _unpreparable.add(name)
+            STATEMENTS_UNPREPARABLE.inc()
+            logging.getLogger(__name__).warning("Unable to prepare statement, executing it directly", exc_info=True)
+            return False
+        super(TimedCursor, self).execute("release savepoint msfbe_prepare;")
+        PREPARE_SECONDS.observe(time.time() - start)
+        STATEMENTS_PREPARED.inc()
+
+        conn = self.connection
+        conn.prepared[name] = True
+        while len(conn.prepared) > conn.max_prepared:
+            oldest, unused = conn.prepared.popitem(last=False)
+            super(TimedCursor, self).execute("deallocate %s;" % oldest)
+            STATEMENTS_DEALLOCATED.inc()
+        return True
+
+    def __execute_prepared(self, query, vars):
+        """
+        Executes the statement as a prepared statement if possible. Returns False if it was not
+        executed.
+        """
+        conn = self.connection
+        if self.name is not None or getattr(conn, "max_prepared", 0) <= 0:
+            return False
+        prepared = to_prepared(query, vars)
+        if prepared is None:
+            return False
+
+        sql, values = prepared
+        name = "msfbe_%s" % hashlib.sha1(sql.encode("utf-8") if isinstance(sql, unicode) else sql).hexdigest()[:20]
+        if name in _unpreparable:
+            return False
+        if name in conn.prepared:
+            conn.prepared[name] = conn.prepared.pop(name)
+        elif not self.__prepare(name, sql):
+            return False
+
+        if len(values) == 0:
+            super(TimedCursor, self).execute("execute %s;" % name)
+        else:
+            super(TimedCursor, self).execute("execute %s (%s);" % (name, ", ".join(["%s"] * len(values))), values)
+        return True
+
+    def execute(self, query, vars=None):
+        reqcontext.check_cancelled()
+        start = time.time()
+        prepared = False
+        try:
+            with reqcontext.timed("db_execute"):
+                prepared = self.__execute_prepared(query, vars)
+                if not prepared:
+                    return super(TimedCursor, self).execute(query, vars)
+        finally:
+            context = reqcontext.current()
+            if context is not None:
+                metrics.DB_EXECUTE_SECONDS.labels(context.path, "true" if prepared else "false").observe(time.time() - start)
+
+    def fetchone(self):
+        with reqcontext.timed("db_fetch"):
+            return super(TimedCursor, self).fetchone()
+
+    def fetchmany(self, size=None):
+        with reqcontext.timed("db_fetch"):
+            if size is None:
+                return super(TimedCursor, self).fetchmany()
+            return super(TimedCursor, self).fetchmany(size)
+
+    def fetchall(self):
+        with reqcontext.timed("db_fetch"):
+            return super(TimedCursor, self).fetchall()
+
+    def __iter__(self):
+        # Fetch in batches of itersize (as psycopg2 does for named cursors) so that iterating
+        # is timed per batch rather than per row.
+        while True:
+            reqcontext.check_cancelled()
+            rows = self.fetchmany(self.itersize)
+            if len(rows) == 0:
+                return
+            for row in rows:
+                yield row
+
+
+class ConnectionPool(object):
+    """
+    Thread-safe pool of psycopg2 connections. Connections are health checked on checkout when
+    they have been idle longer than the health check interval, idle connections above the
+    minimum pool size are closed after the idle timeout, and callers block for up to the
+    checkout timeout when every connection is in use.
+    """
+
+    def __init__(self, webconfig):
+        self.__log = logging.getLogger(__name__)
+        self.__connect_args = dict(dbname=webconfig.get("database", "db.database"),
+                                   user=webconfig.get("database", "db.username"),
+                                   password=webconfig.get("database", "db.password"),
+                                   host=webconfig.get("database", "db.endpoint"),
+                                   port=webconfig.get("database", "db.port"))
+        self.__min_size = int(_get_option(webconfig, "db.pool.min_size", 1))
+        self.__max_size = int(_get_option(webconfig, "db.pool.max_size", 10))
+        self.__idle_timeout = float(_get_option(webconfig, "db.pool.idle_timeout", 300))
+        self.__checkout_timeout = float(_get_option(webconfig, "db.pool.checkout_timeout", 30))
+        self.__health_check_interval = float(_get_option(webconfig, "db.pool.health_check_interval", 30))
+        self.__max_prepared = 0
+        if _get_option(webconfig, "db.prepared_statements", "true") == "true":
+            self.__max_prepared = int(_get_option(webconfig, "db.prepared_statements.max_per_connection", 200))
+
+        self.__pid = os.getpid()
+        self.__cond = threading.Condition()
+        self.__idle = []
+        self.__size = 0
+        self.__in_use = 0
+        self.__waiting = 0
+
+        self.__checkouts = 0
+        self.__checkout_timeouts = 0
+        self.__checkout_seconds_total = 0.0
+        self.__checkout_seconds_max = 0.0
+        self.__discarded = 0
+
+    def pid(self):
+        return self.__pid
+
+    def __connect(self):
+        conn = psycopg2.connect(connection_factory=PreparingConnection, **self.__connect_args)
+        conn.max_prepared = self.__max_prepared
+        return conn
+
+    def __close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            self.__log.warning("Error closing database connection", exc_info=True)
+
+    def __take_expired(self, now):
+        expired = []
+        while len(self.__idle) > 0 and self.__size > self.__min_size:
+            conn, last_used = self.__idle[0]
+            if now - last_used < self.__idle_timeout:
+                break
+            self.__idle.pop(0)
+            self.__size -= 1
+            expired.append(conn)
+        return expired
+
+    def __is_healthy(self, conn, last_used):
+        if conn.closed:
+            return False
+        if time.time() - last_used < self.__health_check_interval:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("select 1;")
+            cur.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        start = time.time()
+        deadline = start + self.__checkout_timeout
+        conn = None
+        last_used = None
+
+        with self.__cond:
+            self.__waiting += 1
+            try:
+                while True:
+                    expired = self.__take_expired(time.time())
+                    for expired_conn in expired:
+                        self.__close(expired_conn)
+
+                    if len(self.__idle) > 0:
+                        conn, last_used = self.__idle.pop()
+                        break
+                    if self.__size < self.__max_size:
+                        self.__size += 1
+                        break
+
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self.__checkout_timeouts += 1
+                        CHECKOUT_TIMEOUTS.inc()
+                        raise ProcessingException(reason="Timed out waiting for a database connection", code=503)
+                    self.__cond.wait(remaining)
+            finally:
+                self.__waiting -= 1
+            self.__in_use += 1
+        CONNECTIONS_IN_USE.inc()
+
+        try:
+            if conn is not None and not self.__is_healthy(conn, last_used):
+                self.__log.info("Replacing unhealthy database connection")
+                self.__close(conn)
+                conn = None
+            if conn is None:
+                conn = self.__connect()
+        except Exception:
+            with self.__cond:
+                self.__size -= 1
+                self.__in_use -= 1
+                self.__cond.notify()
+            CONNECTIONS_IN_USE.dec()
+            raise
+
+        elapsed = time.time() - start
+        with self.__cond:
+            self.__checkouts += 1
+            self.__checkout_seconds_total += elapsed
+            self.__checkout_seconds_max = max(self.__checkout_seconds_max, elapsed)
+        CHECKOUT_SECONDS.observe(elapsed)
+
+        return conn
+
+    def putconn(self, conn, discard=False):
+        if not discard and not conn.closed:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                discard = True
+
+        with self.__cond:
+            self.__in_use -= 1
+            if discard or conn.closed:
+                self.__size -= 1
+                self.__discarded += 1
+            else:
+                self.__idle.append((conn, time.time()))
+            self.__cond.notify()
+        CONNECTIONS_IN_USE.dec()
+
+        if discard:
+            CONNECTIONS_DISCARDED.inc()
+            self.__close(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self.getconn()
+        discard = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            discard = True
+            raise
+        finally:
+            self.putconn(conn, discard)
+
+    def closeall(self):
+        with self.__cond:
+            idle = [conn for conn, last_used in self.__idle]
+            self.__size -= len(idle)
+            self.__idle = []
+        for conn in idle:
+            self.__close(conn)
+
+    def stats(self):
+        with self.__cond:
+            return {
+                "pid": self.__pid,
+                "size": self.__size,
+                "idle": len(self.__idle),
+                "in_use": self.__in_use,
+                "waiting": self.__waiting,
+                "min_size": self.__min_size,
+                "max_size": self.__max_size,
+                "checkouts": self.__checkouts,
+                "checkout_timeouts": self.__checkout_timeouts,
+                "checkout_seconds_avg": self.__checkout_seconds_total / self.__checkouts if self.__checkouts > 0 else 0.0,
+                "checkout_seconds_max": self.__checkout_seconds_max,
+                "discarded": self.__discarded
+            }
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool(webconfig):
+    """
+    Returns the connection pool for the current process. A pool inherited across a fork is
+    abandoned without closing its connections, since their sockets are shared with the parent.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.pid() != os.getpid():
+            _pool = ConnectionPool(webconfig)
+        return _pool
+
+
+def pool_stats():
+    pool = _pool
+    if pool is None or pool.pid() != os.getpid():
+        return None
+    return pool.stats()
+
+
+@contextmanager
+def connection(webconfig):
+    """
+    Checks out a connection for the duration of one transaction. The statement timeout of the
+    active request context, if any, applies to that transaction; a statement it cancels is
+    reported as a 504. The connection is registered with the context so that its statements
+    can be cancelled when the client disconnects.
+    """
+    context = reqcontext.current()
+    timeout = context.statement_timeout if context is not None else None
+    reqcontext.check_cancelled()
+
+    with get_pool(webconfig).connection() as conn:
+        if context is not None:
+            context.add_connection(conn)
+        try:
+            if timeout is not None:
+                cur = conn.cursor()
+                cur.execute("set local statement_timeout = %s;", (int(timeout),))
+                cur.close()
+            yield conn
+        except psycopg2.extensions.QueryCanceledError:
+            if context is not None and context.cancelled:
+                raise RequestCancelled()
+            if timeout is None:
+                raise
+            metrics.STATEMENT_TIMEOUTS.labels(context.path).inc()
+            raise ProcessingException(reason="Query exceeded the time limit of %s ms" % timeout, code=504)
+        finally:
+            if context is not None:
+                context.remove_connection(conn)
+
+
+@contextmanager
+def cursor(webconfig):
+    with connection(webconfig) as conn:
+        cur = conn.cursor(cursor_factory=TimedCursor)
+        try:
+            yield cur
+        finally:
+            cur.close()
+
+
+@contextmanager
+def named_cursor(webconfig, itersize=None):
+    """
+    Server-side cursor that fetches rows from Postgres in batches of 'itersize' rows (default
+    db.stream_batch_size) as it is iterated rather than materializing the whole result set.
+    """
+    if itersize is None:
+        itersize = int(_get_option(webconfig, "db.stream_batch_size", 2000))
+
+    with connection(webconfig) as conn:
+        cur = conn.cursor(name="msfbe_%s" % uuid.uuid4().hex, cursor_factory=TimedCursor)
+        cur.itersize = itersize
+        try:
+            yield cur
+        finally:
+            try:
+                cur.close()
+            except psycopg2.Error:
+                # The transaction has already failed; the pool rolls it back on return
+                pass
@@ -0,0 +1,90 @@
+"""
+Copyright (c) 2021 Jet Propulsion Laboratory,
+California Institute of Technology.  All rights reserved
+"""
+
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_EXECUTOR = "default"
+
+class ExecutionModes:
+    INLINE = "inline"
+    THREADPOOL = "threadpool"
+
+
+def _get_option(webconfig, section, option, default=None):
+    if webconfig.has_option(section, option):
+        return webconfig.get(section, option)
+    return default
+
+
+def execution_mode(webconfig):
+    return _get_option(webconfig, "global", "server.executor_mode", ExecutionModes.INLINE)
+
+
+class ExecutorRegistry(object):
+    """
+    Named thread pools used to run handler work off of the IOLoop. The 'default' pool is sized
+    by server.executor_threads in [global]; additional pools are declared in [executors] as
+    executor.<name>=<threads> and selected by a handler's 'executor' class attribute.
+    """
+
+    def __init__(self, webconfig):
+        self.__webconfig = webconfig
+        self.__executors = {}
+        self.__lock = threading.Lock()
+        self.__pid = os.getpid()
+
+    def pid(self):
+        return self.__pid
+
+    def __pool_size(self, name):
+        if name == DEFAULT_EXECUTOR:
+            return int(_get_option(self.__webconfig, "global", "server.executor_threads", 10))
+        size = _get_option(self.__webconfig, "executors", "executor.%s" % name, None)
+        if size is None:
+            return None
+        return int(size)
+
+    def __create(self, name):
+        size = self.__pool_size(name)
+        if size is None:
+            logging.getLogger(__name__).warning("Executor '%s' is not configured, using '%s'" % (name, DEFAULT_EXECUTOR))
+            return self.__get_locked(DEFAULT_EXECUTOR)
+        logging.getLogger(__name__).info("Creating executor '%s' with %s threads in process %s" % (name, size, self.__pid))
+        return ThreadPoolExecutor(max_workers=size)
+
+    def __get_locked(self, name):
+        if name not in self.__executors:
+            self.__executors[name] = self.__create(name)
+        return self.__executors[name]
+
+    def get(self, name=None):
+        with self.__lock:
+            return self.__get_locked(DEFAULT_EXECUTOR if name is None else name)
+
+    def shutdown(self, wait=False):
+        with self.__lock:
+            for executor in set(self.__executors.values()):
+                executor.shutdown(wait=wait)
+            self.__executors = {}
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_executor(webconfig, name=None):
+    """
+    Returns the named executor for the current process. Pools are created lazily so that each
+    subprocess started by server.start() gets its own threads rather than inheriting dead ones.
+    """
+    global _registry
+    with _registry_lock:
+        if _registry is None or _registry.pid() != os.getpid():
+            _registry = ExecutorRegistry(webconfig)
+        registry = _registry
+    return registry.get(name)
@@ -0,0 +1,120 @@
+"""
+Copyright (c) 2021 Jet Propulsion Laboratory,
+California Institute of Technology.  All rights reserved
+
+Geometry columns are converted by PostGIS rather than in Python: GeoJSON output selects
+ST_AsGeoJSON and is written into the response with serialization.RawJson, and the point list
+format selects the ring as WKB, whose coordinates are read directly with NumPy.
+
+Clients displaying a map pass zoom=<web map zoom level> (or tolerance=<degrees>) to get shapes
+simplified to about one screen pixel and coordinates rounded to the decimals that still resolve
+it, rather than full resolution at every zoom.
+"""
+
+import math
+import struct
+import numpy as np
+import msfbe.serialization as serialization
+
+ZOOM = "zoom"
+TOLERANCE = "tolerance"
+
+# Decimals of full resolution output
+FULL_DECIMALS = 15
+MAX_ZOOM = 30
+TILE_SIZE = 256
+
+_WKB_HEADER = struct.Struct("<BII")
+_WKB_LITTLE_ENDIAN = 1
+_WKB_LINESTRING = 2
+
+
+def get_simplification(request):
+    """
+    Returns the query parameters of the simplification requested with zoom or tolerance, or
+    None for full resolution. The tolerance of a zoom level is the width of a pixel in degrees.
+    """
+    zoom = request.get_int_arg(ZOOM, None)
+    if zoom is not None:
+        tolerance = 360.0 / (TILE_SIZE * 2 ** min(max(zoom, 0), MAX_ZOOM))
+    else:
+        tolerance = request.get_float_arg(TOLERANCE, None)
+        if tolerance is None or tolerance <= 0:
+            return None
+
+    decimals = int(math.ceil(-math.log10(tolerance)))
+    return {
+        "simplify_tolerance": tolerance,
+        "simplify_decimals": min(max(decimals, 0), FULL_DECIMALS)
+    }
+
+
+def decimals(simplification):
+    return simplification["simplify_decimals"] if simplification is not None else None
+
+
+def simplified_sql(column, simplification=None):
+    if simplification is None:
+        return column
+    return "ST_SimplifyPreserveTopology(%s, %%(simplify_tolerance)s)" % column
+
+
+def as_geojson_sql(column, simplification=None):
+    """
+    Selects 'column' as GeoJSON. With a simplification, the statement takes its parameters.
+    """
+    if simplification is None:
+        return "ST_AsGeoJSON(%s, %d)" % (column, FULL_DECIMALS)
+    return "ST_AsGeoJSON(%s, %%(simplify_decimals)s)" % simplified_sql(column, simplification)
+
+
+def ring_wkb_sql(column, simplification=None):
+    """
+    Selects the exterior ring of the polygon in 'column' as 2D little endian WKB, the input of
+    ring_points(). With a simplification, the statement takes its parameters.
+    """
+    return "ST_AsBinary(ST_Force2D(ST_ExteriorRing(%s)), 'NDR')" % simplified_sql(column, simplification)
+
+
+def round_coordinate(value, decimals):
+    scale = float(10 ** decimals)
+    return round(value * scale) / scale
+
+
+def ring_points(wkb, decimals=None):
+    """
+    Returns the [x, y] points of a ring selected with ring_wkb_sql(), rounded to 'decimals' if
+    given, or an empty list for null.
+    """
+    if wkb is None:
+        return []
+
+    wkb = bytes(wkb)
+    byte_order, geometry_type, num_points = _WKB_HEADER.unpack_from(wkb)
+    if byte_order != _WKB_LITTLE_ENDIAN or geometry_type != _WKB_LINESTRING:
+        raise ValueError("Expected a 2D little endian WKB linestring")
+    points = np.frombuffer(wkb, dtype="<f8", count=num_points * 2, offset=_WKB_HEADER.size)
+    if decimals is not None:
+        points = np.round(points, decimals)
+    return points.reshape(num_points, 2).tolist()
+
+
+def geojson(text):
+    """
+    Wraps GeoJSON selected with as_geojson_sql() for output, or returns None for null.
+    """
+    if text is None:
+        return None
+    return serialization.RawJson(text)
+
+
+def with_members(text, members):
+    """
+    Adds 'members' to the GeoJSON object selected with as_geojson_sql() without parsing it.
+    """
+    if text is None:
+        return members
+    if len(members) == 0:
+        return serialization.RawJson(text)
+    text = text.rstrip()
+    return serialization.RawJson(text[:-1] + "," + serialization.dumps(members)[1:])
@@ -0,0 +1,94 @@
+"""
+Copyright (c) 2021 Jet Propulsion Laboratory,
+California Institute of Technology.  All rights reserved
+"""
+
+from msfbe.webmodel import BaseHandler, service_handler, SimpleResults, ProcessingException
+from msfbe import dbpool
+from msfbe import maintenance
+import msfbe.cache as cache
+
+
+def check_admin_access(computeOptions, config):
+    allowed_ips = []
+    if config.has_option("admin", "admin.allowed_ips"):
+        allowed_ips = [ip.strip() for ip in config.get("admin", "admin.allowed_ips").split(",")]
+    if computeOptions.get_remote_ip() not in allowed_ips:
+        raise ProcessingException(reason="Forbidden", code=403)
+
+
+@service_handler
+class DatabasePoolStatsHandlerImpl(BaseHandler):
+    name = "Database Connection Pool Statistics"
+    path = "/admin/dbpool"
+    description = "Connection pool usage for the worker process answering the request"
+    params = {}
+    singleton = True
+    coalesce = False
+
+    def __init__(self):
+        BaseHandler.__init__(self)
+
+    def handle(self, computeOptions, **args):
+        check_admin_access(computeOptions, args["webconfig"])
+        stats = dbpool.pool_stats()
+        return SimpleResults(stats if stats is not None else {})
+
+
+@service_handler
+class CacheStatsHandlerImpl(BaseHandler):
+    name = "Response Cache Statistics"
+    path = "/admin/cache"
+    description = "Response cache usage for the worker process answering the request"
+    params = {}
+    singleton = True
+    coalesce = False
+
+    def __init__(self):
+        BaseHandler.__init__(self)
+
+    def handle(self, computeOptions, **args):
+        check_admin_access(computeOptions, args["webconfig"])
+        stats = cache.cache_stats()
+        return SimpleResults(stats if stats is not None else {})
+
+
+@service_handler
+class CacheFlushHandlerImpl(BaseHandler):
+    name = "Flush Response Cache"
+    path = "/admin/cache/flush"
+    description = "Flushes cached responses in every worker process, e.g. after new AVIRIS data is loaded"
+    params = {}
+    singleton = True
+    coalesce = False
+    methods = ("POST",)
+
+    def __init__(self):
+        BaseHandler.__init__(self)
+
+    def handle(self, computeOptions, **args):
+        check_admin_access(computeOptions, args["webconfig"])
+        return SimpleResults({
+            "flushed": cache.flush_all(args["webconfig"])
+        })
+
+
+@service_handler
+class VistaCountsRefreshHandlerImpl(BaseHandler):
+    name = "Refresh VISTA Counts"
+    path = "/admin/vista/counts/refresh"
+    description = "Recounts the flyovers and plumes of facilities changed by a data load, or of every facility with full=true"
+    params = {}
+    singleton = True
+    coalesce = False
+    methods = ("POST",)
+
+    def __init__(self):
+        BaseHandler.__init__(self)
+
+    def handle(self, computeOptions, **args):
+        check_admin_access(computeOptions, args["webconfig"])
+        full = computeOptions.get_boolean_arg("full", False)
+        return SimpleResults({
+            "refreshed": maintenance.refresh_vista_counts(args["webconfig"], full=full)
+        })
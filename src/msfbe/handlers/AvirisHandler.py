@@ -3,10 +3,10 @@ Copyright (c) 2017 Jet Propulsion Laboratory,
 California Institute of Technology.  All rights reserved
 """
 
-import json
-from msfbe.webmodel import BaseHandler, service_handler
-import psycopg2
-from osgeo import gdal,ogr,osr
+from msfbe.webmodel import BaseHandler, service_handler, SimpleResults, StreamingResults, json_array_chunks, feature_collection_chunks
+from msfbe import dbpool
+from msfbe import geometry
+from msfbe import projection
 
 PLUME_ID = 0
 JSON_URL = 1
@@ -36,21 +36,81 @@ FETCH10 = 24
 FETCH20 = 25
 FLUX = 26
 FLUX_UNCERTAINTY = 27
-PLUME_SHAPE_WKT = 28
+PLUME_SHAPE_WKB = 28
+
+
+# Select list of the plume query, in the order of the indexes above
+PLUME_COLUMNS = [
+    "ap.plume_id",
+    "ap.json_url",
+    "ap.png_url",
+    "ap.plume_url",
+    "ap.rgbqlctr_url",
+    "ap.png_url_thumb",
+    "ap.plume_url_thumb",
+    "ap.rgbqlctr_url_thumb",
+    "ap.plume_tiff_url",
+    "ap.rgb_tiff_url",
+    "to_char(ap.data_date, 'yyyy-mm-dd HH24:MI:SS')",
+    "ap.mergedist",
+    "p.source_id",
+    "ap.ime_5",
+    "ap.ime_10",
+    "ap.ime_20",
+    "ap.candidate_id",
+    "p.plume_longitude_deg",
+    "p.plume_latitude_deg",
+    "ap.aviris_plume_id",
+    "ap.detid5",
+    "ap.detid10",
+    "ap.detid20",
+    "ap.fetch5",
+    "ap.fetch10",
+    "ap.fetch20",
+    "p.flux",
+    "p.flux_uncertainty",
+    geometry.ring_wkb_sql("ap.plume_shape") + " as plume_shape_wkb"
+]
+
+# Columns each field of a formatted plume is built from
+PLUME_FIELD_COLUMNS = {
+    "id": PLUME_ID,
+    "json_url": JSON_URL,
+    "png_url": PNG_URL,
+    "plume_url": PLUME_URL,
+    "rgbqlctr_url": RGBQLCTR_URL,
+    "png_url_thumb": PNG_URL_THUMB,
+    "plume_url_thumb": PLUME_URL_THUMB,
+    "rgbqlctr_url_thumb": RGBQLCTR_URL_THUMB,
+    "plume_tiff_url": PLUME_TIFF_URL,
+    "rgb_tiff_url": RGB_TIFF_URL,
+    "data_date_dt": DATA_DATE,
+    "mergedist": MERGEDIST,
+    "source_id": SOURCE_ID,
+    "ime_5": IME_5,
+    "ime_10": IME_10,
+    "ime_20": IME_20,
+    "candidate_id": CANDIDATE_ID,
+    "flight_campaign": CANDIDATE_ID,
+    "plume_id": AVIRIS_PLUME_ID,
+    "detid5": DETID5,
+    "detid10": DETID10,
+    "detid20": DETID20,
+    "fetch5": FETCH5,
+    "fetch10": FETCH10,
+    "fetch20": FETCH20,
+    "flux": FLUX,
+    "flux_uncertainty": FLUX_UNCERTAINTY,
+    "shape": PLUME_SHAPE_WKB,
+    "location": [PLUME_LATITUDE, PLUME_LONGITUDE]
+}
 
 
 FLIGHTLINE_ID = 0
 FLIGHT_TIMESTAMP = 1
 FLIGHT_NAME = 2
 FLIGHT_IMAGE_URL = 3
-FLIGHT_SHAPE_WKT = 4
-
-class SimpleJsonResult(object):
-    def __init__(self, result):
-        self.result = result
-
-    def toJson(self):
-        return json.dumps(self.result)
+FLIGHT_SHAPE = 4
 
 
 def replace_s3_url(url, s3url):
@@ -89,99 +149,54 @@ class AvirisPlumeHandlerImpl(BaseHandler):
         return item
 
 
-    def __query(self, config, maxLat, maxLon, minLat, minLon, maxObjects, source_id, plume_id, candidate_id):
+    def __query(self, config, maxLat, maxLon, minLat, minLon, maxObjects, source_id, plume_id, candidate_id, fields=None, simplification=None):
 
+        if fields is None:
+            needed = range(len(PLUME_COLUMNS))
+        else:
+            needed = projection.needed_columns(fields, PLUME_FIELD_COLUMNS)
 
-        conn = psycopg2.connect(dbname=config.get("database", "db.database"),
-                                user=config.get("database", "db.username"),
-                                password=config.get("database", "db.password"),
-                                host=config.get("database", "db.endpoint"),
-                                port=config.get("database", "db.port"))
-        cur = conn.cursor()
+        columns = list(PLUME_COLUMNS)
+        columns[PLUME_SHAPE_WKB] = geometry.ring_wkb_sql("ap.plume_shape", simplification) + " as plume_shape_wkb"
 
         sql = """
 select
-  ap.plume_id,
-  ap.json_url,
-  ap.png_url,
-  ap.plume_url,
-  ap.rgbqlctr_url,
-  ap.png_url_thumb,
-  ap.plume_url_thumb,
-  ap.rgbqlctr_url_thumb,
-  ap.plume_tiff_url,
-  ap.rgb_tiff_url,
-  to_char(ap.data_date, 'yyyy-mm-dd HH24:MI:SS'),
-  ap.mergedist,
-  p.source_id,
-  ap.ime_5,
-  ap.ime_10,
-  ap.ime_20,
-  ap.candidate_id,
-  p.plume_longitude_deg,
-  p.plume_latitude_deg,
-  ap.aviris_plume_id,
-  ap.detid5,
-  ap.detid10,
-  ap.detid20,
-  ap.fetch5,
-  ap.fetch10,
-  ap.fetch20,
-  p.flux,
-  p.flux_uncertainty,
-  ST_asText(ap.plume_shape) as plume_shape_wkt
+  """ + projection.select_list(columns, needed) + """
 from
   aviris_plumes as ap,
   plumes as p
 where
-  ST_Intersects(ap.plume_shape, ST_MakeEnvelope(%s, %s, %s, %s, 4326))
+  ST_Intersects(ap.plume_shape, ST_MakeEnvelope(%(minLon)s, %(minLat)s, %(maxLon)s, %(maxLat)s, 4326))
   and ap.source_id is not null
   and ap.candidate_id is not null
   and p.plume_id = ap.candidate_id
-  {sourceidsql}
-  {plumeidsql}
-  {candidateidsql}
+  and (%(source_id)s::text[] is null or ap.source_id = any(%(source_id)s::text[]))
+  and (%(plume_id)s::integer is null or ap.plume_id = %(plume_id)s::integer)
+  and (%(candidate_id)s::text is null or ap.candidate_id = %(candidate_id)s::text)
         """
 
-        if source_id is not None:
-            source_id = "'%s'" % "','".join(source_id)
-            sourceidsql = "and ap.source_id in (%s)"%source_id
-        else:
-            sourceidsql = ""
-
-        if plume_id is not None:
-            plumeidsql = "and ap.plume_id=%s" % plume_id
-        else:
-            plumeidsql = ""
-
-        if candidate_id is not None:
-            candidateidsql = "and ap.candidate_id=\'%s\'" % candidate_id
-        else:
-            candidateidsql = ""
-
-
-
-        sql = sql.format(sourceidsql=sourceidsql, plumeidsql=plumeidsql, candidateidsql=candidateidsql)
-
-        # Query
-        cur.execute(sql,
-                    (
-                        minLon,
-                        minLat,
-                        maxLon,
-                        maxLat
-                    )
-                    )
+        params = {
+            "minLon": minLon,
+            "minLat": minLat,
+            "maxLon": maxLon,
+            "maxLat": maxLat,
+            "source_id": list(source_id) if source_id is not None else None,
+            "plume_id": plume_id,
+            "candidate_id": candidate_id
+        }
+        if simplification is not None:
+            params.update(simplification)
 
-        results = cur.fetchall()
+        # Query. The lists are bound as arrays so that the SQL text is the same for every request
+        with dbpool.cursor(config) as cur:
+            cur.execute(sql, params)
 
-        cur.close()
-        conn.close()
+            results = cur.fetchall()
 
         return results
 
 
-    def __format_plume(self, row, s3url):
+    def __format_plume(self, row, s3url, decimals=None):
         plume = {
             "id": row[PLUME_ID],
             "json_url": replace_s3_url(row[JSON_URL], s3url) if row[JSON_URL] is not None else "n/a",
@@ -210,22 +225,12 @@ where
             "fetch20": row[FETCH20],
             "flux": row[FLUX],
             "flux_uncertainty": row[FLUX_UNCERTAINTY],
-            "shape": [],
+            "shape": geometry.ring_points(row[PLUME_SHAPE_WKB], decimals),
             "location": [
                 row[PLUME_LATITUDE], row[PLUME_LONGITUDE]
             ]
         }
 
-        shape_wkt = row[PLUME_SHAPE_WKT]
-        shape_geom = ogr.CreateGeometryFromWkt(shape_wkt)
-        shape_geom_poly = shape_geom.GetGeometryRef(0)
-        for i in range(0, shape_geom_poly.GetPointCount()):
-            # GetPoint returns a tuple not a Geometry
-            pt = shape_geom_poly.GetPoint(i)
-            plume["shape"].append(pt[:2])
-
-
-
         return plume
 
 
@@ -243,18 +248,23 @@ where
         candidate_id = computeOptions.get_argument("cid", None)
         if type(source_id) == str or type(source_id) == unicode:
             source_id = source_id.split(",")
+        fields = projection.get_fields(computeOptions, PLUME_FIELD_COLUMNS)
+        simplification = geometry.get_simplification(computeOptions)
 
-        rows = self.__query(args["webconfig"], maxLat, maxLon, minLat, minLon, maxObjects, source_id, plume_id, candidate_id)
+        rows = self.__query(args["webconfig"], maxLat, maxLon, minLat, minLon, maxObjects, source_id, plume_id, candidate_id, fields, simplification)
 
         s3url = args["webconfig"].get("s3", "s3.proxyurl")
-        results = [self.__format_plume(row, s3url) for row in rows]
+        decimals = geometry.decimals(simplification)
+        results = [self.__format_plume(row, s3url, decimals) for row in rows]
+        if fields is not None:
+            results = [projection.project(result, fields) for result in results]
 
         if count_only is True:
-            return SimpleJsonResult({
+            return SimpleResults({
                 "count": len(results)
             })
         else:
-            return SimpleJsonResult(results)
+            return SimpleResults(results)
 
 
 
@@ -270,90 +280,85 @@ class AvirisFlightHandlerImpl(BaseHandler):
         BaseHandler.__init__(self)
 
 
-    def __query(self, config, maxLat, maxLon, minLat, minLon, maxObjects=1000):
-
-
-        conn = psycopg2.connect(dbname=config.get("database", "db.database"),
-                                user=config.get("database", "db.username"),
-                                password=config.get("database", "db.password"),
-                                host=config.get("database", "db.endpoint"),
-                                port=config.get("database", "db.port"))
-        cur = conn.cursor()
+    @staticmethod
+    def __query_sql(as_geojson, simplification):
+        # The shape is selected as GeoJSON for the GeoJSON format and as WKB for the point lists
+        # of the basic format
+        if as_geojson:
+            shape = geometry.as_geojson_sql("f.flightline_shape", simplification) + " as flight_shape_geojson"
+        else:
+            shape = geometry.ring_wkb_sql("f.flightline_shape", simplification) + " as flight_shape_wkb"
 
-        sql = """
+        return """
 select
   f.flightline_id,
   to_char(f.flight_timestamp, 'yyyy-mm-dd HH24:MI:SS') as flight_timestamp,
   f.flight_name,
   f.image_url as flight_image_url,
-  ST_asText(f.flightline_shape) as flight_shape_wkt
+  """ + shape + """
 from
   flightlines as f
 where
-  ST_Intersects(f.flightline_shape, ST_MakeEnvelope(%s, %s, %s, %s, 4326))       
-limit %s;
+  ST_Intersects(f.flightline_shape, ST_MakeEnvelope(%(minLon)s, %(minLat)s, %(maxLon)s, %(maxLat)s, 4326))
+limit %(maxObjects)s;
         """
 
+    @staticmethod
+    def __query_params(maxLat, maxLon, minLat, minLon, maxObjects, simplification):
+        params = {
+            "minLon": minLon,
+            "minLat": minLat,
+            "maxLon": maxLon,
+            "maxLat": maxLat,
+            "maxObjects": maxObjects
+        }
+        if simplification is not None:
+            params.update(simplification)
+        return params
 
-        cur.execute(sql,
-                    (
-                        minLon,
-                        minLat,
-                        maxLon,
-                        maxLat,
-                        maxObjects
-                    )
-                    )
-
-        results = cur.fetchall()
+    def __query(self, config, maxLat, maxLon, minLat, minLon, maxObjects=1000, as_geojson=True, simplification=None):
+        with dbpool.cursor(config) as cur:
+            cur.execute(self.__query_sql(as_geojson, simplification),
+                        self.__query_params(maxLat, maxLon, minLat, minLon, maxObjects, simplification))
 
-        cur.close()
-        conn.close()
+            results = cur.fetchall()
 
         return results
 
+    def __stream_query(self, config, maxLat, maxLon, minLat, minLon, maxObjects=1000, as_geojson=True, simplification=None):
+        with dbpool.named_cursor(config) as cur:
+            cur.execute(self.__query_sql(as_geojson, simplification),
+                        self.__query_params(maxLat, maxLon, minLat, minLon, maxObjects, simplification))
 
+            for row in cur:
+                yield row
 
 
-    def __format_flight_basic(self, row, s3url):
+    def __format_flight_basic(self, row, s3url, decimals=None):
         flight = {
             "name": replace_s3_url(row[FLIGHT_NAME], s3url),
-            "shape": [],
+            "shape": geometry.ring_points(row[FLIGHT_SHAPE], decimals),
             "png_url" : row[FLIGHT_IMAGE_URL],
             "data_date_dt": row[FLIGHT_TIMESTAMP],
             "id": row[FLIGHTLINE_ID]
         }
 
-        shape_wkt = row[FLIGHT_SHAPE_WKT]
-        shape_geom = ogr.CreateGeometryFromWkt(shape_wkt)
-        shape_geom_poly = shape_geom.GetGeometryRef(0)
-        for i in range(0, shape_geom_poly.GetPointCount()):
-            # GetPoint returns a tuple not a Geometry
-            pt = shape_geom_poly.GetPoint(i)
-            flight["shape"].append(pt[:2])
-
-
         return flight
 
-
-    def __wkt_to_geojson(self, wkt):
-        shape_geom = ogr.CreateGeometryFromWkt(wkt)
-        return json.loads(shape_geom.ExportToJson())
-
     def __format_flight_geojson(self, row, s3url):
-        geojson = self.__wkt_to_geojson(row[FLIGHT_SHAPE_WKT])
-        geojson["properties"] = {
-            "name": row[FLIGHT_NAME],
-            "png_url": replace_s3_url(row[FLIGHT_IMAGE_URL], s3url),
-            "data_date_dt": row[FLIGHT_TIMESTAMP],
-            "id": row[FLIGHTLINE_ID]
-        }
-        return geojson
+        return geometry.with_members(row[FLIGHT_SHAPE], {
+            "properties": {
+                "name": row[FLIGHT_NAME],
+                "png_url": replace_s3_url(row[FLIGHT_IMAGE_URL], s3url),
+                "data_date_dt": row[FLIGHT_TIMESTAMP],
+                "id": row[FLIGHTLINE_ID]
+            }
+        })
 
-    def __format_rows_basic(self, rows, s3url):
+    def __format_rows_basic(self, rows, s3url, decimals=None):
         results = []
         for row in rows:
-            results.append(self.__format_flight_basic(row, s3url))
+            results.append(self.__format_flight_basic(row, s3url, decimals))
         return results
 
     def __format_rows_geojson(self, rows, s3url):
@@ -375,11 +380,11 @@ limit %s;
 
         return geojson
 
-    def __format_rows(self, rows, s3url, as_geojson=True):
+    def __format_rows(self, rows, s3url, as_geojson=True, decimals=None):
         if as_geojson:
             return self.__format_rows_geojson(rows, s3url)
         else:
-            return self.__format_rows_basic(rows, s3url)
+            return self.__format_rows_basic(rows, s3url, decimals)
 
 
     def handle(self, computeOptions, **args):
@@ -391,15 +396,26 @@ limit %s;
         as_geojson = computeOptions.get_boolean_arg("asgeojson", True)
 
         maxObjects = computeOptions.get_argument("maxObjects", 1000)
-
-        rows = self.__query(args["webconfig"], maxLat, maxLon, minLat, minLon, maxObjects)
+        stream = computeOptions.get_boolean_arg("stream", False)
+        simplification = geometry.get_simplification(computeOptions)
+        decimals = geometry.decimals(simplification)
 
         s3url = args["webconfig"].get("s3", "s3.proxyurl")
-        results = self.__format_rows(rows, s3url, as_geojson)
+
+        if stream is True and count_only is False:
+            rows = self.__stream_query(args["webconfig"], maxLat, maxLon, minLat, minLon, maxObjects, as_geojson, simplification)
+            if as_geojson:
+                return StreamingResults(feature_collection_chunks(self.__format_flight_geojson(row, s3url) for row in rows))
+            else:
+                return StreamingResults(json_array_chunks(self.__format_flight_basic(row, s3url, decimals) for row in rows))
+
+        rows = self.__query(args["webconfig"], maxLat, maxLon, minLat, minLon, maxObjects, as_geojson, simplification)
+
+        results = self.__format_rows(rows, s3url, as_geojson, decimals)
 
         if count_only is True:
-            return SimpleJsonResult({
+            return SimpleResults({
                 "count": len(results)
             })
         else:
-            return SimpleJsonResult(results)
\ No newline at end of file
+            return SimpleResults(results)
\ No newline at end of file
@@ -4,9 +4,9 @@ California Institute of Technology.  All rights reserved
 """
 
 import json
-from msfbe.webmodel import BaseHandler, service_handler
+from msfbe.webmodel import BaseHandler, service_handler, SimpleResults
 import requests
-import psycopg2
+from msfbe import dbpool
 
 class CountiesColumns:
     COUNTY_ID = 0
@@ -19,13 +19,6 @@ class CountiesColumns:
     CONUM = 7
 
 
-class SimpleResult(object):
-    def __init__(self, result):
-        self.result = result
-
-    def toJson(self):
-        return json.dumps(self.result)
-
 @service_handler
 class CountiesHandlerImpl(BaseHandler):
     name = "Counties Service"
@@ -54,27 +47,18 @@ class CountiesHandlerImpl(BaseHandler):
       ST_Intersects(c.county_shape, ST_MakeEnvelope(%s, %s, %s, %s, 4326));
             """
 
-        conn = psycopg2.connect(dbname=config.get("database", "db.database"),
-                                user=config.get("database", "db.username"),
-                                password=config.get("database", "db.password"),
-                                host=config.get("database", "db.endpoint"),
-                                port=config.get("database", "db.port"))
-        cur = conn.cursor()
-
         # Query
-        cur.execute(sql,
-                    (
-                        minLon,
-                        minLat,
-                        maxLon,
-                        maxLat
-                    )
-                    )
-
-        results = cur.fetchall()
-
-        cur.close()
-        conn.close()
+        with dbpool.cursor(config) as cur:
+            cur.execute(sql,
+                        (
+                            minLon,
+                            minLat,
+                            maxLon,
+                            maxLat
+                        )
+                        )
+
+            results = cur.fetchall()
 
         return results
 
@@ -104,4 +88,4 @@ class CountiesHandlerImpl(BaseHandler):
         rows = self.__query(args["webconfig"], maxLat, maxLon, minLat, minLon)
 
         results = self.__format_results(rows)
-        return SimpleResult(results)
+        return SimpleResults(results)
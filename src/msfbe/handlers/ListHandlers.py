@@ -14,7 +14,9 @@ create_query_based_handler(
         column("name", 1),
         column("area", 2),
         column("perimeter", 3)
-    ]
+    ],
+    cache_ttl=3600,
+    cache_control="public, max-age=3600"
 )
 
 
@@ -29,7 +31,9 @@ create_query_based_handler(
         column("sector_level_1", 0),
         column("sector_level_2", 1),
         column("sector_level_3", 2)
-    ]
+    ],
+    cache_ttl=3600,
+    cache_control="public, max-age=3600"
 )
 
 create_query_based_handler(
@@ -42,7 +46,9 @@ create_query_based_handler(
     columns=[
         column("min_date", 0),
         column("max_date", 1)
-    ]
+    ],
+    cache_ttl=3600,
+    cache_control="public, max-age=3600"
 )
 
 create_query_based_handler(
@@ -61,5 +67,7 @@ order by
     columns=[
         column("category_id", 0),
         column("category", 1)
-    ]
+    ],
+    cache_ttl=3600,
+    cache_control="public, max-age=3600"
 )
\ No newline at end of file
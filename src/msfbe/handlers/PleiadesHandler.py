@@ -4,7 +4,7 @@ California Institute of Technology.  All rights reserved
 """
 
 import json
-from msfbe.webmodel import BaseHandler, service_handler
+from msfbe.webmodel import BaseHandler, service_handler, SimpleResults
 from datetime import datetime
 import subprocess
 import tempfile
@@ -39,6 +39,7 @@ class PleiadesRunHandlerImpl(BaseHandler):
     description = "Enables management of Pleiades run and status APIs"
     params = {}
     singleton = True
+    coalesce = False
 
     def __init__(self):
         BaseHandler.__init__(self)
@@ -126,11 +127,4 @@ class PleiadesRunHandlerImpl(BaseHandler):
 
         jobspec["meta"]["jobfile"] = output_path
 
-        class SimpleResult(object):
-            def __init__(self, result):
-                self.result = result
-
-            def toJson(self):
-                return json.dumps(self.result)
-
-        return SimpleResult(jobspec)
\ No newline at end of file
+        return SimpleResults(jobspec)
\ No newline at end of file
@@ -4,7 +4,7 @@ California Institute of Technology.  All rights reserved
 """
 
 import json
-from webmodel import BaseHandler, service_handler
+from webmodel import BaseHandler, service_handler, SimpleResults
 
 
 @service_handler
@@ -19,11 +19,4 @@ class SayHiHandlerImpl(BaseHandler):
         BaseHandler.__init__(self)
 
     def handle(self, computeOptions, **args):
-        class SimpleResult(object):
-            def __init__(self, result):
-                self.result = result
-
-            def toJson(self):
-                return json.dumps(self.result)
-
-        return SimpleResult({"say": "hi"})
\ No newline at end of file
+        return SimpleResults({"say": "hi"})
\ No newline at end of file
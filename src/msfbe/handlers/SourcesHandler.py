@@ -5,8 +5,8 @@ California Institute of Technology.  All rights reserved
 
 import json
 from msfbe.webmodel import BaseHandler, service_handler, SimpleResults
-import psycopg2
-from osgeo import gdal,ogr,osr
+from msfbe import dbpool
+from msfbe import pagination
 
 
 class SourceListColumns:
@@ -43,16 +43,9 @@ class SourcesHandlerImpl(BaseHandler):
 
 
 
-    def __query(self, config, maxLat, maxLon, minLat, minLon, maxObjects=1000):
+    def __query(self, config, maxLat, maxLon, minLat, minLon, maxObjects=1000, after=None, paged=False):
 
 
-        conn = psycopg2.connect(dbname=config.get("database", "db.database"),
-                                user=config.get("database", "db.username"),
-                                password=config.get("database", "db.password"),
-                                host=config.get("database", "db.endpoint"),
-                                port=config.get("database", "db.port"))
-        cur = conn.cursor()
-
         sql = """
 select
   s.source_id,
@@ -92,27 +85,32 @@ from
       on v.id = vs.vista_id
 where
   ST_Intersects(s.source_location, ST_MakeEnvelope(%s, %s, %s, %s, 4326))
-limit
-  %s
-        """
+"""
+        params = [minLon, minLat, maxLon, maxLat]
 
-        cur.execute(sql,
-                    (
-                        minLon,
-                        minLat,
-                        maxLon,
-                        maxLat,
-                        maxObjects
-                    )
-                    )
+        # A source has a row for each facility tied at the minimum distance, so pages are
+        # ordered by source and facility and start after the last row of the previous page.
+        # Sources without facilities have a single row with a null vista_id, ordered as -1.
+        if after is not None:
+            sql += "  and (s.source_id, coalesce(vs.vista_id, -1)) > (%s, %s)\n"
+            params.extend(after)
+        if paged:
+            sql += "order by\n  s.source_id,\n  coalesce(vs.vista_id, -1)\n"
+        sql += "limit\n  %s\n"
+        params.append(maxObjects)
 
-        results = cur.fetchall()
+        with dbpool.cursor(config) as cur:
+            cur.execute(sql, params)
 
-        cur.close()
-        conn.close()
+            results = cur.fetchall()
 
         return results
 
+    @staticmethod
+    def __page_key(row):
+        vista_id = row[SourceListColumns.VISTA_ID]
+        return [row[SourceListColumns.SOURCE_ID], vista_id if vista_id is not None else -1]
+
     def __format_source(self, row):
         source = {
             "source_id": row[SourceListColumns.SOURCE_ID],
@@ -145,6 +143,13 @@ limit
 
         maxObjects = computeOptions.get_argument("maxObjects", 1000)
 
+        if pagination.is_requested(computeOptions):
+            page_size = pagination.get_page_size(args["webconfig"], computeOptions)
+            after = pagination.get_page_token(computeOptions, 2)
+            rows = self.__query(args["webconfig"], maxLat, maxLon, minLat, minLon, page_size + 1,
+                                after=after, paged=True)
+            rows, next_page_token = pagination.page(rows, page_size, self.__page_key)
+            return SimpleResults(pagination.envelope([self.__format_source(row) for row in rows], next_page_token))
 
         rows = self.__query(args["webconfig"], maxLat, maxLon, minLat, minLon, maxObjects)
 
@@ -4,9 +4,10 @@ California Institute of Technology.  All rights reserved
 """
 
 import json
-from msfbe.webmodel import BaseHandler, service_handler
+from msfbe.webmodel import BaseHandler, service_handler, SimpleResults
 from datetime import datetime
-import psycopg2
+from msfbe import dbpool
+from msfbe import projection
 from msfbe.queryhandlers import *
 
 
@@ -19,13 +20,6 @@ class DetectionRatesBySectorColumns:
     UNIQUE_FACILITIES_FLOWN_OVER = 4
     UNIQUE_FACILITIES_WITH_PLUME_DETECTIONS = 5
 
-class SimpleResult(object):
-    def __init__(self, result):
-        self.result = result
-
-    def toJson(self):
-        return json.dumps(self.result)
-
 @service_handler
 class StatsHandlerImpl(BaseHandler):
     name = "Detection Rates by Sector"
@@ -33,6 +27,9 @@ class StatsHandlerImpl(BaseHandler):
     description = ""
     params = {}
     singleton = True
+    executor = "stats"
+    cache_ttl = 3600
+    cache_control = "public, max-age=300"
 
     def __init__(self):
         BaseHandler.__init__(self)
@@ -42,13 +39,6 @@ class StatsHandlerImpl(BaseHandler):
         return dt.strftime("%Y-%m-%d")
 
     def __query(self, config, county=None, sector=None, subsector=None, from_date=None, to_date=None):
-        conn = psycopg2.connect(dbname=config.get("database", "db.database"),
-                                user=config.get("database", "db.username"),
-                                password=config.get("database", "db.password"),
-                                host=config.get("database", "db.endpoint"),
-                                port=config.get("database", "db.port"))
-        cur = conn.cursor()
-
         county = "" if county is None else county
         sector = "" if sector is None else sector
         subsector = "" if subsector is None else subsector
@@ -82,22 +72,20 @@ group by
   v.sector_level_2;
         """
 
-        cur.execute(sql,
-                    (
-                        from_date,
-                        to_date,
-                        from_date,
-                        to_date,
-                        "%{county}%".format(county=county),
-                        "%{sector}%".format(sector=sector),
-                        "%{subsector}%".format(subsector=subsector)
-                    )
-                    )
-
-        results = cur.fetchall()
-
-        cur.close()
-        conn.close()
+        with dbpool.cursor(config) as cur:
+            cur.execute(sql,
+                        (
+                            from_date,
+                            to_date,
+                            from_date,
+                            to_date,
+                            "%{county}%".format(county=county),
+                            "%{sector}%".format(sector=sector),
+                            "%{subsector}%".format(subsector=subsector)
+                        )
+                        )
+
+            results = cur.fetchall()
 
         return results
 
@@ -129,7 +117,7 @@ group by
         results = self.__format_results(rows)
 
 
-        return SimpleResult(results)
+        return SimpleResults(results)
 
 
 
@@ -188,17 +176,12 @@ class FlyoverOfSourceHandlerImpl(BaseHandler):
     description = ""
     params = {}
     singleton = True
+    executor = "stats"
 
     def __init__(self):
         BaseHandler.__init__(self)
 
     def __query(self, config, source_id):
-        conn = psycopg2.connect(dbname=config.get("database", "db.database"),
-                                user=config.get("database", "db.username"),
-                                password=config.get("database", "db.password"),
-                                host=config.get("database", "db.endpoint"),
-                                port=config.get("database", "db.port"))
-        cur = conn.cursor()
         sql = """
 select
   s.source_id,
@@ -254,12 +237,10 @@ where
   s.source_id = %s;
                 """
 
-        cur.execute(sql,(source_id,))
-
-        results = cur.fetchall()
+        with dbpool.cursor(config) as cur:
+            cur.execute(sql,(source_id,))
 
-        cur.close()
-        conn.close()
+            results = cur.fetchall()
 
         return results
 
@@ -311,7 +292,7 @@ where
 
         results = self.__format_results(rows, s3url)
 
-        return SimpleResult(results)
+        return SimpleResults(results)
 
 
 
@@ -342,6 +323,63 @@ class FlyoversOfFacilityColumns:
     RGBQLCTR_URL_THUMB = 23
 
 
+# Select list of the flyovers query, in the order of FlyoversOfFacilityColumns
+FLYOVERS_OF_FACILITY_SELECT = [
+    "v.vista_id",
+    "v.category_id",
+    "v.category",
+    "v.name",
+    "v.operator",
+    "v.site_name",
+    "v.state",
+    "v.address",
+    "v.sector",
+    "v.city",
+    "f.flightline_id",
+    "to_char(f.flight_timestamp, 'yyyy-mm-dd HH24:MI:SS') as flight_timestamp",
+    "p.plume_id",
+    "p.flux",
+    "p.flux_uncertainty",
+    "p.candidate_id",
+    "to_char(p.detection_timestamp, 'yyyy-mm-dd HH24:MI:SS') as detection_timestamp",
+    "p.source_id",
+    "p.plume_id is not null as plume_detected",
+    "v.sector_level_1",
+    "v.sector_level_2",
+    "v.sector_level_3",
+    "ap.rgbqlctr_url",
+    "ap.rgbqlctr_url_thumb"
+]
+
+FLYOVERS_OF_FACILITY_FIELD_COLUMNS = {
+    "facility_id": FlyoversOfFacilityColumns.FACILITY_ID,
+    "facility_category_id": FlyoversOfFacilityColumns.FACILITY_CATEGORY_ID,
+    "facility_category": FlyoversOfFacilityColumns.FACILITY_CATEGORY,
+    "facility_name": FlyoversOfFacilityColumns.FACILITY_NAME,
+    "facility_operator": FlyoversOfFacilityColumns.FACILITY_OPERATOR,
+    "facility_site_name": FlyoversOfFacilityColumns.FACILITY_SITE_NAME,
+    "facility_state": FlyoversOfFacilityColumns.FACILITY_STATE,
+    "facility_address": FlyoversOfFacilityColumns.FACILITY_ADDRESS,
+    "facility_sector": FlyoversOfFacilityColumns.FACILITY_SECTOR,
+    "facility_city": FlyoversOfFacilityColumns.FACILITY_CITY,
+    "flightline_id": FlyoversOfFacilityColumns.FLIGHTLINE_ID,
+    "flightline_date": FlyoversOfFacilityColumns.FLIGHTLINE_DATE,
+    "plume_id": FlyoversOfFacilityColumns.PLUME_ID,
+    "flux": FlyoversOfFacilityColumns.FLUX,
+    "flux_uncertainty": FlyoversOfFacilityColumns.FLUX_UNCERTAINTY,
+    "aviris_plume_id": FlyoversOfFacilityColumns.CANDIDATE_ID,
+    "candidate_id": FlyoversOfFacilityColumns.CANDIDATE_ID,
+    "plume_date": FlyoversOfFacilityColumns.PLUME_DATE,
+    "source_id": FlyoversOfFacilityColumns.SOURCE_ID,
+    "plume_detected": FlyoversOfFacilityColumns.PLUME_DETECTED,
+    "sector_level_1": FlyoversOfFacilityColumns.SECTOR_LEVEL_1,
+    "sector_level_2": FlyoversOfFacilityColumns.SECTOR_LEVEL_2,
+    "sector_level_3": FlyoversOfFacilityColumns.SECTOR_LEVEL_3,
+    "rgbqlctr_url": FlyoversOfFacilityColumns.RGBQLCTR_URL,
+    "rgbqlctr_url_thumb": FlyoversOfFacilityColumns.RGBQLCTR_URL_THUMB
+}
+
+
 @service_handler
 class FlyoversOfFacilityHandlerImpl(BaseHandler):
     name = "Flyovers of Facility"
@@ -349,45 +387,28 @@ class FlyoversOfFacilityHandlerImpl(BaseHandler):
     description = ""
     params = {}
     singleton = True
+    executor = "stats"
 
     def __init__(self):
         BaseHandler.__init__(self)
 
 
-    def __query(self, config, vista_id):
-        conn = psycopg2.connect(dbname=config.get("database", "db.database"),
-                                user=config.get("database", "db.username"),
-                                password=config.get("database", "db.password"),
-                                host=config.get("database", "db.endpoint"),
-                                port=config.get("database", "db.port"))
-        cur = conn.cursor()
+    def __query(self, config, vista_id, fields=None):
+        if fields is None:
+            needed = range(len(FLYOVERS_OF_FACILITY_SELECT))
+        else:
+            needed = projection.needed_columns(fields, FLYOVERS_OF_FACILITY_FIELD_COLUMNS)
 
+        # Rows are made distinct over every column before the projection, so that requesting
+        # fewer fields returns the same rows in the same order
+        aliases = ["c%d" % i for i in range(len(FLYOVERS_OF_FACILITY_SELECT))]
+        order_by = "c%d,\n  c%d" % (FlyoversOfFacilityColumns.FLIGHTLINE_DATE, FlyoversOfFacilityColumns.PLUME_DATE)
         sql = """
+select
+  """ + projection.select_list(aliases, needed) + """
+from (
 select distinct
-  v.vista_id,
-  v.category_id,
-  v.category,
-  v.name,
-  v.operator,
-  v.site_name,
-  v.state,
-  v.address,
-  v.sector,
-  v.city,
-  f.flightline_id,
-  to_char(f.flight_timestamp, 'yyyy-mm-dd HH24:MI:SS') as flight_timestamp,
-  p.plume_id,
-  p.flux,
-  p.flux_uncertainty,
-  p.candidate_id,
-  to_char(p.detection_timestamp, 'yyyy-mm-dd HH24:MI:SS') as detection_timestamp,
-  p.source_id,
-  p.plume_id is not null as plume_detected,
-  v.sector_level_1,
-  v.sector_level_2,
-  v.sector_level_3,
-  ap.rgbqlctr_url,
-  ap.rgbqlctr_url_thumb
+  """ + ",\n  ".join(FLYOVERS_OF_FACILITY_SELECT) + """
 from
   vista as v
   inner join vista_flightlines vf on v.id = vf.vista_id
@@ -401,17 +422,15 @@ from
       and ap.candidate_id is not null
 where
   v.vista_id = %s
+) as _q(""" + ", ".join(aliases) + """)
 order by
-  flight_timestamp,
-  detection_timestamp;    
+  """ + order_by + """;
         """
 
-        cur.execute(sql, (vista_id,))
+        with dbpool.cursor(config) as cur:
+            cur.execute(sql, (vista_id,))
 
-        results = cur.fetchall()
-
-        cur.close()
-        conn.close()
+            results = cur.fetchall()
 
         return results
 
@@ -457,38 +476,31 @@ order by
 
     def handle(self, computeOptions, **args):
         vista_id = computeOptions.get_argument("vista_id", None)
+        fields = projection.get_fields(computeOptions, FLYOVERS_OF_FACILITY_FIELD_COLUMNS)
 
-        rows = self.__query(args["webconfig"], vista_id)
+        rows = self.__query(args["webconfig"], vista_id, fields)
         s3url = args["webconfig"].get("s3", "s3.proxyurl")
 
         results = self.__format_results(rows, s3url)
+        if fields is not None:
+            results = [projection.project(result, fields) for result in results]
 
-        return SimpleResult(results)
-
+        return SimpleResults(results)
 
 
 
 
 
 
-def filter_null_results(row, params):
-    if row["vista_id"] is None\
-                and (      params["sector_level_1"] != "%"
-                        or params["sector_level_2"] != "%"
-                        or params["sector_level_3"] != "%"
-                        or params["vista_category"] != "%"):
-        return None
-    else:
-        return row
 
+# Sources without a matching facility are only listed when no facility criteria are given
+filter_null_results = where_not_null("vista_id", unless_params_default=[
+    "sector_level_1",
+    "sector_level_2",
+    "sector_level_3",
+    "vista_category"
+])
 
-def replace_nulls_with_zero_length_string(row, params):
-    if row is not None:
-        for key in row:
-            value = row[key]
-            if value is None:
-                row[key] = ""
-    return row
 
 create_query_based_handler(
     uri="/methanePlumeSources",
@@ -554,8 +566,11 @@ create_query_based_handler(
     ],
     filters=[
         filter_null_results,
-        replace_nulls_with_zero_length_string
-    ]
+        coalesce_empty("vista_name", "vista_id", "vista_category", "sector_level_1", "sector_level_2",
+                       "sector_level_3", "county_name")
+    ],
+    sort_key=["source_id", "county_name"],
+    executor="stats"
 )
 
 
@@ -571,7 +586,9 @@ create_query_based_handler(
       s.q_source_final,
       s.q_source_final_sigma,
       s.confidence_in_persistence,
-      v.vista_id
+      v.vista_id,
+      c.coname as county_name,
+      v.sector_level_1
     from
       sources as s
       left join vista as v
@@ -602,7 +619,9 @@ create_query_based_handler(
         column("avg_q_source_final", 3),
         column("avg_q_source_final_sigma", 4),
         column("avg_confidence_in_persistence", 5),
-        column("vista_id", 6)
+        column("vista_id", 6),
+        column("county_name", 7),
+        column("sector_level_1", 8)
     ],
     filters=[
         filter_null_results
@@ -614,7 +633,14 @@ create_query_based_handler(
         summary("avg_q_source_final", SummaryTypes.AVERAGE),
         summary("avg_q_source_final_sigma", SummaryTypes.AVERAGE),
         summary("avg_confidence_in_persistence", SummaryTypes.AVERAGE)
-    ]
+    ],
+    group_by=[
+        "county_name",
+        "sector_level_1"
+    ],
+    executor="stats",
+    cache_ttl=3600,
+    cache_control="public, max-age=300"
 )
 
 
@@ -653,6 +679,7 @@ class EmissionsBySourceHandlerImpl(BaseHandler):
     description = ""
     params = {}
     singleton = True
+    executor = "stats"
 
     def __init__(self):
         BaseHandler.__init__(self)
@@ -665,13 +692,6 @@ class EmissionsBySourceHandlerImpl(BaseHandler):
         to_date = "now()" if to_date is None else self.__format_dt(to_date)
         from_date = "1970-01-01" if from_date is None else self.__format_dt(from_date)
 
-        conn = psycopg2.connect(dbname=config.get("database", "db.database"),
-                                user=config.get("database", "db.username"),
-                                password=config.get("database", "db.password"),
-                                host=config.get("database", "db.endpoint"),
-                                port=config.get("database", "db.port"))
-        cur = conn.cursor()
-
         sql = """
 select distinct
   s.source_id,
@@ -707,20 +727,18 @@ group by
   s.nearest_facility;
         """
 
-        cur.execute(sql,
-                    (
-                        from_date,
-                        to_date,
-                        "%{county}%".format(county=county),
-                        "%{sector}%".format(sector=sector),
-                        "%{subsector}%".format(subsector=subsector)
-                    )
-                    )
-
-        results = cur.fetchall()
+        with dbpool.cursor(config) as cur:
+            cur.execute(sql,
+                        (
+                            from_date,
+                            to_date,
+                            "%{county}%".format(county=county),
+                            "%{sector}%".format(sector=sector),
+                            "%{subsector}%".format(subsector=subsector)
+                        )
+                        )
 
-        cur.close()
-        conn.close()
+            results = cur.fetchall()
 
         return results
 
@@ -751,4 +769,4 @@ group by
         to_date = computeOptions.get_datetime_arg("to_date", None)
         rows = self.__query(args["webconfig"], county, sector, subsector, from_date, to_date)
         results = self.__format_results(rows)
-        return SimpleResult(results)
\ No newline at end of file
+        return SimpleResults(results)
\ No newline at end of file
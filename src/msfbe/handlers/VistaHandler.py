@@ -4,9 +4,12 @@ California Institute of Technology.  All rights reserved
 """
 
 import json
-from msfbe.webmodel import BaseHandler, service_handler
-import psycopg2
-from osgeo import gdal,ogr,osr
+from msfbe.webmodel import BaseHandler, service_handler, SimpleResults, StreamingResults, BinaryResults, feature_collection_chunks
+from msfbe.serialization import RawJson
+from msfbe import dbpool
+from msfbe import geometry
+from msfbe import maintenance
+from msfbe import tiles
 
 
 VISTA_ID = 0
@@ -22,24 +25,15 @@ ADDRESS = 9
 STATE = 10
 SECTOR = 11
 CITY = 12
-SOURCE_ID = 13
-FACILITY_POLY_CONTAINS_SOURCE = 14
-DISTANCE = 15
-AREA_NAME = 16
-SOURCE_TYPE = 17
-SOURCE_LATITUDE = 18
-SOURCE_LONGITUDE = 19
-SECTOR_LEVEL_1 = 20
-SECTOR_LEVEL_2 = 21
-SECTOR_LEVEL_3 = 22
-NEAREST_FACILITY = 23
-FLYOVER_COUNT = 24
-PLUME_COUNT = 25
-PLUME_SHAPE_WKT = 26
-GEOJSON = 27
-INTERNAL_ID = 28
-PROPERTY_NAME = 28
-PROPERTY_VALUE = 29
+SOURCES_JSON = 13
+FLYOVER_COUNT = 14
+PLUME_COUNT = 15
+GEOJSON = 16
+INTERNAL_ID = 17
+SIMPLIFIED_GEOMETRY = 18
+
+# Decimals of the LLat and LLong metadata
+METADATA_DECIMALS = 5
 
 
 
@@ -71,22 +65,6 @@ class VistaHandlerImpl(BaseHandler):
     def __init__(self):
         BaseHandler.__init__(self)
 
-    @staticmethod
-    def __open_db_connection(config):
-        conn = psycopg2.connect(dbname=config.get("database", "db.database"),
-                                user=config.get("database", "db.username"),
-                                password=config.get("database", "db.password"),
-                                host=config.get("database", "db.endpoint"),
-                                port=config.get("database", "db.port"))
-        cur = conn.cursor()
-
-        return conn, cur
-
-    @staticmethod
-    def __close_db_connection(conn, cur):
-        cur.close()
-        conn.close()
-
     @staticmethod
     def __parse_field_query_results(cur):
         results = []
@@ -96,10 +74,6 @@ class VistaHandlerImpl(BaseHandler):
             if row is None:
                 break
 
-            shape_wkt = row[FieldBoundaryColumns.FIELD_SHAPE]
-            shape_geom = ogr.CreateGeometryFromWkt(shape_wkt)
-            geojson = json.loads(shape_geom.ExportToJson())
-
             item = {
                 "type": "Feature",
                 "properties": {
@@ -111,7 +85,7 @@ class VistaHandlerImpl(BaseHandler):
                     "category": "Field_Boundaries",
                     "category_id": 1000
                 },
-                "geometry" : geojson,
+                "geometry" : geometry.geojson(row[FieldBoundaryColumns.FIELD_SHAPE]),
                 "id": row[FieldBoundaryColumns.ID]
             }
 
@@ -120,57 +94,42 @@ class VistaHandlerImpl(BaseHandler):
         return results
 
     @staticmethod
-    def __parse_vista_query_results(cur, maxObjects, includeProperties=False):
-        results = []
-
-        curr_vista_id = None
+    def __format_vista(row, decimals=None):
+        item = json.loads(row[GEOJSON])
+        metadata_decimals = METADATA_DECIMALS
+        if decimals is not None:
+            item["geometry"] = geometry.geojson(row[SIMPLIFIED_GEOMETRY])
+            metadata_decimals = min(decimals, METADATA_DECIMALS)
+        item["properties"] = {
+            "name": row[VISTA_NAME],
+            "id": row[VISTA_ID],
+            "internal_id": row[INTERNAL_ID],
+            "category_id": row[CATEGORY_ID],
+            "category": row[CATEGORY],
+            "num_flights_matching": row[FLYOVER_COUNT],
+            "num_plumes_matching": row[PLUME_COUNT],
+            "description": None,
+            "metadata": {
+                "LLat": str(geometry.round_coordinate(row[LATITUDE], metadata_decimals)),
+                "LLong": str(geometry.round_coordinate(row[LONGITUDE], metadata_decimals))
+            },
+            # Aggregated to a JSON object keyed by source id in SQL
+            "sources": RawJson(row[SOURCES_JSON])
+        }
+        return item
 
-        while True:
-            row = cur.fetchone()
-            if row is None:
-                break
-            if row[VISTA_ID] != curr_vista_id:
-                if len(results) >= maxObjects:
-                    break
-                item = json.loads(row[GEOJSON])
-                item["properties"] = {
-                    "name": row[VISTA_NAME],
-                    "id": row[VISTA_ID],
-                    "internal_id": row[INTERNAL_ID],
-                    "category_id": row[CATEGORY_ID],
-                    "category": row[CATEGORY],
-                    "num_flights_matching": row[FLYOVER_COUNT],
-                    "num_plumes_matching": row[PLUME_COUNT],
-                    "description": None,
-                    "metadata": {
-                        "LLat": str(round(row[LATITUDE] * 100000) / 100000),
-                        "LLong": str(round(row[LONGITUDE] * 100000) / 100000)
-                    },
-                    "sources": {}
-                }
-                results.append(item)
-                curr_vista_id = row[VISTA_ID]
-
-
-            if includeProperties:
-                item["properties"]["metadata"][row[PROPERTY_NAME]] = row[PROPERTY_VALUE]
-
-
-            if row[SOURCE_ID] is not None:
-                item["properties"]["sources"][row[SOURCE_ID]] = {
-                    "id": row[SOURCE_ID],
-                    "lat": row[SOURCE_LATITUDE],
-                    "lon": row[SOURCE_LONGITUDE],
-                    "area": row[AREA_NAME],
-                    "type": row[SOURCE_TYPE],
-                    "est_dist_from_facility": row[DISTANCE],
-                    "sector_level_1": row[SECTOR_LEVEL_1],
-                    "sector_level_2": row[SECTOR_LEVEL_2],
-                    "sector_level_3": row[SECTOR_LEVEL_3],
-                    "internal_id": row[SOURCE_ID]
-                }
+    @staticmethod
+    def __iter_vista_query_results(cur, decimals=None):
+        """
+        Yields one feature per row. Rows are consumed as the cursor is iterated, so this works
+        with server-side cursors as well.
+        """
+        for row in cur:
+            yield VistaHandlerImpl.__format_vista(row, decimals)
 
-        return results
+    @staticmethod
+    def __parse_vista_query_results(cur, decimals=None):
+        return list(VistaHandlerImpl.__iter_vista_query_results(cur, decimals))
 
     @staticmethod
     def __parse_vista_metadata_query_results(cur, results={}):
@@ -192,70 +151,104 @@ class VistaHandlerImpl(BaseHandler):
         return results
 
     @staticmethod
-    def __query_single_object(config, vista_id):
-        conn, cur = VistaHandlerImpl.__open_db_connection(config)
+    def __select_sql(config, facilities_sql, source_filter="", simplification=None):
+        """
+        Selects one row per facility in the 'facilities' CTE, which yields vista.id in output
+        order, with its sources aggregated to a JSON object. 'source_filter' restricts which
+        sources are included. vista_sources may list a source more than once for a facility, so
+        the nearest of those rows is used to keep the keys of the object unique. With a
+        simplification, the geometry of the stored feature is also selected simplified.
+        """
+        if simplification is not None:
+            simplified = geometry.as_geojson_sql("ST_GeomFromGeoJSON(v.geojson::json->>'geometry')", simplification)
+        else:
+            simplified = "null"
 
-        sql = """
-        select
-          v.vista_id,
-          v.name,
-          v.site_name,
-          v.shape_type,
-          v.latitude,
-          v.longitude,
-          v.category,
-          v.category_id,
-          v.operator,
-          v.address,
-          v.state,
-          v.sector,
-          v.city,
-          vs.source_id,
-          vs.facility_poly_contains_source,
-          vs.distance,
-          s.area_name,
-          s.source_type,
-          s.source_latitude_deg,
-          s.source_longitude_deg,
-          s.sector_level_1,
-          s.sector_level_2,
-          s.sector_level_3,
-          s.nearest_facility,
-          vf.flyover_count,
-          vap.plume_count,
-          ST_asText(v.facility_envelope) as plume_shape_wkt,
-          v.geojson,
-          v.id
-        from
-          vista as v
-          left join vista_sources as vs
-              on vs.vista_id = v.id
-          left join sources as s
-              on s.source_id = vs.source_id
-          left join (select distinct vista_id, count(1) as flyover_count from vista_flightlines group by vista_id) as vf
-              on vf.vista_id = v.id
-          left join (select distinct vista_id, count(1) as plume_count from vista_aviris_plumes group by vista_id) as vap
-              on vap.vista_id = v.id
-        where
-          v.vista_id = %s;
-                """
+        return """
+with facilities as (""" + facilities_sql + """
+)
+select
+  v.vista_id,
+  v.name,
+  v.site_name,
+  v.shape_type,
+  v.latitude,
+  v.longitude,
+  v.category,
+  v.category_id,
+  v.operator,
+  v.address,
+  v.state,
+  v.sector,
+  v.city,
+  coalesce(vss.sources::text, '{}') as sources,
+  nullif(vc.flyover_count, 0) as flyover_count,
+  nullif(vc.plume_count, 0) as plume_count,
+  v.geojson,
+  v.id,
+  """ + simplified + """ as simplified_geometry
+from
+  facilities as f
+  join vista as v
+      on v.id = f.id
+  left join """ + maintenance.vista_counts_sql(config) + """ as vc
+      on vc.vista_id = v.id
+  left join lateral (
+    select
+      json_object_agg(vs.source_id, json_build_object(
+        'id', vs.source_id,
+        'lat', s.source_latitude_deg,
+        'lon', s.source_longitude_deg,
+        'area', s.area_name,
+        'type', s.source_type,
+        'est_dist_from_facility', vs.distance,
+        'sector_level_1', s.sector_level_1,
+        'sector_level_2', s.sector_level_2,
+        'sector_level_3', s.sector_level_3,
+        'internal_id', vs.source_id
+      ) order by vs.source_id) as sources
+    from (
+      select distinct on (vs.source_id)
+        vs.source_id,
+        vs.distance
+      from
+        vista_sources as vs
+      where
+        vs.vista_id = v.id
+        and vs.source_id is not null""" + source_filter.replace("\n", "\n  ") + """
+      order by
+        vs.source_id,
+        vs.distance
+    ) as vs
+      left join sources as s
+          on s.source_id = vs.source_id
+  ) as vss on true
+order by
+  v.id;
+        """
 
-        cur.execute(sql, (vista_id,))
+    @staticmethod
+    def __query_single_object(config, vista_id, simplification=None):
+        sql = VistaHandlerImpl.__select_sql(config, """
+  select v.id from vista as v where v.vista_id = %(vista_id)s""", simplification=simplification)
+
+        params = {"vista_id": vista_id}
+        if simplification is not None:
+            params.update(simplification)
 
-        results = VistaHandlerImpl.__parse_vista_query_results(cur, 1, includeProperties=False)
+        with dbpool.cursor(config) as cur:
+            cur.execute(sql, params)
 
-        if len(results) == 1:
-            internal_id = results[0]["properties"]["internal_id"]
-            results[0]["properties"]["metadata"] = VistaHandlerImpl.__query_vista_metadata(cur, internal_id, {"LLat":results[0]["properties"]["metadata"]["LLat"], "LLong":results[0]["properties"]["metadata"]["LLong"]})
+            results = VistaHandlerImpl.__parse_vista_query_results(cur, geometry.decimals(simplification))
 
-        VistaHandlerImpl.__close_db_connection(conn, cur)
+            if len(results) == 1:
+                internal_id = results[0]["properties"]["internal_id"]
+                results[0]["properties"]["metadata"] = VistaHandlerImpl.__query_vista_metadata(cur, internal_id, {"LLat":results[0]["properties"]["metadata"]["LLat"], "LLong":results[0]["properties"]["metadata"]["LLong"]})
 
         return results
 
     @staticmethod
     def __query_fields(config, maxLat, maxLon, minLat, minLon):
-        conn, cur = VistaHandlerImpl.__open_db_connection(config)
-
         sql = """
         select
   fb.id,
@@ -264,107 +257,81 @@ class VistaHandlerImpl(BaseHandler):
   fb.area_acre,
   fb.perimeter,
   fb.district,
-  ST_asText(fb.field_envelope) as field_envelope_wkt,
-  ST_asText(fb.field_shape) as field_shape_wkt
+  null as field_envelope,
+  """ + geometry.as_geojson_sql("fb.field_shape") + """ as field_shape_geojson
 from
   field_boundaries as fb
 where
   ST_Intersects(fb.field_envelope , ST_MakeEnvelope(%s, %s, %s, %s, 4326));
         """
 
-        cur.execute(sql,
-                    (
-                        minLon,
-                        minLat,
-                        maxLon,
-                        maxLat
-                    )
-                    )
+        with dbpool.cursor(config) as cur:
+            cur.execute(sql,
+                        (
+                            minLon,
+                            minLat,
+                            maxLon,
+                            maxLat
+                        )
+                        )
 
-        results = VistaHandlerImpl.__parse_field_query_results(cur)
-        VistaHandlerImpl.__close_db_connection(conn, cur)
+            results = VistaHandlerImpl.__parse_field_query_results(cur)
 
         return results
 
     @staticmethod
-    def __query(config, maxLat, maxLon, minLat, minLon, category, maxObjects, source_id):
-        conn, cur = VistaHandlerImpl.__open_db_connection(config)
+    def __build_query(config, maxLat, maxLon, minLat, minLon, category, source_id, maxObjects, simplification=None):
+        # Facilities are limited before their sources are joined, so that only maxObjects
+        # facilities are read no matter how many intersect the bounding box
+        sql = VistaHandlerImpl.__select_sql(config, """
+  select
+    v.id
+  from
+    vista as v
+  where
+    ST_Intersects(v.facility_envelope, ST_MakeEnvelope(%(minLon)s, %(minLat)s, %(maxLon)s, %(maxLat)s, 4326))
+    and (%(category)s::integer[] is null or v.category_id = any(%(category)s::integer[]))
+    and (%(source_id)s::text[] is null or exists (
+      select 1 from vista_sources as vs where vs.vista_id = v.id and vs.source_id = any(%(source_id)s::text[])))
+  order by
+    v.id
+  limit %(maxObjects)s""", """
+      and (%(source_id)s::text[] is null or vs.source_id = any(%(source_id)s::text[]))""", simplification)
+
+        # The lists are bound as arrays so that the SQL text is the same for every request
+        params = {
+            "minLon": minLon,
+            "minLat": minLat,
+            "maxLon": maxLon,
+            "maxLat": maxLat,
+            "source_id": list(source_id) if source_id is not None else None,
+            "category": list(category) if category is not None else None,
+            "maxObjects": maxObjects
+        }
+        if simplification is not None:
+            params.update(simplification)
+        return sql, params
 
-        sql = """
-select
-  v.vista_id,
-  v.name,
-  v.site_name,
-  v.shape_type,
-  v.latitude,
-  v.longitude,
-  v.category,
-  v.category_id,
-  v.operator,
-  v.address,
-  v.state,
-  v.sector,
-  v.city,
-  vs.source_id,
-  vs.facility_poly_contains_source,
-  vs.distance,
-  s.area_name,
-  s.source_type,
-  s.source_latitude_deg,
-  s.source_longitude_deg,
-  s.sector_level_1,
-  s.sector_level_2,
-  s.sector_level_3,
-  s.nearest_facility,
-  vf.flyover_count,
-  vap.plume_count,
-  ST_asText(v.facility_envelope) as plume_shape_wkt,
-  v.geojson,
-  v.id
-from
-  vista as v
-  left join vista_sources as vs
-      on vs.vista_id = v.id
-  left join sources as s
-      on s.source_id = vs.source_id
-  left join (select distinct vista_id, count(1) as flyover_count from vista_flightlines group by vista_id) as vf
-      on vf.vista_id = v.id
-  left join (select distinct vista_id, count(1) as plume_count from vista_aviris_plumes group by vista_id) as vap
-      on vap.vista_id = v.id
-where
-  ST_Intersects(v.facility_envelope, ST_MakeEnvelope(%s, %s, %s, %s, 4326))        
-        {sourceidsql}
-        {categoryidsql};
-        """
-
-        if source_id is not None:
-            source_id = "'%s'" % "','".join(source_id)
-            sourceidsql = " and vs.source_id in (%s) " % source_id
-        else:
-            sourceidsql = ""
-
-        if category is not None:
-            categoryidsql = " and v.category_id in (%s) " % ", ".join(map(str, category))
-        else:
-            categoryidsql = ""
+    @staticmethod
+    def __query(config, maxLat, maxLon, minLat, minLon, category, maxObjects, source_id, simplification=None):
+        sql, params = VistaHandlerImpl.__build_query(config, maxLat, maxLon, minLat, minLon, category, source_id, maxObjects, simplification)
 
-        sql = sql.format(sourceidsql=sourceidsql, categoryidsql=categoryidsql)
+        with dbpool.cursor(config) as cur:
+            cur.execute(sql, params)
 
+            results = VistaHandlerImpl.__parse_vista_query_results(cur, geometry.decimals(simplification))
 
-        cur.execute(sql,
-                    (
-                        minLon,
-                        minLat,
-                        maxLon,
-                        maxLat
-                    )
-                    )
+        return results
 
-        results = VistaHandlerImpl.__parse_vista_query_results(cur, maxObjects, includeProperties=False)
+    @staticmethod
+    def __stream_query(config, maxLat, maxLon, minLat, minLon, category, maxObjects, source_id, simplification=None):
+        sql, params = VistaHandlerImpl.__build_query(config, maxLat, maxLon, minLat, minLon, category, source_id, maxObjects, simplification)
 
-        VistaHandlerImpl.__close_db_connection(conn, cur)
+        with dbpool.named_cursor(config) as cur:
+            cur.execute(sql, params)
 
-        return results
+            for item in VistaHandlerImpl.__iter_vista_query_results(cur, geometry.decimals(simplification)):
+                yield item
 
     def handle(self, computeOptions, **args):
 
@@ -383,28 +350,27 @@ where
             category = map(int, category.split(","))
 
         maxObjects = computeOptions.get_int_arg("maxObjects", 1000)
+        stream = computeOptions.get_boolean_arg("stream", False)
+        simplification = geometry.get_simplification(computeOptions)
+
+        if vista_id is None and stream is True and count_only is False:
+            return StreamingResults(feature_collection_chunks(
+                self.__stream_query(args["webconfig"], maxLat, maxLon, minLat, minLon, category, maxObjects, source_id, simplification)))
 
         if vista_id is None:
-            results = self.__query(args["webconfig"], maxLat, maxLon, minLat, minLon, category, maxObjects, source_id)
+            results = self.__query(args["webconfig"], maxLat, maxLon, minLat, minLon, category, maxObjects, source_id, simplification)
             #if 1000 in category:
             #    results_fields = self.__query_fields(args["webconfig"], maxLat, maxLon, minLat, minLon)
             #else:
             #    results_fields = []
             #results = results_vista + results_fields
         else:
-            results = self.__query_single_object(args["webconfig"], vista_id)
-
-        class SimpleResult(object):
-            def __init__(self, result):
-                self.result = result
-
-            def toJson(self):
-                return json.dumps(self.result)
+            results = self.__query_single_object(args["webconfig"], vista_id, simplification)
 
         geojson = results#self.__response_to_geojson(response)
 
         if count_only is True:
-            return SimpleResult({
+            return SimpleResults({
                 "count": len(geojson)
             })
         else:
@@ -419,4 +385,105 @@ where
                 "features": geojson
             }
 
-        return SimpleResult(geojson)
\ No newline at end of file
+        return SimpleResults(geojson)
+
+
+
+@service_handler
+class VistaTileHandlerImpl(BaseHandler):
+    name = "VISTA Vector Tile Service"
+    path = r"/vista/tiles/(\d+)/(\d+)/(\d+)\.mvt"
+    description = "VISTA facilities as Mapbox Vector Tiles"
+    params = {}
+    singleton = True
+    cache_control = "public, max-age=3600"
+
+    LAYER = "vista"
+    EXTENT = 4096
+    BUFFER = 64
+
+    def __init__(self):
+        BaseHandler.__init__(self)
+
+    @staticmethod
+    def __query(config, z, x, y, category, as_points):
+        xmin, ymin, xmax, ymax = tiles.tile_bounds(z, x, y)
+        margin = (xmax - xmin) * VistaTileHandlerImpl.BUFFER / VistaTileHandlerImpl.EXTENT
+
+        sql = """
+with features as (
+  select
+    v.id,
+    v.vista_id,
+    v.name,
+    v.category,
+    v.category_id,
+    v.sector_level_1,
+    v.sector_level_2,
+    v.sector_level_3,
+    count(distinct vs.source_id) as num_sources,
+    string_agg(distinct vs.source_id, ',' order by vs.source_id) as source_ids,
+    coalesce(vc.flyover_count, 0) as flyover_count,
+    coalesce(vc.plume_count, 0) as plume_count,
+    ST_AsMVTGeom(
+      ST_Transform(case when %(as_points)s then ST_PointOnSurface(v.facility_envelope) else v.facility_envelope end, 3857),
+      ST_MakeEnvelope(%(xmin)s, %(ymin)s, %(xmax)s, %(ymax)s, 3857),
+      %(extent)s, %(buffer)s, true) as geom
+  from
+    vista as v
+    left join vista_sources as vs
+        on vs.vista_id = v.id
+    left join """ + maintenance.vista_counts_sql(config) + """ as vc
+        on vc.vista_id = v.id
+  where
+    ST_Intersects(v.facility_envelope,
+                  ST_Transform(ST_MakeEnvelope(%(bxmin)s, %(bymin)s, %(bxmax)s, %(bymax)s, 3857), 4326))
+    and (%(category)s::integer[] is null or v.category_id = any(%(category)s::integer[]))
+  group by
+    v.id,
+    vc.vista_id,
+    vc.flyover_count,
+    vc.plume_count
+)
+select ST_AsMVT(features, %(layer)s, %(extent)s, 'geom') from features where geom is not null;
+        """
+
+        with dbpool.cursor(config) as cur:
+            cur.execute(sql, {
+                "xmin": xmin,
+                "ymin": ymin,
+                "xmax": xmax,
+                "ymax": ymax,
+                "bxmin": xmin - margin,
+                "bymin": ymin - margin,
+                "bxmax": xmax + margin,
+                "bymax": ymax + margin,
+                "extent": VistaTileHandlerImpl.EXTENT,
+                "buffer": VistaTileHandlerImpl.BUFFER,
+                "layer": VistaTileHandlerImpl.LAYER,
+                "as_points": as_points,
+                "category": category
+            })
+            row = cur.fetchone()
+
+        return bytes(row[0]) if row is not None and row[0] is not None else b""
+
+    def handle(self, computeOptions, **args):
+        config = args["webconfig"]
+        z, x, y = tiles.parse_tile(config, *computeOptions.get_path_args())
+
+        category = computeOptions.get_argument("category", None)
+        if category is not None and len(category) > 0:
+            category = sorted(set(map(int, category.split(","))))
+        else:
+            category = None
+        filters = {"category": category}
+
+        cached = tiles.get_cached(config, self.LAYER, z, x, y, filters)
+        if cached is not None:
+            body, last_modified = cached
+            return BinaryResults(body, tiles.CONTENT_TYPE, last_modified)
+
+        body = self.__query(config, z, x, y, category, z < tiles.point_zoom(config))
+        tiles.put_cached(config, self.LAYER, z, x, y, filters, body)
+        return BinaryResults(body, tiles.CONTENT_TYPE)
@@ -10,4 +10,5 @@ import msfbe.handlers.StatsHandler
 import msfbe.handlers.ListHandlers
 import msfbe.handlers.SourcesHandler
 import msfbe.handlers.PleiadesHandler
-import msfbe.handlers.ImageProxyHandler
\ No newline at end of file
+import msfbe.handlers.ImageProxyHandler
+import msfbe.handlers.AdminHandler
\ No newline at end of file
@@ -7,16 +7,28 @@ import logging
 import sys, os
 import traceback
 import tornado.web
+from tornado import gen
 from tornado.options import define, options, parse_command_line
 import ConfigParser
 import pkg_resources
 from tornado.httpserver import HTTPServer
 from tornado.ioloop import IOLoop
 import msfbe.webmodel as webmodel
-from msfbe.webmodel import RequestObject, ProcessingException
+from msfbe.webmodel import RequestObject, ProcessingException, RequestCancelled
+from msfbe.executors import get_executor, execution_mode, ExecutionModes
+import msfbe.cache as cache
+import msfbe.serialization as serialization
+import msfbe.metrics as metrics
+import msfbe.reqcontext as reqcontext
+import msfbe.profiling as profiling
+import msfbe.admission as admission
+from msfbe.singleflight import SingleFlight
 import importlib
 import signal
 import time
+import calendar
+import email.utils
+from datetime import datetime
 from functools import partial
 import psutil
 
@@ -33,24 +45,56 @@ class BaseRequestHandler(tornado.web.RequestHandler):
 
     def initialize(self):
         self.logger = logging.getLogger('nexus')
+        self.client_disconnected = False
 
-    def get(self):
-        self.run()
+    def on_connection_close(self):
+        self.client_disconnected = True
+        super(BaseRequestHandler, self).on_connection_close()
+
+    @gen.coroutine
+    def get(self, *args):
+        # Groups captured from the handler's path are available as RequestObject.get_path_args()
+        yield self.run()
+
+    @gen.coroutine
+    def post(self, *args):
+        yield self.run()
+
+    def allowed_methods(self):
+        return ("GET",)
 
+    @gen.coroutine
     def run(self):
         self.set_header("Access-Control-Allow-Origin", "*")
         reqObject = RequestObject(self)
         try:
-            result = self.do_get(reqObject)
+            if self.request.method not in self.allowed_methods():
+                raise ProcessingException(reason="Method not allowed", code=405,
+                                          headers={"Allow": ", ".join(self.allowed_methods())})
+            result = yield gen.maybe_future(self.do_get(reqObject))
             self.async_callback(result)
         except ProcessingException as e:
+            for name, value in e.headers.items():
+                self.set_header(name, value)
             self.async_onerror_callback(e.reason, e.code)
         except Exception as e:
             self.async_onerror_callback(str(e), 500)
 
     def async_onerror_callback(self, reason, code=500):
+        if self.client_disconnected:
+            self.logger.info("Request to %s abandoned by the client: %s" % (self.request.path, reason))
+            self.set_status(499, reason="Client Closed Request")
+            self.finish()
+            return
+
         self.logger.error("Error processing request", exc_info=True)
 
+        if self._headers_written:
+            # Part of a streamed response has already been sent; drop the connection so the
+            # client sees a truncated response rather than a body with an error appended.
+            self.request.connection.close()
+            return
+
         self.set_header("Content-Type", "application/json")
         self.set_status(code)
 
@@ -59,41 +103,307 @@ class BaseRequestHandler(tornado.web.RequestHandler):
             "code": code
         }
 
-        self.write(json.dumps(response, indent=5))
+        self.write(serialization.dumps(response))
         self.finish()
 
     def async_callback(self, result):
         self.finish()
 
-    ''' Override me for standard handlers! '''
+    ''' Override me for standard handlers! May return a Future. '''
     def do_get(self, reqObject):
         pass
 
 
 
 class ModularHandlerWrapper(BaseRequestHandler):
+    # Identical handler calls in flight in this process
+    single_flight = SingleFlight()
+
     def initialize(self, clazz=None, webconfig=None):
         BaseRequestHandler.initialize(self)
         self.__clazz = clazz
         self.__webconfig = webconfig
+        self.__context = reqcontext.RequestContext(clazz.path(), admission.statement_timeout(webconfig, clazz.path()))
+        self.__held_gates = []
+        self.__bytes_written = 0
+        self.__profile = None
+        self.__sampled = False
+        self.__shared_result = False
+        self.__flight = None
+
+    def allowed_methods(self):
+        return self.__clazz.methods()
+
+    def __profiled(self, fn, *args, **kwargs):
+        if self.__profile is None:
+            return fn(*args, **kwargs)
+        return self.__profile.runcall(fn, *args, **kwargs)
+
+    def __submit(self, fn, *args, **kwargs):
+        """
+        Runs handler code with the request context active (and under the profiler when the
+        request is being profiled), on the handler's executor when running in threadpool mode.
+        Returns a Future.
+        """
+        args = (fn,) + args
+        fn = self.__profiled
+        if execution_mode(self.__webconfig) != ExecutionModes.THREADPOOL:
+            return gen.maybe_future(reqcontext.run(self.__context, time.time(), fn, *args, **kwargs))
+        executor = get_executor(self.__webconfig, self.__clazz.executor())
+        return executor.submit(reqcontext.run, self.__context, time.time(), fn, *args, **kwargs)
+
+    @gen.coroutine
+    def __invoke(self, request):
+        """
+        Runs the handler once its admission gate lets the request through. The slot is released
+        when the handler returns or, for a streamed result, once the stream has been written.
+        """
+        gate = admission.get_gate(self.__webconfig, self.__clazz.path())
+        start = time.time()
+        yield gate.acquire()
+        self.__context.add_timing("admission", time.time() - start)
 
-    def do_get(self, request):
         instance = self.__clazz.instance()
-
-        results = instance.handle(request, webconfig=self.__webconfig)
-
         try:
-            self.set_status(results.status_code)
+            results = yield self.__submit(instance.handle, request, webconfig=self.__webconfig)
+        except Exception:
+            gate.release()
+            raise
+
+        if hasattr(results, "toJsonChunks"):
+            self.__held_gates.append(gate)
+        else:
+            gate.release()
+        raise gen.Return(results)
+
+    def __release_gates(self):
+        held, self.__held_gates = self.__held_gates, []
+        for gate in held:
+            gate.release()
+
+    @gen.coroutine
+    def __invoke_coalesced(self, request):
+        """
+        Invokes the handler, sharing the result with concurrent GET requests for the same path
+        and arguments unless the handler sets coalesce = False.
+        """
+        if not self.__clazz.coalesce() or self.__profile is not None or self.request.method != "GET":
+            results = yield self.__invoke(request)
+            raise gen.Return(results)
+
+        key = cache.cache_key(self.__clazz.path(), request)
+        self.__flight, shared = self.single_flight.join(key, lambda: self.__invoke(request), on_abandoned=self.__cancel)
+        try:
+            results = yield self.__flight.future
+        finally:
+            self.__flight = None
+
+        if shared and not self.client_disconnected:
+            if hasattr(results, "toJsonChunks"):
+                # A stream can only be written once; run the handler for this request
+                results = yield self.__invoke(request)
+            else:
+                self.__shared_result = True
+                self.set_header("X-Coalesced", "true")
+                metrics.REQUESTS_COALESCED.labels(self.__clazz.path()).inc()
+        raise gen.Return(results)
+
+    def __cancel(self):
+        """
+        Cancels the handler work for this request, including any running database statement.
+        """
+        cancelled = self.__context.cancel()
+        if cancelled > 0:
+            metrics.QUERIES_CANCELLED.labels(self.__clazz.path()).inc(cancelled)
+
+    def on_connection_close(self):
+        super(ModularHandlerWrapper, self).on_connection_close()
+        if self._finished:
+            return
+
+        metrics.REQUESTS_CANCELLED.labels(self.__clazz.path()).inc()
+        if self.__flight is not None:
+            # Work shared with other requests is only cancelled once none of them want it
+            self.single_flight.leave(self.__flight)
+        else:
+            self.__cancel()
+
+    def __next_chunk(self, chunks):
+        return self.__submit(next, chunks, None)
+
+    def __close_chunks(self, chunks):
+        if not hasattr(chunks, "close"):
+            return gen.maybe_future(None)
+        return self.__submit(chunks.close)
+
+    @gen.coroutine
+    def __write_stream(self, results):
+        """
+        Writes a streaming result with chunked transfer encoding, flushing each chunk to the
+        client before the next one is produced so memory use stays flat.
+        """
+        self.set_header("Content-Type", "application/json")
+        chunks = iter(results.toJsonChunks())
+        try:
+            while True:
+                chunk = yield self.__next_chunk(chunks)
+                if chunk is None:
+                    break
+                self.write(chunk)
+                start = time.time()
+                yield self.flush()
+                self.__context.add_timing("write", time.time() - start)
+        finally:
+            # Releases the database cursor if the stream was abandoned part way through
+            yield self.__close_chunks(chunks)
+            self.__release_gates()
+
+    def __cache_key(self, request):
+        ttl = self.__clazz.cache_ttl()
+        if not ttl or not cache.is_enabled(self.__webconfig) or request.get_content_type() != ContentTypes.JSON:
+            return None
+        if self.request.method != "GET":
+            return None
+        return cache.cache_key(self.__clazz.path(), request)
+
+    def __cache_control(self):
+        cache_control = self.__clazz.cache_control()
+        if cache_control is None and self.__webconfig.has_option("cache", "cache.default_cache_control"):
+            cache_control = self.__webconfig.get("cache", "cache.default_cache_control")
+        return cache_control
+
+    def __is_not_modified(self, last_modified):
+        if self.request.headers.get("If-None-Match") is not None:
+            return self.check_etag_header()
+
+        if_modified_since = self.request.headers.get("If-Modified-Since")
+        if if_modified_since is not None and last_modified is not None:
+            since = email.utils.parsedate(if_modified_since)
+            if since is not None:
+                return int(last_modified) <= calendar.timegm(since)
+        return False
+
+    def __set_validators(self, etag, last_modified=None):
+        """
+        Sets the ETag, Last-Modified and Cache-Control headers for a JSON or binary response
+        and answers a matching conditional GET with 304. Returns True when the body should not
+        be written. 'last_modified' is the creation time of the cache entry or the time the data
+        last changed; without one, Last-Modified is not sent and only the ETag is checked.
+
+        Only a cache hit answers 304 without producing the body. Otherwise the ETag is the hash
+        of the serialized body, so the handler runs and its results are serialized in full
+        before the request can be answered with 304.
+        """
+        self.set_header("Etag", etag)
+        if last_modified is not None:
+            self.set_header("Last-Modified", datetime.utcfromtimestamp(int(last_modified)))
+
+        cache_control = self.__cache_control()
+        if cache_control is not None:
+            self.set_header("Cache-Control", cache_control)
+
+        if self.__is_not_modified(last_modified):
+            self.set_status(304)
+            return True
+        return False
+
+    @gen.coroutine
+    def __profile_request(self, request):
+        """
+        Runs the handler and the JSON serialization of its result under the profiler, then
+        writes the profile instead of the response: the top-N functions by cumulative time, or
+        a pstats file with profile_format=pstats.
+        """
+        results = yield self.__invoke(request)
+
+        if hasattr(results, "toJsonChunks"):
+            chunks = iter(results.toJsonChunks())
+            try:
+                while True:
+                    chunk = yield self.__next_chunk(chunks)
+                    if chunk is None:
+                        break
+            finally:
+                yield self.__close_chunks(chunks)
+        elif hasattr(results, "toJson"):
+            yield self.__submit(results.toJson)
+
+        if request.get_argument("profile_format", profiling.ProfileFormats.TEXT) == profiling.ProfileFormats.PSTATS:
+            self.set_header("Content-Type", "application/octet-stream")
+            self.set_header("Content-Disposition", "attachment; filename=\"%s\"" % request.get_argument('filename', "profile.pstats"))
+            self.write(profiling.pstats_bytes(self.__profile))
+        else:
+            self.set_header("Content-Type", "text/plain")
+            self.write(profiling.top_stats(self.__profile, request.get_int_arg("profile_top", profiling.top_n(self.__webconfig))))
+        raise gen.Return(results)
+
+    @gen.coroutine
+    def do_get(self, request):
+        if profiling.is_requested(self.__webconfig, request):
+            self.__profile = profiling.new_profile()
+            results = yield self.__profile_request(request)
+            raise gen.Return(results)
+
+        key = self.__cache_key(request)
+        if key is not None:
+            entry = cache.get_cache(self.__webconfig).get(key)
+            if entry is not None:
+                self.set_header("Content-Type", entry.content_type)
+                self.set_header("X-Cache", "HIT")
+                if not self.__set_validators(entry.etag, entry.created):
+                    self.write(entry.body)
+                raise gen.Return(None)
+
+        if profiling.should_sample(self.__webconfig):
+            self.__profile = profiling.new_profile()
+            self.__sampled = True
+
+        results = yield self.__invoke_coalesced(request)
+
+        if self.client_disconnected:
+            # Nobody is waiting for the response; skip serializing it
+            raise RequestCancelled()
+
+        if request.get_content_type() == ContentTypes.JSON and hasattr(results, "toJsonChunks"):
+            yield self.__write_stream(results)
+            raise gen.Return(results)
+
+        if hasattr(results, "toBinary"):
+            self.set_header("Content-Type", results.content_type)
+            body = results.toBinary()
+            if not self.__set_validators(cache.compute_etag(body), results.last_modified):
+                self.write(body)
+            raise gen.Return(results)
+
+        status_code = 200
+        try:
+            status_code = results.status_code
+            self.set_status(status_code)
         except AttributeError:
             pass
 
         if request.get_content_type() == ContentTypes.JSON:
             self.set_header("Content-Type", "application/json")
+            pretty = request.get_boolean_arg("pretty", False)
+            start = time.time()
             try:
-                self.write(results.toJson())
+                body = self.__profiled(results.toJson, pretty=pretty)
             except AttributeError:
                 traceback.print_exc(file=sys.stdout)
-                self.write(json.dumps(results, indent=4))
+                body = serialization.dumps(results, pretty=pretty)
+            self.__context.add_timing("serialize", time.time() - start)
+            if status_code != 200:
+                self.write(body)
+            else:
+                etag = cache.compute_etag(body)
+                last_modified = None
+                if key is not None:
+                    self.set_header("X-Cache", "MISS")
+                    entry = cache.get_cache(self.__webconfig).put(key, body, "application/json", self.__clazz.cache_ttl(), etag)
+                    if entry is not None:
+                        last_modified = entry.created
+                if not self.__set_validators(etag, last_modified):
+                    self.write(body)
         elif request.get_content_type() == ContentTypes.PNG:
             self.set_header("Content-Type", "image/png")
             try:
@@ -126,13 +436,48 @@ class ModularHandlerWrapper(BaseRequestHandler):
                 traceback.print_exc(file=sys.stdout)
                 raise ProcessingException(reason="Unable to convert results to Zip.")
 
-        return results
+        raise gen.Return(results)
 
     def async_callback(self, result):
         super(ModularHandlerWrapper, self).async_callback(result)
-        if hasattr(result, 'cleanup'):
+        if hasattr(result, 'cleanup') and not self.__shared_result:
             result.cleanup()
 
+    def write(self, chunk):
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode("utf-8")
+        if isinstance(chunk, bytes):
+            self.__bytes_written += len(chunk)
+        super(ModularHandlerWrapper, self).write(chunk)
+
+    def on_finish(self):
+        self.__release_gates()
+
+        timings = self.__context.timings()
+
+        # Formatting is whatever the handler spent outside of the database. For streamed
+        # responses this includes serialization, which happens as the chunks are produced.
+        handler_seconds = timings.pop("handler", None)
+        if handler_seconds is not None:
+            timings["format"] = max(0.0, handler_seconds - timings.get("db_execute", 0.0) - timings.get("db_fetch", 0.0))
+        timings["total"] = self.request.request_time()
+
+        metrics.observe_request(self.__clazz.path(), timings, self.__bytes_written, self.get_status())
+
+        if self.__sampled:
+            profiling.save_sample(self.__webconfig, self.__profile, self.__clazz.path())
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """
+    Metrics for all server processes in the Prometheus text exposition format.
+    """
+    path = r"/metrics"
+
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(metrics.render())
+
 
 class MsfStaticFileHandler(tornado.web.StaticFileHandler):
 
@@ -181,6 +526,7 @@ if __name__ == "__main__":
 
     define("pgendpoint", default=webconfig.get("database", "db.endpoint"), type=str)
     define("pgport", default=webconfig.get("database", "db.port"), type=int)
+    define("pgdatabase", default=webconfig.get("database", "db.database"), type=str)
     define("pguser", default=webconfig.get("database", "db.username"), type=str)
     define("pgpassword", default=webconfig.get("database", "db.password"), type=str)
 
@@ -188,6 +534,9 @@ if __name__ == "__main__":
 
     parse_command_line()
 
+    if webconfig.has_option("global", "server.json_backend"):
+        serialization.set_backend(webconfig.get("global", "server.json_backend"))
+
     webconfig.set("database", "db.endpoint", options.pgendpoint)
     #webconfig.set("database", "db.username", options.pguser)
     #webconfig.set("database", "db.password", options.pgpassword)
@@ -195,6 +544,7 @@ if __name__ == "__main__":
     webconfig.set("database", "db.password", os.getenv('PG_PWD'))
 
     webconfig.set("database", "db.port", options.pgport)
+    webconfig.set("database", "db.database", options.pgdatabase)
 
     webconfig.set("s3", "s3.bucket", options.s3bucket)
 
@@ -228,6 +578,12 @@ if __name__ == "__main__":
             (clazzWrapper.path(), ModularHandlerWrapper,
              dict(clazz=clazzWrapper, webconfig=webconfig)))
 
+    # Per-path metrics are allocated now so that they are shared with the forked subprocesses
+    metrics.register_paths([clazzWrapper.path() for clazzWrapper in webmodel.AVAILABLE_HANDLERS])
+    admission.register_paths([clazzWrapper.path() for clazzWrapper in webmodel.AVAILABLE_HANDLERS])
+    if webconfig.has_option("metrics", "metrics.enabled") and webconfig.get("metrics", "metrics.enabled") == "true":
+        handlers.append((MetricsHandler.path, MetricsHandler))
+
     if staticEnabled:
         handlers.append(
             (r'/(.*)', MsfStaticFileHandler, {'path': staticDir, "default_filename": "index.html"}))
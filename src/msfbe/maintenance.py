@@ -0,0 +1,209 @@
+"""
+Copyright (c) 2021 Jet Propulsion Laboratory,
+California Institute of Technology.  All rights reserved
+
+Maintenance of derived tables, run after data loads rather than per request.
+
+vista_counts holds the number of flyovers and plumes of each VISTA facility, which the /vista
+queries join instead of counting vista_flightlines and vista_aviris_plumes in full. Statement
+level triggers on those two tables record the facilities a load touches in vista_counts_dirty,
+and refresh_vista_counts() recounts only those. The triggers use transition tables, so they
+need PostgreSQL 10 or later. Until vista_counts is created, the /vista queries count on each
+request as before.
+
+    python -m msfbe.maintenance --init --full     # once, to create and fill the tables
+    python -m msfbe.maintenance                   # after each load
+"""
+
+import argparse
+import logging
+import os
+import ConfigParser
+import pkg_resources
+from msfbe import dbpool
+from msfbe import tiles
+
+COUNTED_TABLES = ("vista_flightlines", "vista_aviris_plumes")
+
+SCHEMA_SQL = """
+create table if not exists vista_counts (
+    vista_id integer primary key references vista (id) on delete cascade,
+    flyover_count integer not null,
+    plume_count integer not null
+);
+
+create table if not exists vista_counts_dirty (
+    vista_id integer not null
+);
+
+create or replace function vista_counts_mark_dirty() returns trigger language plpgsql as $$
+begin
+    if TG_OP = 'INSERT' then
+        insert into vista_counts_dirty (vista_id) select distinct vista_id from new_rows;
+    elsif TG_OP = 'DELETE' then
+        insert into vista_counts_dirty (vista_id) select distinct vista_id from old_rows;
+    elsif TG_OP = 'UPDATE' then
+        insert into vista_counts_dirty (vista_id)
+        select vista_id from new_rows union select vista_id from old_rows;
+    else
+        insert into vista_counts_dirty (vista_id) select id from vista;
+    end if;
+    return null;
+end
+$$;
+"""
+
+TRIGGER_SQL = """
+drop trigger if exists {table}_counts_insert on {table};
+create trigger {table}_counts_insert after insert on {table}
+    referencing new table as new_rows
+    for each statement execute procedure vista_counts_mark_dirty();
+
+drop trigger if exists {table}_counts_delete on {table};
+create trigger {table}_counts_delete after delete on {table}
+    referencing old table as old_rows
+    for each statement execute procedure vista_counts_mark_dirty();
+
+drop trigger if exists {table}_counts_update on {table};
+create trigger {table}_counts_update after update on {table}
+    referencing old table as old_rows new table as new_rows
+    for each statement execute procedure vista_counts_mark_dirty();
+
+drop trigger if exists {table}_counts_truncate on {table};
+create trigger {table}_counts_truncate after truncate on {table}
+    for each statement execute procedure vista_counts_mark_dirty();
+"""
+
+# Claims the dirty facilities and recounts them. Markers added by loads that commit while this
+# runs are not visible to the delete, so they are left for the next refresh.
+REFRESH_SQL = """
+with dirty as (
+  delete from vista_counts_dirty returning vista_id
+)
+insert into vista_counts (vista_id, flyover_count, plume_count)
+select
+  v.id,
+  (select count(1) from vista_flightlines as vf where vf.vista_id = v.id),
+  (select count(1) from vista_aviris_plumes as vap where vap.vista_id = v.id)
+from
+  vista as v
+where
+  v.id in (select vista_id from dirty)
+on conflict (vista_id) do update set
+  flyover_count = excluded.flyover_count,
+  plume_count = excluded.plume_count;
+"""
+
+FULL_REFRESH_SQL = """
+delete from vista_counts_dirty;
+
+insert into vista_counts (vista_id, flyover_count, plume_count)
+select
+  v.id,
+  coalesce(vf.flyover_count, 0),
+  coalesce(vap.plume_count, 0)
+from
+  vista as v
+  left join (select vista_id, count(1) as flyover_count from vista_flightlines group by vista_id) as vf
+      on vf.vista_id = v.id
+  left join (select vista_id, count(1) as plume_count from vista_aviris_plumes group by vista_id) as vap
+      on vap.vista_id = v.id
+on conflict (vista_id) do update set
+  flyover_count = excluded.flyover_count,
+  plume_count = excluded.plume_count;
+"""
+
+# Stands in for vista_counts in databases where it has not been created
+COUNTS_FALLBACK_SQL = """(
+    select
+      cv.id as vista_id,
+      (select count(1) from vista_flightlines as vf where vf.vista_id = cv.id) as flyover_count,
+      (select count(1) from vista_aviris_plumes as vap where vap.vista_id = cv.id) as plume_count
+    from
+      vista as cv
+  )"""
+
+_vista_counts_exists = False
+
+
+def vista_counts_sql(webconfig):
+    """
+    Returns the relation to join for the flyover and plume counts of facilities: vista_counts,
+    or a subquery counting them if the table does not exist yet. Its columns are vista_id,
+    flyover_count and plume_count.
+    """
+    global _vista_counts_exists
+    if not _vista_counts_exists:
+        with dbpool.cursor(webconfig) as cur:
+            cur.execute("select to_regclass('vista_counts') is not null;")
+            _vista_counts_exists = cur.fetchone()[0]
+        if not _vista_counts_exists:
+            logging.getLogger(__name__).warning("vista_counts does not exist, counting flyovers and plumes per request; "
+                                                "create it with 'python -m msfbe.maintenance --init --full'")
+            return COUNTS_FALLBACK_SQL
+    return "vista_counts"
+
+
+def create_vista_counts(webconfig):
+    """
+    Creates vista_counts, vista_counts_dirty and the triggers that maintain the latter. Safe to
+    run again, e.g. after the counted tables are recreated.
+    """
+    with dbpool.connection(webconfig) as conn:
+        cur = conn.cursor()
+        cur.execute(SCHEMA_SQL)
+        for table in COUNTED_TABLES:
+            cur.execute(TRIGGER_SQL.format(table=table))
+        cur.close()
+        conn.commit()
+
+
+def refresh_vista_counts(webconfig, full=False):
+    """
+    Recounts the facilities whose flyovers or plumes changed since the last refresh, or every
+    facility if 'full', and flushes the tile cache, whose tiles include the counts. Returns the
+    number of facilities recounted.
+    """
+    with dbpool.connection(webconfig) as conn:
+        cur = conn.cursor()
+        cur.execute("select to_regclass('vista_counts') is not null;")
+        if not cur.fetchone()[0]:
+            raise Exception("vista_counts does not exist; create it with 'python -m msfbe.maintenance --init --full'")
+        cur.execute(FULL_REFRESH_SQL if full else REFRESH_SQL)
+        refreshed = cur.rowcount
+        cur.close()
+        conn.commit()
+
+    logging.getLogger(__name__).info("Refreshed flyover and plume counts of %s facilities" % refreshed)
+    if refreshed > 0:
+        tiles.flush_cache(webconfig)
+    return refreshed
+
+
+def main():
+    webconfig = ConfigParser.RawConfigParser()
+    webconfig.readfp(pkg_resources.resource_stream(__name__, "config.ini"), filename='config.ini')
+
+    parser = argparse.ArgumentParser(description="Refresh the per-facility flyover and plume counts")
+    parser.add_argument("--pgendpoint", default=webconfig.get("database", "db.endpoint"))
+    parser.add_argument("--pgport", default=webconfig.get("database", "db.port"))
+    parser.add_argument("--pgdatabase", default=webconfig.get("database", "db.database"))
+    parser.add_argument("--init", action="store_true", help="Create the counts tables and triggers first")
+    parser.add_argument("--full", action="store_true", help="Recount every facility")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    webconfig.set("database", "db.endpoint", args.pgendpoint)
+    webconfig.set("database", "db.port", args.pgport)
+    webconfig.set("database", "db.database", args.pgdatabase)
+    webconfig.set("database", "db.username", os.getenv('PG_USER'))
+    webconfig.set("database", "db.password", os.getenv('PG_PWD'))
+
+    if args.init:
+        create_vista_counts(webconfig)
+    refresh_vista_counts(webconfig, full=args.full)
+
+
+if __name__ == "__main__":
+    main()
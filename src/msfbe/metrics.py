@@ -0,0 +1,273 @@
+"""
+Copyright (c) 2021 Jet Propulsion Laboratory,
+California Institute of Technology.  All rights reserved
+
+Counters, gauges and histograms kept in shared memory so that the subprocesses forked by
+server.start() all update the same values and any of them can render the aggregate in the
+Prometheus text format. Metrics, and every label combination used with them, must be created
+before the fork; a label combination first seen afterwards is only visible in the process that
+created it.
+"""
+
+import logging
+import multiprocessing
+import os
+import threading
+
+DEFAULT_TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+DEFAULT_SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+
+REQUEST_STAGES = ("admission", "queue", "db_execute", "db_fetch", "format", "serialize", "write", "total")
+
+_registry = []
+_registry_lock = threading.Lock()
+_parent_pid = os.getpid()
+
+
+def _format_labels(labelnames, labelvalues, extra=None):
+    pairs = list(zip(labelnames, labelvalues))
+    if extra is not None:
+        pairs.append(extra)
+    if len(pairs) == 0:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in pairs)
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+class _Metric(object):
+    type_name = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = multiprocessing.Lock()
+        self._children = {}
+        self._children_lock = threading.Lock()
+        self.__warned = set()
+        if len(self.labelnames) == 0:
+            self._children[()] = self._create_child()
+
+    def _create_child(self):
+        raise NotImplementedError()
+
+    def labels(self, *labelvalues):
+        labelvalues = tuple(str(v) for v in labelvalues)
+        if len(labelvalues) != len(self.labelnames):
+            raise ValueError("Expected labels %s for metric %s" % (self.labelnames, self.name))
+
+        child = self._children.get(labelvalues)
+        if child is None:
+            with self._children_lock:
+                child = self._children.get(labelvalues)
+                if child is None:
+                    if os.getpid() != _parent_pid and labelvalues not in self.__warned:
+                        self.__warned.add(labelvalues)
+                        logging.getLogger(__name__).warning("Metric %s%s created after fork is not shared between processes" %
+                                                            (self.name, _format_labels(self.labelnames, labelvalues)))
+                    child = self._create_child()
+                    self._children[labelvalues] = child
+        return child
+
+    def _default_child(self):
+        return self._children[()]
+
+    def _render_child(self, labelvalues, child):
+        raise NotImplementedError()
+
+    def render(self):
+        lines = [
+            "# HELP %s %s" % (self.name, self.documentation),
+            "# TYPE %s %s" % (self.name, self.type_name)
+        ]
+        with self._children_lock:
+            children = sorted(self._children.items())
+        for labelvalues, child in children:
+            lines.extend(self._render_child(labelvalues, child))
+        return lines
+
+
+class _ValueChild(object):
+    def __init__(self, lock):
+        self.__lock = lock
+        self.__value = multiprocessing.RawValue('d', 0.0)
+
+    def inc(self, amount=1):
+        with self.__lock:
+            self.__value.value += amount
+
+    def dec(self, amount=1):
+        with self.__lock:
+            self.__value.value -= amount
+
+    def set(self, value):
+        with self.__lock:
+            self.__value.value = value
+
+    def get(self):
+        with self.__lock:
+            return self.__value.value
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def _create_child(self):
+        return _ValueChild(self._lock)
+
+    def inc(self, amount=1):
+        self._default_child().inc(amount)
+
+    def get(self):
+        return self._default_child().get()
+
+    def _render_child(self, labelvalues, child):
+        return ["%s%s %s" % (self.name, _format_labels(self.labelnames, labelvalues), _format_value(child.get()))]
+
+
+class Gauge(Counter):
+    """
+    Gauge summed across processes, e.g. the number of connections in use by all workers.
+    """
+    type_name = "gauge"
+
+    def dec(self, amount=1):
+        self._default_child().dec(amount)
+
+
+class _HistogramChild(object):
+    def __init__(self, lock, buckets):
+        self.__lock = lock
+        self.__buckets = buckets
+        # Per-bucket (non-cumulative) counts, then the +Inf bucket, sum and count
+        self.__values = multiprocessing.RawArray('d', len(buckets) + 3)
+
+    def observe(self, value):
+        index = len(self.__buckets)
+        for i, bound in enumerate(self.__buckets):
+            if value <= bound:
+                index = i
+                break
+        with self.__lock:
+            self.__values[index] += 1
+            self.__values[-2] += value
+            self.__values[-1] += 1
+
+    def snapshot(self):
+        with self.__lock:
+            return list(self.__values)
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_TIME_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        _Metric.__init__(self, name, documentation, labelnames)
+
+    def _create_child(self):
+        return _HistogramChild(self._lock, self.buckets)
+
+    def observe(self, value):
+        self._default_child().observe(value)
+
+    def _render_child(self, labelvalues, child):
+        values = child.snapshot()
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), values[:-2]):
+            cumulative += count
+            lines.append("%s_bucket%s %s" % (self.name,
+                                             _format_labels(self.labelnames, labelvalues, ("le", _format_value(bound))),
+                                             _format_value(cumulative)))
+        labels = _format_labels(self.labelnames, labelvalues)
+        lines.append("%s_sum%s %s" % (self.name, labels, _format_value(values[-2])))
+        lines.append("%s_count%s %s" % (self.name, labels, _format_value(values[-1])))
+        return lines
+
+
+def _register(metric):
+    with _registry_lock:
+        _registry.append(metric)
+    return metric
+
+
+def counter(name, documentation, labelnames=()):
+    return _register(Counter(name, documentation, labelnames))
+
+
+def gauge(name, documentation, labelnames=()):
+    return _register(Gauge(name, documentation, labelnames))
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_TIME_BUCKETS):
+    return _register(Histogram(name, documentation, labelnames, buckets))
+
+
+def render():
+    lines = []
+    with _registry_lock:
+        registered = list(_registry)
+    for metric in registered:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+REQUEST_STAGE_SECONDS = histogram("msfbe_request_stage_seconds",
+                                  "Time spent per request in each processing stage",
+                                  labelnames=("path", "stage"))
+RESPONSE_BYTES = histogram("msfbe_response_bytes",
+                           "Size of response bodies written",
+                           labelnames=("path",),
+                           buckets=DEFAULT_SIZE_BUCKETS)
+REQUESTS = counter("msfbe_requests_total",
+                   "Requests handled, by path and status code class",
+                   labelnames=("path", "status"))
+STATEMENT_TIMEOUTS = counter("msfbe_statement_timeouts_total",
+                             "Database statements cancelled by the handler's statement_timeout",
+                             labelnames=("path",))
+REQUESTS_CANCELLED = counter("msfbe_requests_cancelled_total",
+                             "Requests abandoned by the client before the response was complete",
+                             labelnames=("path",))
+QUERIES_CANCELLED = counter("msfbe_db_queries_cancelled_total",
+                            "Database statements cancelled because the client disconnected",
+                            labelnames=("path",))
+DB_EXECUTE_SECONDS = histogram("msfbe_db_execute_seconds",
+                                "Time spent executing database statements, by whether they ran as prepared statements",
+                                labelnames=("path", "prepared"))
+REQUESTS_COALESCED = counter("msfbe_requests_coalesced_total",
+                             "Requests answered with the result of an identical request already in flight",
+                             labelnames=("path",))
+
+
+def register_paths(paths):
+    """
+    Creates the per-path metrics for every handler path. Must be called before the server forks.
+    """
+    for path in paths:
+        for stage in REQUEST_STAGES:
+            REQUEST_STAGE_SECONDS.labels(path, stage)
+        RESPONSE_BYTES.labels(path)
+        REQUESTS_COALESCED.labels(path)
+        STATEMENT_TIMEOUTS.labels(path)
+        REQUESTS_CANCELLED.labels(path)
+        QUERIES_CANCELLED.labels(path)
+        DB_EXECUTE_SECONDS.labels(path, "true")
+        DB_EXECUTE_SECONDS.labels(path, "false")
+        for status in ("2xx", "3xx", "4xx", "5xx"):
+            REQUESTS.labels(path, status)
+
+
+def observe_request(path, timings, bytes_written=None, status_code=200):
+    for stage, seconds in timings.items():
+        REQUEST_STAGE_SECONDS.labels(path, stage).observe(seconds)
+    if bytes_written is not None:
+        RESPONSE_BYTES.labels(path).observe(bytes_written)
+    REQUESTS.labels(path, "%sxx" % (status_code // 100)).inc()
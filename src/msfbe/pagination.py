@@ -0,0 +1,87 @@
+"""
+Copyright (c) 2021 Jet Propulsion Laboratory,
+California Institute of Technology.  All rights reserved
+
+Keyset pagination. A client passes pageSize (and pageToken from the previous page) and gets
+
+    {"results": [...], "next_page_token": "..."}
+
+where next_page_token is null on the last page. Tokens are opaque to clients; they hold the
+sort key of the last row of the previous page, so each page is a range scan starting after it
+rather than an offset into the full result set.
+"""
+
+import base64
+import binascii
+import json
+from msfbe.webmodel import ProcessingException
+import msfbe.serialization as serialization
+
+PAGE_SIZE = "pageSize"
+PAGE_TOKEN = "pageToken"
+
+
+def _get_option(webconfig, option, default):
+    if webconfig.has_option("pagination", option):
+        return webconfig.get("pagination", option)
+    return default
+
+
+def is_requested(request):
+    return request.get_argument(PAGE_SIZE, None) is not None or request.get_argument(PAGE_TOKEN, None) is not None
+
+
+def get_page_size(webconfig, request):
+    default_page_size = int(_get_option(webconfig, "pagination.default_page_size", 1000))
+    max_page_size = int(_get_option(webconfig, "pagination.max_page_size", 10000))
+
+    try:
+        page_size = int(request.get_argument(PAGE_SIZE, default_page_size))
+    except ValueError:
+        raise ProcessingException(reason="Invalid %s" % PAGE_SIZE, code=400)
+    if page_size <= 0:
+        raise ProcessingException(reason="Invalid %s" % PAGE_SIZE, code=400)
+    return min(page_size, max_page_size)
+
+
+def encode_token(key):
+    token = json.dumps(key, separators=(",", ":"), default=serialization.to_serializable)
+    return base64.urlsafe_b64encode(token).rstrip("=")
+
+
+def decode_token(token, key_length):
+    try:
+        key = json.loads(base64.urlsafe_b64decode(str(token) + "=" * (-len(token) % 4)))
+    except (TypeError, ValueError, binascii.Error):
+        raise ProcessingException(reason="Invalid %s" % PAGE_TOKEN, code=400)
+    if not isinstance(key, list) or len(key) != key_length:
+        raise ProcessingException(reason="Invalid %s" % PAGE_TOKEN, code=400)
+    return key
+
+
+def get_page_token(request, key_length):
+    """
+    Returns the sort key the requested page starts after, or None for the first page.
+    """
+    token = request.get_argument(PAGE_TOKEN, None)
+    if token is None or len(token) == 0:
+        return None
+    return decode_token(token, key_length)
+
+
+def page(rows, page_size, key):
+    """
+    Splits rows fetched with a limit of page_size + 1 into the page and the token for the next
+    one (None when this is the last page). 'key' returns a row's sort key as a list.
+    """
+    if len(rows) <= page_size:
+        return rows, None
+    rows = rows[:page_size]
+    return rows, encode_token(key(rows[-1]))
+
+
+def envelope(results, next_page_token):
+    return {
+        "results": results,
+        "next_page_token": next_page_token
+    }
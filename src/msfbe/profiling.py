@@ -0,0 +1,113 @@
+"""
+Copyright (c) 2021 Jet Propulsion Laboratory,
+California Institute of Technology.  All rights reserved
+
+Request profiling with cProfile. A client on the [profiling] allowed IP list can pass
+profile=true to get the handler's profile instead of its normal response, and
+profiling.sample_rate=N profiles one in N requests to files in profiling.output_dir.
+"""
+
+import cProfile
+import logging
+import marshal
+import os
+import pstats
+import random
+import re
+import time
+import uuid
+from StringIO import StringIO
+from msfbe.webmodel import ProcessingException
+
+
+class ProfileFormats:
+    TEXT = "text"
+    PSTATS = "pstats"
+
+
+def _get_option(webconfig, option, default):
+    if webconfig.has_option("profiling", option):
+        return webconfig.get("profiling", option)
+    return default
+
+
+def is_enabled(webconfig):
+    return _get_option(webconfig, "profiling.enabled", "false") == "true"
+
+
+def is_requested(webconfig, request):
+    """
+    True when the request asks to be profiled with profile=true. Raises a 403 if profiling is
+    disabled or the client is not allowed to use it.
+    """
+    if not request.get_boolean_arg("profile", False):
+        return False
+
+    allowed_ips = [ip.strip() for ip in _get_option(webconfig, "profiling.allowed_ips", "").split(",")]
+    if not is_enabled(webconfig) or request.get_remote_ip() not in allowed_ips:
+        raise ProcessingException(reason="Profiling is not available", code=403)
+    return True
+
+
+def top_n(webconfig):
+    return int(_get_option(webconfig, "profiling.top_n", 50))
+
+
+def should_sample(webconfig):
+    sample_rate = int(_get_option(webconfig, "profiling.sample_rate", 0))
+    return is_enabled(webconfig) and sample_rate > 0 and random.randint(1, sample_rate) == 1
+
+
+def top_stats(profile, top_n, sort="cumulative"):
+    out = StringIO()
+    stats = pstats.Stats(profile, stream=out)
+    stats.strip_dirs().sort_stats(sort).print_stats(top_n)
+    return out.getvalue()
+
+
+def pstats_bytes(profile):
+    """
+    The profile in the format written by Profile.dump_stats(), readable with pstats.Stats(path).
+    """
+    profile.create_stats()
+    return marshal.dumps(profile.stats)
+
+
+def _prune(output_dir, max_files):
+    files = [os.path.join(output_dir, name) for name in os.listdir(output_dir) if name.endswith(".prof")]
+    if len(files) <= max_files:
+        return
+    files.sort(key=os.path.getmtime)
+    for path in files[:len(files) - max_files]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def save_sample(webconfig, profile, path):
+    """
+    Writes a sampled profile to the output directory, removing the oldest profiles beyond
+    profiling.max_files.
+    """
+    output_dir = _get_option(webconfig, "profiling.output_dir", "/tmp/msfbe-profiles")
+    max_files = int(_get_option(webconfig, "profiling.max_files", 100))
+
+    try:
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+
+        name = "%s_%s_%s_%s.prof" % (time.strftime("%Y%m%dT%H%M%S"), os.getpid(), uuid.uuid4().hex[:8],
+                                     re.sub(r"[^A-Za-z0-9]+", "_", path).strip("_"))
+        target = os.path.join(output_dir, name)
+        with open(target + ".tmp", "wb") as f:
+            f.write(pstats_bytes(profile))
+        os.rename(target + ".tmp", target)
+
+        _prune(output_dir, max_files)
+    except (IOError, OSError):
+        logging.getLogger(__name__).warning("Unable to save request profile", exc_info=True)
+
+
+def new_profile():
+    return cProfile.Profile()
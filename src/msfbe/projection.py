@@ -0,0 +1,58 @@
+"""
+Copyright (c) 2021 Jet Propulsion Laboratory,
+California Institute of Technology.  All rights reserved
+
+Column projection. A client passes fields=name1,name2,... to get only those fields of each
+result. Handlers select null in place of the columns no requested field needs, which keeps the
+layout of their rows (and the column index constants used to read them) unchanged while the
+database no longer reads, transfers or decodes the unneeded values.
+"""
+
+from msfbe.webmodel import ProcessingException
+
+FIELDS = "fields"
+
+
+def get_fields(request, available):
+    """
+    Returns the requested fields in the order given, or None if the request does not ask for a
+    projection. Raises a 400 for fields that are not in 'available'.
+    """
+    value = request.get_argument(FIELDS, None)
+    if value is None or len(value) == 0:
+        return None
+
+    fields = []
+    for name in value.split(","):
+        name = name.strip()
+        if name not in available:
+            raise ProcessingException(reason="Unknown field '%s'" % name, code=400)
+        if name not in fields:
+            fields.append(name)
+    return fields
+
+
+def needed_columns(fields, field_columns, always=()):
+    """
+    Returns the set of column indexes needed to produce 'fields', where 'field_columns' maps
+    each field to the index (or list of indexes) of the columns it is built from.
+    """
+    needed = set(always)
+    for name in fields:
+        columns = field_columns[name]
+        if isinstance(columns, int):
+            needed.add(columns)
+        else:
+            needed.update(columns)
+    return needed
+
+
+def select_list(expressions, needed):
+    """
+    Joins select list 'expressions', replacing the ones whose index is not in 'needed' with null.
+    """
+    return ",\n  ".join(expression if i in needed else "null" for i, expression in enumerate(expressions))
+
+
+def project(result, fields):
+    return dict((name, result[name]) for name in fields if name in result)
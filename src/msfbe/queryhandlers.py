@@ -1,10 +1,10 @@
-import json
-from msfbe.webmodel import BaseHandler, service_handler, SimpleResults
-import requests
-import psycopg2
+from msfbe.webmodel import BaseHandler, service_handler, SimpleResults, ProcessingException
+from msfbe import dbpool
+from msfbe import pagination
+from msfbe import projection
+import numbers
 import types
 import numpy as np
-import math
 
 
 class ParamType:
@@ -43,6 +43,39 @@ def column(
 
 
 
+class FilterTypes:
+    WHERE_NOT_NULL = 0
+    COALESCE_EMPTY = 1
+
+
+def where_not_null(
+    name,
+    unless_params_default=[]
+):
+    """
+    Drops rows where column 'name' is null. When 'unless_params_default' names request
+    parameters, rows are only dropped if one of those parameters is set to a non-default value.
+    """
+    assert isinstance(name, types.StringType)
+    return {
+        "type": FilterTypes.WHERE_NOT_NULL,
+        "name": name,
+        "unless_params_default": unless_params_default
+    }
+
+
+def coalesce_empty(*names):
+    """
+    Replaces nulls with a zero length string in the named columns, which must be text columns.
+    """
+    for name in names:
+        assert isinstance(name, types.StringType)
+    return {
+        "type": FilterTypes.COALESCE_EMPTY,
+        "names": names
+    }
+
+
 class SummaryTypes:
     AVERAGE = 0
     SUM = 1
@@ -65,104 +98,252 @@ def summary(
 
 
 class Summarizer:
+    """
+    Computes one summary over a column of results. 'values' is a NumPy array holding the
+    column's non-null values.
+    """
 
     def __init__(self, field):
         self.field = field
 
-    def next(self, row):
-        raise Exception("Not implemented")
-
-    def value(self):
+    def summarize(self, values):
         raise Exception("Not implemented")
 
 
-class AverageSummarizer(Summarizer):
+def _as_numeric(values):
+    """
+    Returns 'values' as an integer or float array if they are all ints or floats, so that they
+    reduce in NumPy, and otherwise unchanged. Other types, including numeric text and Decimal,
+    are compared as themselves.
+    """
+    numeric = np.asarray(values.tolist())
+    return numeric if numeric.dtype.kind in "iuf" else values
 
-    def __init__(self, field):
-        Summarizer.__init__(self, field)
-        self.__values = []
 
-    def next(self, row):
-        row_value = row[self.field]
-        if row_value is not None:
-            self.__values.append(row_value)
+def _extreme(reduce, values, sentinel, clamp):
+    # The value in its native type, with numbers clamped to the sentinel like the SQL summaries
+    value = reduce(_as_numeric(values))
+    if isinstance(value, np.generic):
+        value = value.item()
+    return clamp(value, sentinel) if isinstance(value, numbers.Number) else value
 
-    def value(self):
-        v = np.mean(self.__values)
-        return 0.0 if np.isnan(v) or math.isnan(v) else v
 
-class SumSummarizer(Summarizer):
+class AverageSummarizer(Summarizer):
 
-    def __init__(self, field):
-        Summarizer.__init__(self, field)
-        self.__value = 0.0
+    def summarize(self, values):
+        if len(values) == 0:
+            return 0.0
+        v = np.mean(values.astype(np.float64))
+        return 0.0 if np.isnan(v) else float(v)
 
-    def next(self, row):
-        row_value = row[self.field]
-        if row_value is not None:
-            self.__value += row_value
+class SumSummarizer(Summarizer):
 
-    def value(self):
-        return self.__value
+    def summarize(self, values):
+        return float(np.sum(values.astype(np.float64))) if len(values) > 0 else 0.0
 
 class MinSummarizer(Summarizer):
 
-    def __init__(self, field):
-        Summarizer.__init__(self, field)
-        self.__value = 9999999999
-
-    def next(self, row):
-        row_value = row[self.field]
-        if row_value is not None:
-            self.__value = np.min((self.__value, row_value))
-
-    def value(self):
-        return self.__value
+    def summarize(self, values):
+        if len(values) == 0:
+            return 9999999999
+        return _extreme(np.min, values, 9999999999, min)
 
 class MaxSummarizer(Summarizer):
 
-    def __init__(self, field):
-        Summarizer.__init__(self, field)
-        self.__value = -9999999999
-
-    def next(self, row):
-        row_value = row[self.field]
-        if row_value is not None:
-            self.__value = np.max((self.__value, row_value))
-
-    def value(self):
-        return self.__value
+    def summarize(self, values):
+        if len(values) == 0:
+            return -9999999999
+        return _extreme(np.max, values, -9999999999, max)
 
 
 class CountSummarizer(Summarizer):
 
-    def __init__(self, field):
-        Summarizer.__init__(self, field)
-        self.__count = 0
-
-    def next(self, row):
-        row_value = row[self.field]
-        if row_value is not None:
-            self.__count += 1
-
-    def value(self):
-        return self.__count
+    def summarize(self, values):
+        return len(values)
 
 
 class CountDistinctSummarizer(Summarizer):
 
-    def __init__(self, field):
-        Summarizer.__init__(self, field)
-        self.__value_list = []
-
-    def next(self, row):
-        row_value = row[self.field]
-        if row_value is not None and not row_value in self.__value_list:
-            self.__value_list.append(row_value)
-
-    def value(self):
-        return len(self.__value_list)
-
+    def summarize(self, values):
+        try:
+            return len(np.unique(values))
+        except TypeError:
+            # Values that cannot be ordered against each other
+            return len(set(values))
+
+
+
+def _add_wildcard(value):
+    if value is not None and len(value) == 0:
+        return "%"
+    if value is not None and value[0] != '%':
+        value = "%%%s" % value
+    if value is not None and value[-1] != '%':
+        value = "%s%%" % value
+    return value
+
+
+def _param_default(param):
+    if param["type"] == ParamType.STRING and param["add_wildcard"] is True:
+        return _add_wildcard(param["default_value"])
+    return param["default_value"]
+
+
+def _filter_param_name(index):
+    return "_filter_%d" % index
+
+
+def compile_filter_sql(sql, columns, filters):
+    """
+    Wraps a handler's query in a select that applies its declarative filters in the database.
+    The base query's result columns are renamed c0..cN by position and keep their positions.
+    A where_not_null filter with 'unless_params_default' is switched off by a boolean parameter
+    set by filter_params().
+    """
+    indexes = dict((col["name"], col["index"]) for col in columns)
+    aliases = ["c%d" % i for i in range(max(indexes.values()) + 1)]
+
+    selected = list(aliases)
+    predicates = []
+    for i, spec in enumerate(filters):
+        if spec["type"] == FilterTypes.WHERE_NOT_NULL:
+            predicate = "c%d is not null" % indexes[spec["name"]]
+            if len(spec["unless_params_default"]) > 0:
+                predicate = "(%s or %%(%s)s)" % (predicate, _filter_param_name(i))
+            predicates.append(predicate)
+        elif spec["type"] == FilterTypes.COALESCE_EMPTY:
+            for name in spec["names"]:
+                selected[indexes[name]] = "coalesce(c%d, '')" % indexes[name]
+        else:
+            raise Exception("Invalid filter type specified: %s" % spec["type"])
+
+    base_sql = sql.strip().rstrip(";")
+    compiled = "select " + ", ".join(selected) + " from (" + base_sql + "\n) as _q(" + ", ".join(aliases) + ")"
+    if len(predicates) > 0:
+        compiled += " where " + " and ".join(predicates)
+    return compiled + ";"
+
+
+def filter_params(filters, params, param_map):
+    """
+    Returns the query parameters used by the SQL compiled from 'filters' for a request with the
+    parameter values in 'param_map'.
+    """
+    defaults = dict((param["name"], _param_default(param)) for param in params)
+    filter_map = {}
+    for i, spec in enumerate(filters):
+        if spec["type"] == FilterTypes.WHERE_NOT_NULL and len(spec["unless_params_default"]) > 0:
+            filter_map[_filter_param_name(i)] = all(param_map[name] == defaults[name]
+                                                    for name in spec["unless_params_default"])
+    return filter_map
+
+
+# SQL aggregates equivalent to the Python summarizers above, including their results for an
+# empty set of values (an average of 0.0 and a sum of 0.0). min and max work on columns of any
+# type, so their sentinels are applied to the fetched values by clamp_summaries().
+_SUMMARY_SQL = {
+    SummaryTypes.AVERAGE: "coalesce(avg({column})::double precision, 0.0)",
+    SummaryTypes.SUM: "coalesce(sum({column})::double precision, 0.0)",
+    SummaryTypes.MIN: "min({column})",
+    SummaryTypes.MAX: "max({column})",
+    SummaryTypes.COUNT: "count({column})",
+    SummaryTypes.COUNT_DISTINCT: "count(distinct {column})"
+}
+
+_SUMMARY_SENTINELS = {
+    SummaryTypes.MIN: (9999999999, min),
+    SummaryTypes.MAX: (-9999999999, max)
+}
+
+
+def clamp_summaries(summarize, values):
+    """
+    Applies the min/max sentinels of the Python summarizers to the summary 'values' computed in
+    SQL: they replace nulls, and numeric values are clamped to them.
+    """
+    clamped = []
+    for spec, value in zip(summarize, values):
+        if spec["type"] in _SUMMARY_SENTINELS:
+            sentinel, clamp = _SUMMARY_SENTINELS[spec["type"]]
+            if value is None:
+                value = sentinel
+            elif isinstance(value, numbers.Number):
+                value = clamp(value, sentinel)
+        clamped.append(value)
+    return clamped
+
+
+def _page_param_name(index):
+    return "_page_after_%d" % index
+
+
+def compile_page_sql(sql, columns, sort_key, after=False):
+    """
+    Wraps a handler's query in a select returning one page of it ordered by 'sort_key', a list
+    of columns that together are unique and not null. The base query's result columns are
+    renamed c0..cN by position and keep their positions. The page size plus one is passed as
+    _page_limit and, with 'after', the previous page's last sort key as _page_after_0..N.
+    """
+    indexes = dict((col["name"], col["index"]) for col in columns)
+    aliases = ", ".join("c%d" % i for i in range(max(indexes.values()) + 1))
+    keys = ", ".join("c%d" % indexes[name] for name in sort_key)
+
+    base_sql = sql.strip().rstrip(";")
+    compiled = "select " + aliases + " from (" + base_sql + "\n) as _q(" + aliases + ")"
+    if after:
+        compiled += " where (" + keys + ") > (" + ", ".join("%%(%s)s" % _page_param_name(i) for i in range(len(sort_key))) + ")"
+    return compiled + " order by " + keys + " limit %(_page_limit)s;"
+
+
+def compile_projection_sql(sql, columns, names, order_by=()):
+    """
+    Wraps a handler's query in a select that returns null for every column other than 'names'.
+    The base query's result columns are renamed c0..cN by position and keep their positions.
+    The order of a subquery is not kept by the select around it, so a base query whose order
+    matters, such as a page, is ordered again by the columns 'order_by'.
+    """
+    indexes = dict((col["name"], col["index"]) for col in columns)
+    aliases = ["c%d" % i for i in range(max(indexes.values()) + 1)]
+    needed = set(indexes[name] for name in names)
+
+    base_sql = sql.strip().rstrip(";")
+    compiled = "select " + projection.select_list(aliases, needed) + " from (" + base_sql + "\n) as _q(" + ", ".join(aliases) + ")"
+    if len(order_by) > 0:
+        compiled += " order by " + ", ".join("c%d" % indexes[name] for name in order_by)
+    return compiled + ";"
+
+
+def compile_summary_sql(sql, columns, summarize, group_by=()):
+    """
+    Wraps a handler's query in a select that computes its summaries in the database, returning
+    a single row or, with 'group_by', one row per group. The base query's result columns are
+    renamed c0..cN by position. Returns None when a summary cannot be computed in SQL.
+    """
+    indexes = dict((col["name"], col["index"]) for col in columns)
+
+    aggregates = []
+    for spec in summarize:
+        if spec["type"] not in _SUMMARY_SQL or spec["name"] not in indexes:
+            return None
+        aggregates.append(_SUMMARY_SQL[spec["type"]].format(column="c%d" % indexes[spec["name"]]))
+
+    groups = []
+    for name in group_by:
+        if name not in indexes:
+            return None
+        groups.append("c%d" % indexes[name])
+
+    base_sql = sql.strip().rstrip(";")
+    aliases = ", ".join("c%d" % i for i in range(max(indexes.values()) + 1))
+    compiled = "select " + ", ".join(groups + aggregates) + " from (" + base_sql + "\n) as _q(" + aliases + ")"
+    if len(groups) > 0:
+        compiled += " group by " + ", ".join(groups) + " order by " + ", ".join(groups)
+    return compiled + ";"
+
+
+def _group_sort_key(key):
+    # Orders groups the way the database does, with nulls last
+    return [(value is None, value) for value in key]
 
 
 class QueryResultsSummarizer:
@@ -190,27 +371,51 @@ class QueryResultsSummarizer:
         elif summary["type"] == SummaryTypes.MIN:
             return MinSummarizer(summary["name"])
         else:
-            raise Exception("Invalid summarizer type specified: %s" % summary.type)
+            raise Exception("Invalid summarizer type specified: %s" % summary["type"])
 
+    def __column(self, results, field):
+        column = np.empty(len(results), dtype=object)
+        column[:] = [row[field] for row in results]
+        return column
 
-    def __summarize_row(self, row):
+    def __summarize(self, columns, rows=None):
+        summaries = {}
         for summarizer in self.__summarizers:
-            summarizer.next(row)
+            values = columns[summarizer.field]
+            if rows is not None:
+                values = values[rows]
+            summaries[summarizer.field] = summarizer.summarize(values[np.not_equal(values, None)])
+        return summaries
+
+    def summarize_resultset(self, results, group_by=()):
+        """
+        Returns a single row of summaries or, with 'group_by', one row per distinct combination
+        of the group_by fields holding those fields and the group's summaries.
+        """
+        # Each field is transposed into a column once, however many summaries use it
+        columns = {}
+        for summarizer in self.__summarizers:
+            if summarizer.field not in columns:
+                columns[summarizer.field] = self.__column(results, summarizer.field)
 
-    def summarize_resultset(self, results):
-        for row in results:
-            self.__summarize_row(row)
+        if len(group_by) == 0:
+            return [self.__summarize(columns)]
 
-        new_results = {}
-        for summarizer in self.__summarizers:
-            new_results[summarizer.field] = summarizer.value()
-        return [new_results]
+        groups = {}
+        for i, row in enumerate(results):
+            groups.setdefault(tuple(row[field] for field in group_by), []).append(i)
 
+        new_results = []
+        for key in sorted(groups, key=_group_sort_key):
+            summaries = self.__summarize(columns, np.array(groups[key], dtype=np.intp))
+            summaries.update(zip(group_by, key))
+            new_results.append(summaries)
+        return new_results
 
 
 
 
-def _build_query_handler_class(_uri, _name, _sql, _params, _columns, _filters, _summarize = None):
+def _build_query_handler_class(_uri, _name, _sql, _params, _columns, _filters, _summarize = None, _executor = None, _cache_ttl = None, _cache_control = None, _group_by = None, _sort_key = None):
     @service_handler
     class GenericQueryBasedHandler(BaseHandler):
         name = _name
@@ -218,14 +423,34 @@ def _build_query_handler_class(_uri, _name, _sql, _params, _columns, _filters, _
         description = ""
         params = {}
         singleton = True
+        executor = _executor
+        cache_ttl = _cache_ttl
+        cache_control = _cache_control
 
         def __init__(self):
             BaseHandler.__init__(self)
             self.params = _params
             self.columns = _columns
-            self.filters = _filters
+            # Declarative filters are applied in SQL, anything else is called on each row
+            self.sql_filters = [filter for filter in _filters if isinstance(filter, dict)]
+            self.filters = [filter for filter in _filters if not isinstance(filter, dict)]
             self.summarize_spec = _summarize
+            self.group_by = _group_by if _group_by is not None else []
+            self.sort_key = [_sort_key] if isinstance(_sort_key, types.StringType) else (_sort_key or [])
             self.sql = _sql
+            if len(self.sql_filters) > 0:
+                self.sql = compile_filter_sql(_sql, self.columns, self.sql_filters)
+
+            # Row filters run in Python, so summaries can only be computed in SQL without them.
+            # Compiled on first use of each requested grouping.
+            self.summarize_in_sql = self.summarize_spec is not None and len(self.summarize_spec) > 0 and len(self.filters) == 0
+            self.summary_sql = {}
+
+            # First and subsequent pages
+            self.page_sql = None
+            if len(self.sort_key) > 0:
+                self.page_sql = (compile_page_sql(self.sql, self.columns, self.sort_key),
+                                 compile_page_sql(self.sql, self.columns, self.sort_key, after=True))
 
 
         def create_results_summarizer(self):
@@ -234,19 +459,69 @@ def _build_query_handler_class(_uri, _name, _sql, _params, _columns, _filters, _
             else:
                 return None
 
-        def __query(self, config, params):
-            conn = psycopg2.connect(dbname=config.get("database", "db.database"),
-                                    user=config.get("database", "db.username"),
-                                    password=config.get("database", "db.password"),
-                                    host=config.get("database", "db.endpoint"),
-                                    port=config.get("database", "db.port"))
-            cur = conn.cursor()
-
-            cur.execute(self.sql, params)
-
-            results = cur.fetchall()
-            cur.close()
-            conn.close()
+        def __get_group_by(self, computeOptions):
+            group_by = []
+            value = computeOptions.get_argument("groupBy", None)
+            if value is None or len(value) == 0:
+                return group_by
+            for name in value.split(","):
+                name = name.strip()
+                if name not in self.group_by or self.create_results_summarizer() is None:
+                    raise ProcessingException(reason="Cannot group by '%s'" % name, code=400)
+                if name not in group_by:
+                    group_by.append(name)
+            return group_by
+
+        def __get_summary_sql(self, group_by):
+            if not self.summarize_in_sql:
+                return None
+            key = tuple(group_by)
+            if key not in self.summary_sql:
+                self.summary_sql[key] = compile_summary_sql(self.sql, self.columns, self.summarize_spec, key)
+            return self.summary_sql[key]
+
+        def __get_fields(self, computeOptions):
+            fields = projection.get_fields(computeOptions, [col["name"] for col in self.columns])
+            if fields is not None and self.create_results_summarizer() is not None:
+                raise ProcessingException(reason="%s is not supported by %s" % (projection.FIELDS, self.path), code=400)
+            return fields
+
+        def __project_sql(self, sql, fields, order_by=()):
+            # Python filters may look at any column, so only their output is trimmed
+            if fields is None or len(self.filters) > 0:
+                return sql
+            return compile_projection_sql(sql, self.columns, fields + self.sort_key, order_by)
+
+        def __project_results(self, results, fields):
+            if fields is None:
+                return results
+            return [projection.project(result, fields) for result in results]
+
+        def __handle_page(self, computeOptions, config, param_map, fields):
+            if self.page_sql is None or self.create_results_summarizer() is not None:
+                raise ProcessingException(reason="Paging is not supported by %s" % self.path, code=400)
+
+            page_size = pagination.get_page_size(config, computeOptions)
+            after = pagination.get_page_token(computeOptions, len(self.sort_key))
+            param_map["_page_limit"] = page_size + 1
+            if after is not None:
+                for i, value in enumerate(after):
+                    param_map[_page_param_name(i)] = value
+
+            rows = self.__query(config, param_map, self.__project_sql(self.page_sql[after is not None], fields, self.sort_key))
+
+            # The token comes from the last row fetched, so rows dropped by Python filters are
+            # not fetched again
+            key_indexes = [col["index"] for name in self.sort_key for col in self.columns if col["name"] == name]
+            rows, next_page_token = pagination.page(rows, page_size, lambda row: [row[i] for i in key_indexes])
+            results = self.__project_results(self.__format_results(rows, param_map), fields)
+            return SimpleResults(pagination.envelope(results, next_page_token))
+
+        def __query(self, config, params, sql=None):
+            with dbpool.cursor(config) as cur:
+                cur.execute(sql if sql is not None else self.sql, params)
+
+                results = cur.fetchall()
 
             return results
 
@@ -273,13 +548,7 @@ def _build_query_handler_class(_uri, _name, _sql, _params, _columns, _filters, _
                 if param["type"] == ParamType.STRING:
                     param_value = computeOptions.get_argument(param["name"], param["default_value"])
                     if param["add_wildcard"] is True:
-                        if param_value is not None and len(param_value) == 0:
-                            param_value = "%"
-                        else:
-                            if param_value is not None and param_value[0] != '%':
-                                param_value = "%%%s"%param_value
-                            if param_value is not None and param_value[-1] != '%':
-                                param_value = "%s%%"%param_value
+                        param_value = _add_wildcard(param_value)
                     param_map[param["name"]] = param_value
                 elif param["type"] == ParamType.BOOLEAN:
                     param_map[param["name"]] = computeOptions.get_boolean_arg(param["name"], param["default_value"])
@@ -291,13 +560,29 @@ def _build_query_handler_class(_uri, _name, _sql, _params, _columns, _filters, _
                     param_map[param["name"]] = computeOptions.get_int_arg(param["name"], param["default_value"])
                 else:
                     raise Exception("Unsupported or invalid parameter type")
+            param_map.update(filter_params(self.sql_filters, self.params, param_map))
+
+            fields = self.__get_fields(computeOptions)
+
+            if pagination.is_requested(computeOptions):
+                return self.__handle_page(computeOptions, args["webconfig"], param_map, fields)
+
+            group_by = self.__get_group_by(computeOptions)
+
+            summary_sql = self.__get_summary_sql(group_by)
+            if summary_sql is not None:
+                rows = self.__query(args["webconfig"], param_map, summary_sql)
+                names = group_by + [spec["name"] for spec in self.summarize_spec]
+                return SimpleResults([dict(zip(names, list(row[:len(group_by)]) +
+                                               clamp_summaries(self.summarize_spec, row[len(group_by):])))
+                                      for row in rows])
 
-            rows = self.__query(args["webconfig"], param_map)
-            results = self.__format_results(rows, param_map)
+            rows = self.__query(args["webconfig"], param_map, self.__project_sql(self.sql, fields))
+            results = self.__project_results(self.__format_results(rows, param_map), fields)
 
             summarize = self.create_results_summarizer()
             if summarize is not None:
-                results = summarize.summarize_resultset(results)
+                results = summarize.summarize_resultset(results, group_by)
 
             return SimpleResults(results)
 
@@ -309,8 +594,13 @@ def create_query_based_handler(
     params=[],
     columns=[],
     filters=[],
-    summarize=[]
+    summarize=[],
+    executor=None,
+    cache_ttl=None,
+    cache_control=None,
+    group_by=[],
+    sort_key=None
 ):
-    _build_query_handler_class(uri, name, sql, params, columns, filters, summarize)
+    _build_query_handler_class(uri, name, sql, params, columns, filters, summarize, executor, cache_ttl, cache_control, group_by, sort_key)
 
 
@@ -0,0 +1,108 @@
+"""
+Copyright (c) 2021 Jet Propulsion Laboratory,
+California Institute of Technology.  All rights reserved
+
+Per-request state shared between the request handler on the IOLoop and the handler code it
+runs on an executor thread. The wrapper activates the context around each call it makes into
+handler code; code further down (e.g. database cursors) finds it with current().
+"""
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from msfbe.webmodel import RequestCancelled
+
+_local = threading.local()
+
+
+class RequestContext(object):
+    def __init__(self, path, statement_timeout=None):
+        self.path = path
+        # Milliseconds, applied to database transactions started for the request
+        self.statement_timeout = statement_timeout
+        self.cancelled = False
+        self.__timings = {}
+        self.__connections = set()
+        self.__lock = threading.Lock()
+
+    def add_timing(self, stage, seconds):
+        with self.__lock:
+            self.__timings[stage] = self.__timings.get(stage, 0.0) + seconds
+
+    def timing(self, stage):
+        with self.__lock:
+            return self.__timings.get(stage, 0.0)
+
+    def timings(self):
+        with self.__lock:
+            return dict(self.__timings)
+
+    def add_connection(self, conn):
+        with self.__lock:
+            self.__connections.add(conn)
+
+    def remove_connection(self, conn):
+        with self.__lock:
+            self.__connections.discard(conn)
+
+    def cancel(self):
+        """
+        Marks the request as cancelled and cancels the statements running on its database
+        connections. Handler code notices at its next database call. Returns the number of
+        connections a cancel request was sent to.
+        """
+        with self.__lock:
+            if self.cancelled:
+                return 0
+            self.cancelled = True
+            connections = list(self.__connections)
+
+        cancelled = 0
+        for conn in connections:
+            try:
+                conn.cancel()
+                cancelled += 1
+            except Exception:
+                logging.getLogger(__name__).warning("Unable to cancel database statement", exc_info=True)
+        return cancelled
+
+
+def current():
+    return getattr(_local, "context", None)
+
+
+def run(context, submitted, fn, *args, **kwargs):
+    """
+    Calls fn with 'context' active on the calling thread. Time since 'submitted' is recorded as
+    executor queue time and the time spent in fn as handler time.
+    """
+    start = time.time()
+    context.add_timing("queue", start - submitted)
+    if context.cancelled:
+        raise RequestCancelled()
+
+    previous = current()
+    _local.context = context
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        _local.context = previous
+        context.add_timing("handler", time.time() - start)
+
+
+def check_cancelled():
+    context = current()
+    if context is not None and context.cancelled:
+        raise RequestCancelled()
+
+
+@contextmanager
+def timed(stage):
+    start = time.time()
+    try:
+        yield
+    finally:
+        context = current()
+        if context is not None:
+            context.add_timing(stage, time.time() - start)
@@ -0,0 +1,182 @@
+"""
+Copyright (c) 2021 Jet Propulsion Laboratory,
+California Institute of Technology.  All rights reserved
+"""
+
+import json
+import logging
+import re
+import threading
+from datetime import datetime
+from decimal import Decimal
+import numpy as np
+
+try:
+    import simplejson
+except ImportError:
+    simplejson = None
+
+
+class JsonBackends:
+    AUTO = "auto"
+    SIMPLEJSON = "simplejson"
+    JSON = "json"
+
+
+_NUMPY_TYPES = (
+    np.bool_,
+    np.float16,
+    np.float32,
+    np.float64,
+    np.int8,
+    np.int16,
+    np.int32,
+    np.int64,
+    np.str_,
+    np.uint8,
+    np.uint16,
+    np.uint32,
+    np.uint64,
+    np.void,
+)
+
+
+class RawJson(object):
+    """
+    Text that is already JSON, such as GeoJSON generated by PostGIS, written into the output
+    as is rather than parsed and serialized again.
+    """
+    __slots__ = ("text",)
+
+    def __init__(self, text):
+        self.text = text
+
+
+# Encoders write RawJson values as a string holding this marker and the index of the fragment,
+# which dumps() then replaces with the fragment itself. PostgreSQL text cannot contain NUL, so
+# the marker never collides with a value read from the database.
+_RAW_JSON_MARKER = "\x00rawjson:"
+_RAW_JSON_PATTERN = re.compile(r'"\\u0000rawjson:(\d+)"')
+
+_raw_json = threading.local()
+
+
+def _raw_json_placeholder(obj):
+    fragments = getattr(_raw_json, "fragments", None)
+    if fragments is None:
+        # Serialized outside of dumps()
+        return json.loads(obj.text)
+    fragments.append(obj.text)
+    return "%s%d" % (_RAW_JSON_MARKER, len(fragments) - 1)
+
+
+def to_serializable(obj):
+    """
+    Converts the non-JSON types handlers return (numpy values, Decimal, datetime, RawJson) into
+    plain Python values. Raises TypeError for anything else.
+    """
+    if isinstance(obj, RawJson):
+        return _raw_json_placeholder(obj)
+    elif isinstance(obj, np.ndarray):
+        return obj.tolist()
+    elif isinstance(obj, _NUMPY_TYPES):
+        return obj.item()
+    elif hasattr(np, "float128") and isinstance(obj, np.float128):
+        return obj.astype(np.float64).item()
+    elif isinstance(obj, Decimal):
+        return str(obj)
+    elif isinstance(obj, datetime):
+        return str(obj)
+    elif obj is np.ma.masked:
+        return str(np.nan)
+    raise TypeError("%r is not JSON serializable" % (obj,))
+
+
+class JsonEncoder(json.JSONEncoder):
+    def default(self, obj):
+        try:
+            return to_serializable(obj)
+        except TypeError:
+            # Let the base class default method raise the TypeError
+            return json.JSONEncoder.default(self, obj)
+
+
+def _dumps_json(obj):
+    # Without indent the standard library uses its C encoder; 'default' is only consulted for
+    # the few values that are not plain Python types.
+    return json.dumps(obj, separators=(",", ":"), cls=JsonEncoder)
+
+
+if simplejson is not None:
+    # Options that make simplejson's output identical to the standard library's: NaN and Infinity
+    # are written as such, and Decimal and namedtuple values go through to_serializable() and
+    # lists as they do with json.
+    _SIMPLEJSON_OPTIONS = {
+        "separators": (",", ":"),
+        "default": to_serializable,
+        "allow_nan": True,
+        "use_decimal": False,
+        "namedtuple_as_object": False,
+        "tuple_as_array": True,
+        "iterable_as_array": False,
+        "bigint_as_string": False,
+        "for_json": False
+    }
+
+    def _dumps_simplejson(obj):
+        return simplejson.dumps(obj, **_SIMPLEJSON_OPTIONS)
+
+    def _has_speedups():
+        return simplejson._import_c_make_encoder() is not None
+else:
+    _dumps_simplejson = None
+
+    def _has_speedups():
+        return False
+
+
+def _auto_backend():
+    # simplejson is only faster than the standard library with its C extension
+    return _dumps_simplejson if _has_speedups() else _dumps_json
+
+
+_backend = _auto_backend()
+
+
+def set_backend(name):
+    global _backend
+    if name == JsonBackends.AUTO:
+        _backend = _auto_backend()
+    elif name == JsonBackends.SIMPLEJSON:
+        if _dumps_simplejson is None:
+            raise Exception("JSON backend 'simplejson' is not installed")
+        _backend = _dumps_simplejson
+    elif name == JsonBackends.JSON:
+        _backend = _dumps_json
+    else:
+        raise Exception("Invalid JSON backend specified: %s" % name)
+    logging.getLogger(__name__).info("Using JSON backend '%s'" % backend_name())
+
+
+def backend_name():
+    return JsonBackends.SIMPLEJSON if _backend is _dumps_simplejson else JsonBackends.JSON
+
+
+def dumps(obj, pretty=False):
+    """
+    Serializes a handler result. Output is compact by default; pretty=True produces indented
+    output with the standard library encoder.
+    """
+    previous = getattr(_raw_json, "fragments", None)
+    _raw_json.fragments = fragments = []
+    try:
+        if pretty:
+            body = json.dumps(obj, indent=4, cls=JsonEncoder)
+        else:
+            body = _backend(obj)
+    finally:
+        _raw_json.fragments = previous
+
+    if len(fragments) > 0:
+        body = _RAW_JSON_PATTERN.sub(lambda match: fragments[int(match.group(1))], body)
+    return body
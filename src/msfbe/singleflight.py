@@ -0,0 +1,61 @@
+"""
+Copyright (c) 2021 Jet Propulsion Laboratory,
+California Institute of Technology.  All rights reserved
+"""
+
+from tornado import gen
+
+
+class Call(object):
+    def __init__(self, key, future, on_abandoned=None):
+        self.key = key
+        self.future = future
+        self.on_abandoned = on_abandoned
+        self.waiters = 1
+
+
+class SingleFlight(object):
+    """
+    Collapses concurrent calls with the same key into one: while a call is in flight, later
+    callers wait for and share its result (or exception) instead of starting their own.
+    Only used from the IOLoop thread, so calls are coalesced within a server process.
+    """
+
+    def __init__(self):
+        self.__calls = {}
+
+    def in_flight(self):
+        return len(self.__calls)
+
+    def join(self, key, fn, on_abandoned=None):
+        """
+        Returns (call, shared) where call.future resolves to the result and shared is True when
+        the call was started by another caller. 'fn' returns a Future and is only called when
+        no call with the same key is in flight. 'on_abandoned' is called if every caller leaves
+        before the call completes.
+        """
+        call = self.__calls.get(key)
+        if call is not None:
+            call.waiters += 1
+            return call, True
+
+        call = Call(key, gen.maybe_future(fn()), on_abandoned)
+        self.__calls[key] = call
+        call.future.add_done_callback(lambda future: self.__done(call))
+        return call, False
+
+    def __done(self, call):
+        if self.__calls.get(call.key) is call:
+            del self.__calls[call.key]
+
+    def leave(self, call):
+        """
+        Called when a caller no longer wants the result of 'call'.
+        """
+        if call.future.done():
+            return
+        call.waiters -= 1
+        if call.waiters == 0:
+            self.__done(call)
+            if call.on_abandoned is not None:
+                call.on_abandoned()
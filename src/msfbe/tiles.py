@@ -0,0 +1,171 @@
+"""
+Copyright (c) 2021 Jet Propulsion Laboratory,
+California Institute of Technology.  All rights reserved
+
+Helpers for Mapbox Vector Tile endpoints: web mercator tile bounds and an on-disk cache of
+generated tiles under tiles.cache_dir, laid out as g<generation>/<layer>/<filters>/<z>/<x>/<y>.mvt.
+Cached tiles are served until they are older than tiles.cache_ttl seconds or the cache is
+flushed. The generation is kept in a file in the cache directory, so a flush applies to every
+worker process and to tiles written by requests that were already running.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+from msfbe.webmodel import ProcessingException
+import msfbe.metrics as metrics
+
+CONTENT_TYPE = "application/vnd.mapbox-vector-tile"
+
+# Half the width of the EPSG:3857 world
+WORLD_EXTENT = 20037508.342789244
+
+TILE_CACHE_HITS = metrics.counter("msfbe_tile_cache_hits_total", "Vector tiles served from the tile cache")
+TILE_CACHE_MISSES = metrics.counter("msfbe_tile_cache_misses_total", "Vector tiles generated by the database")
+
+
+def _get_option(webconfig, option, default):
+    if webconfig.has_option("tiles", option):
+        return webconfig.get("tiles", option)
+    return default
+
+
+def parse_tile(webconfig, z, x, y):
+    """
+    Validates tile coordinates taken from the request path. Returns them as ints.
+    """
+    max_zoom = int(_get_option(webconfig, "tiles.max_zoom", 22))
+    z, x, y = int(z), int(x), int(y)
+    if z > max_zoom or x >= 2 ** z or y >= 2 ** z:
+        raise ProcessingException(reason="Invalid tile %s/%s/%s" % (z, x, y), code=400)
+    return z, x, y
+
+
+def tile_bounds(z, x, y):
+    """
+    Returns (xmin, ymin, xmax, ymax) of a tile in EPSG:3857.
+    """
+    size = 2 * WORLD_EXTENT / 2 ** z
+    xmin = -WORLD_EXTENT + x * size
+    ymax = WORLD_EXTENT - y * size
+    return xmin, ymax - size, xmin + size, ymax
+
+
+def point_zoom(webconfig):
+    """
+    Zoom levels below this render features as points rather than polygons.
+    """
+    return int(_get_option(webconfig, "tiles.point_zoom", 10))
+
+
+def _filters_key(filters):
+    values = dict((name, value) for name, value in filters.items() if value is not None)
+    if len(values) == 0:
+        return "all"
+    return hashlib.sha1(json.dumps(values, sort_keys=True)).hexdigest()[:16]
+
+
+def _cache_dir(webconfig):
+    return _get_option(webconfig, "tiles.cache_dir", "/tmp/msfbe-tiles")
+
+
+def _generation_path(webconfig):
+    return os.path.join(_cache_dir(webconfig), "generation")
+
+
+def _generation(webconfig):
+    try:
+        with open(_generation_path(webconfig)) as f:
+            return int(f.read().strip())
+    except (IOError, OSError, ValueError):
+        return 0
+
+
+def _generation_dir(generation):
+    return "g%d" % generation
+
+
+def _cache_path(webconfig, layer, z, x, y, filters):
+    return os.path.join(_cache_dir(webconfig), _generation_dir(_generation(webconfig)), layer,
+                        _filters_key(filters), str(z), str(x), "%d.mvt" % y)
+
+
+def is_cache_enabled(webconfig):
+    return _get_option(webconfig, "tiles.cache_enabled", "false") == "true"
+
+
+def get_cached(webconfig, layer, z, x, y, filters):
+    """
+    Returns (body, last_modified) of a cached tile, or None if it is not cached or has expired.
+    """
+    if not is_cache_enabled(webconfig):
+        return None
+
+    path = _cache_path(webconfig, layer, z, x, y, filters)
+    ttl = float(_get_option(webconfig, "tiles.cache_ttl", 86400))
+    try:
+        modified = os.path.getmtime(path)
+        if time.time() - modified >= ttl:
+            TILE_CACHE_MISSES.inc()
+            return None
+        with open(path, "rb") as f:
+            body = f.read()
+    except (IOError, OSError):
+        TILE_CACHE_MISSES.inc()
+        return None
+
+    TILE_CACHE_HITS.inc()
+    return body, modified
+
+
+def put_cached(webconfig, layer, z, x, y, filters, body):
+    if not is_cache_enabled(webconfig):
+        return
+
+    path = _cache_path(webconfig, layer, z, x, y, filters)
+    try:
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            # Created by another process in the meantime
+            if not os.path.isdir(os.path.dirname(path)):
+                raise
+        # Written under a unique name and renamed so that other processes never read a partial tile
+        temp = "%s.%s.tmp" % (path, uuid.uuid4().hex[:8])
+        with open(temp, "wb") as f:
+            f.write(body)
+        os.rename(temp, path)
+    except (IOError, OSError):
+        logging.getLogger(__name__).warning("Unable to cache tile %s" % path, exc_info=True)
+
+
+def flush_cache(webconfig):
+    """
+    Flushes the tile cache by moving to a new generation and removing the tiles of the previous
+    ones. Returns the new generation.
+    """
+    cache_dir = _cache_dir(webconfig)
+    generation = _generation(webconfig) + 1
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        temp = "%s.%s.tmp" % (_generation_path(webconfig), uuid.uuid4().hex[:8])
+        with open(temp, "w") as f:
+            f.write("%d\n" % generation)
+        os.rename(temp, _generation_path(webconfig))
+    except (IOError, OSError):
+        logging.getLogger(__name__).warning("Unable to flush the tile cache in %s" % cache_dir, exc_info=True)
+        return None
+
+    current = _generation_dir(generation)
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name != current and name.startswith("g") and os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+
+    logging.getLogger(__name__).info("Flushed the tile cache (generation %s)" % generation)
+    return generation
@@ -14,6 +14,8 @@ import re
 from pytz import UTC, timezone
 import types
 import numpy as np
+import msfbe.serialization as serialization
+from msfbe.serialization import JsonEncoder as CustomEncoder
 
 AVAILABLE_HANDLERS = []
 AVAILABLE_INITIALIZERS = []
@@ -72,6 +74,21 @@ class HandlerModuleWrapper:
     def params(self):
         return self.__clazz.params
 
+    def executor(self):
+        return getattr(self.__clazz, "executor", None)
+
+    def cache_ttl(self):
+        return getattr(self.__clazz, "cache_ttl", None)
+
+    def cache_control(self):
+        return getattr(self.__clazz, "cache_control", None)
+
+    def coalesce(self):
+        return getattr(self.__clazz, "coalesce", True)
+
+    def methods(self):
+        return getattr(self.__clazz, "methods", ("GET",))
+
     def instance(self):
         if "singleton" in self.__clazz.__dict__ and self.__clazz.__dict__["singleton"] is True:
             if self.__instance is None:
@@ -91,11 +108,17 @@ class HandlerModuleWrapper:
 
 
 class ProcessingException(Exception):
-    def __init__(self, reason="", code=500):
+    def __init__(self, reason="", code=500, headers=None):
         self.reason = reason
         self.code = code
+        self.headers = headers if headers is not None else {}
         Exception.__init__(self, reason)
 
+
+class RequestCancelled(ProcessingException):
+    def __init__(self):
+        ProcessingException.__init__(self, reason="Request cancelled because the client disconnected", code=499)
+
 class RequestObject:
     floatingPointPattern = re.compile('[+-]?(\d+(\.\d*)?|\.\d+)([eE][+-]?\d+)?')
 
@@ -110,6 +133,16 @@ class RequestObject:
     def get_content_type(self):
         return self.get_argument(RequestParameters.OUTPUT, "JSON")
 
+    def get_path_args(self):
+        return tuple(self.requestHandler.path_args)
+
+    def get_normalized_arguments(self, ignore=()):
+        arguments = self.requestHandler.request.arguments
+        return tuple(sorted((name, tuple(values)) for name, values in arguments.items() if name not in ignore))
+
+    def get_remote_ip(self):
+        return self.requestHandler.request.remote_ip
+
     def __validate_is_number(self, v):
         if v is None or (type(v) == str and len(v) == 0):
             return False
@@ -195,54 +228,64 @@ class BaseHandler(object):
 
 
 
-class CustomEncoder(json.JSONEncoder):
-    def default(self, obj):
-        """If input object is an ndarray it will be converted into a dict
-        holding dtype, shape and the data, base64 encoded.
-        """
-        numpy_types = (
-            np.bool_,
-            # np.bytes_, -- python `bytes` class is not json serializable
-            # np.complex64,  -- python `complex` class is not json serializable
-            # np.complex128,  -- python `complex` class is not json serializable
-            # np.complex256,  -- python `complex` class is not json serializable
-            # np.datetime64,  -- python `datetime.datetime` class is not json serializable
-            np.float16,
-            np.float32,
-            np.float64,
-            # np.float128,  -- special handling below
-            np.int8,
-            np.int16,
-            np.int32,
-            np.int64,
-            # np.object_  -- should already be evaluated as python native
-            np.str_,
-            np.uint8,
-            np.uint16,
-            np.uint32,
-            np.uint64,
-            np.void,
-        )
-        if isinstance(obj, np.ndarray):
-            return obj.tolist()
-        elif isinstance(obj, numpy_types):
-            return obj.item()
-        elif isinstance(obj, np.float128):
-            return obj.astype(np.float64).item()
-        elif isinstance(obj, Decimal):
-            return str(obj)
-        elif isinstance(obj, datetime):
-            return str(obj)
-        elif obj is np.ma.masked:
-            return str(np.NaN)
-        # Let the base class default method raise the TypeError
-        return json.JSONEncoder.default(self, obj)
-
-
-
 class SimpleResults:
     def __init__(self, result):
         self.result = result
 
-    def toJson(self):
-        return json.dumps(self.result, indent=4, cls=CustomEncoder)
\ No newline at end of file
+    def toJson(self, pretty=False):
+        return serialization.dumps(self.result, pretty=pretty)
+
+
+class BinaryResults:
+    """
+    Results that are already encoded, written as-is with their own content type.
+    """
+    def __init__(self, body, content_type, last_modified=None):
+        self.body = body
+        self.content_type = content_type
+        self.last_modified = last_modified
+
+    def toBinary(self):
+        return self.body
+
+
+class StreamingResults:
+    """
+    Results written to the client incrementally. 'chunks' is an iterator of JSON text fragments
+    that is advanced on the handler's executor, so it may lazily pull rows from the database.
+    """
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    def toJsonChunks(self):
+        return self.chunks
+
+
+_END_OF_ITEMS = object()
+
+def json_array_chunks(items, batch_size=500, prefix="[", suffix="]"):
+    items = iter(items)
+
+    # Pull the first item before anything is written so that query errors are still reported
+    # with a proper status code.
+    item = next(items, _END_OF_ITEMS)
+    yield prefix
+
+    batch = []
+    separator = ""
+    while item is not _END_OF_ITEMS:
+        batch.append(serialization.dumps(item))
+        if len(batch) >= batch_size:
+            yield separator + ",".join(batch)
+            separator = ","
+            batch = []
+        item = next(items, _END_OF_ITEMS)
+
+    if len(batch) > 0:
+        yield separator + ",".join(batch)
+    yield suffix
+
+
+def feature_collection_chunks(features, batch_size=500):
+    prefix = '{"type": "FeatureCollection", "crs": {"type": "name", "properties": {"name": "EPSG:4326"}}, "features": ['
+    return json_array_chunks(features, batch_size, prefix=prefix, suffix="]}")